@@ -18,7 +18,8 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from datetime import timedelta
+from datetime import date, timedelta
+import numpy as np
 import dbutils as db
 
 class ServiceDateHandler(object):
@@ -47,6 +48,7 @@ class ServiceDateHandler(object):
     self.calendar_rows = cur.fetchall();
     db.SQLExec(cur,"""select * from gtf_calendar_dates""");
     self.calendar_date_rows = cur.fetchall();
+    self._build_date_index();
 
     ## Load existing combos
 
@@ -75,12 +77,78 @@ class ServiceDateHandler(object):
       self.fill_unique_service_combinations(dbconn,autoCommit);
 
 
+  def __getstate__(self):
+    # the calendar rows are only needed to build the date index
+    state = dict(self.__dict__)
+    state.pop('calendar_rows',None)
+    state.pop('calendar_date_rows',None)
+    return state
+
+
   @staticmethod
   def parseDate(text):
     """Given a date in yyyy-mm-dd format, returns a datetime.date object"""
     #date conveniently returned in format yyyy-mm-dd
     return date(*map(int,text.split("-")))
 
+  @staticmethod
+  def toDate(value):
+    if isinstance(value,basestring):
+      return ServiceDateHandler.parseDate(value)
+    return value
+
+
+  def _build_date_index(self):
+    """
+    Works out the service IDs in effect on every day from the first
+    to the last date mentioned in the calendar tables, so that
+    effective_service_ids is a lookup.
+
+    self.day_codes[d] is the index into self.service_tuples of the
+    service IDs in effect on the day with ordinal self.first_ordinal+d.
+    """
+    ordinals = []
+    for row in self.calendar_rows:
+      ordinals.append(self.toDate(row['start_date']).toordinal())
+      ordinals.append(self.toDate(row['end_date']).toordinal())
+    for row in self.calendar_date_rows:
+      ordinals.append(self.toDate(row['date']).toordinal())
+    self.service_tuples = [()]
+    if not ordinals:
+      self.first_ordinal = 0
+      self.day_codes = np.zeros(0,dtype=np.int32)
+      return
+    self.first_ordinal = first = min(ordinals)
+    day_sets = [set() for i in xrange(max(ordinals) - first + 1)]
+
+    for row in self.calendar_rows:
+      # recall we selected mon,tues,... first in the query
+      runs = [int(row[i]) for i in range(7)]
+      service_id = row['service_id']
+      start = self.toDate(row['start_date']).toordinal()
+      end = self.toDate(row['end_date']).toordinal()
+      for o in xrange(start,end+1):
+        if runs[(o+6)%7]: # ordinal 1 was a monday
+          day_sets[o-first].add(service_id)
+
+    for row in self.calendar_date_rows:
+      service_ids = day_sets[self.toDate(row['date']).toordinal()-first]
+      if int(row['exception_type'])-2: # 1 means added, 2 means removed
+        #so this means added
+        service_ids.add(row['service_id']);
+      else:
+        #and this means removed
+        service_ids.discard(row['service_id']);
+
+    codes = {(): 0}
+    self.day_codes = np.zeros(len(day_sets),dtype=np.int32)
+    for i,service_ids in enumerate(day_sets):
+      key = tuple(sorted(service_ids)) # to prevent permuted duplicates
+      code = codes.get(key)
+      if code is None:
+        code = codes[key] = len(self.service_tuples)
+        self.service_tuples.append(key)
+      self.day_codes[i] = code
 
 
   def effective_service_ids(self,day):
@@ -88,29 +156,22 @@ class ServiceDateHandler(object):
     Given a day (date object), returns a collection of service IDs
     that are in effect on that day
     """
-    service_ids = set()
-    dayOfWeek = day.weekday() #0-6 for Mon-Sun
-    for row in self.calendar_rows:     
-      # recall we selected mon,tues,... first in the query
-      if int(row[dayOfWeek]):
-        #this service runs on this day of the week
-        if row['start_date'] <= day and row['end_date'] >= day: 
-          #this service applies to this date
-          service_ids.add(row['service_id']);
+    d = day.toordinal() - self.first_ordinal
+    if d < 0 or d >= len(self.day_codes):
+      return ()
+    return self.service_tuples[self.day_codes[d]]
 
-    for row in self.calendar_date_rows:
-      rowDate = row['date'];
-      if rowDate == day:
-        if int(row['exception_type'])-2: # 1 means added, 2 means removed
-          #so this means added
-          service_ids.add(row['service_id']);
-        else:
-          #and this means removed
-          service_ids.discard(row['service_id']);
-          
-    ret = list(service_ids);
-    ret.sort(); # to prevent permuted duplicates
-    return tuple(ret);
+  def service_ids_for_dates(self,days):
+    """
+    Given a sequence of days (date objects), returns a list of the
+    effective_service_ids for each.
+    """
+    d = np.array([day.toordinal() for day in days],dtype=np.int64) \
+        - self.first_ordinal
+    inside = (d >= 0) & (d < len(self.day_codes))
+    codes = np.zeros(len(d),dtype=np.int32)
+    codes[inside] = self.day_codes[d[inside]]
+    return [self.service_tuples[c] for c in codes]
 
 
 
@@ -20,7 +20,16 @@
 
 import psycopg2 as db
 import psycopg2.extras
+import psycopg2.extensions
+import re
 from ServiceDateHandler import ServiceDateHandler
+from cStringIO import StringIO
+import cPickle
+import os
+import stat
+import tempfile
+import threading
+import time
 
 def read_config(fname):
   f = open(fname,'r');
@@ -43,13 +52,123 @@ for i in range(5):
     continue
   break
 
-conn = None
+# Each thread checks out its own connection from the pool on first use;
+# see get_conn(). The ServiceDateHandler is also made on first use; see
+# get_service_date_handler().
+pool = None
+local = threading.local()
 SDHandler = None
+# held while the ServiceDateHandler is being made
+sdh_lock = threading.Lock()
 
-def SQLCopy(cur,copy_stmt,rowList):
-  gtx = cur.greentrunk;
-  copier = gtx.query(copy_stmt);
-  copier(rowList);
+# Most connections the pool will have open at once
+POOL_MAX_CONNS = 20
+# Seconds to wait for a connection when all of them are in use
+POOL_WAIT_SECONDS = 30
+# Idle connections are checked before reuse after this many seconds
+POOL_CHECK_SECONDS = 30
+# Milliseconds a statement may run for on pool connections (None: forever)
+STATEMENT_TIMEOUT_MS = None
+
+# Built ServiceDateHandlers are saved here, named by feed fingerprint.
+# They are pickles, so the directory must be writable by no one else.
+SDH_CACHE_DIR = os.path.join(tempfile.gettempdir(),
+                             "sdhandler-%d" % (os.getuid(),))
+SDH_CACHE_VERSION = 1
+
+# Number of rows a CopyWriter buffers before sending them to the db
+COPY_FLUSH_ROWS = 5000
+
+# CopyWriters whose buffers (for the calling thread) get flushed by
+# commit() and thrown away by rollback()
+copy_writers = []
+
+def copy_text(value):
+  """
+  Returns value formatted as a field in PostgreSQL's COPY text format.
+  """
+  if value is None:
+    return '\\N'
+  if isinstance(value,bool):
+    return value and 't' or 'f'
+  if isinstance(value,float):
+    value = repr(value)
+  elif isinstance(value,unicode):
+    value = value.encode('utf-8')
+  else:
+    value = str(value)
+  return value.replace('\\','\\\\').replace('\t','\\t') \
+      .replace('\n','\\n').replace('\r','\\r')
+
+def SQLCopy(cur,table,columns,rows):
+  """
+  Writes rows, each a sequence of values in the order given by columns,
+  into table with a single COPY ... FROM STDIN. Returns the number of
+  rows written.
+  """
+  buf = StringIO()
+  count = 0
+  for row in rows:
+    buf.write('\t'.join(map(copy_text,row)))
+    buf.write('\n')
+    count += 1
+  if count == 0:
+    return 0
+  buf.seek(0)
+  cur.copy_expert("COPY %s (%s) FROM STDIN" % (table,",".join(columns)), buf)
+  return count
+
+class CopyWriter(object):
+  """
+  Buffers rows destined for a table and COPYs them in whenever
+  flush_rows of them have accumulated. Anything still buffered is
+  written by flush(), which commit() calls for every CopyWriter.
+
+  Each thread has its own buffer, which is only ever written on that
+  thread's connection, so one thread's commit() or rollback() leaves
+  the rows other threads have buffered alone.
+  """
+  def __init__(self,table,columns,flush_rows=None):
+    self.table = table
+    self.columns = list(columns)
+    self.flush_rows = flush_rows or COPY_FLUSH_ROWS
+    self.local = threading.local()
+    copy_writers.append(self)
+
+  def _rows(self):
+    rows = getattr(self.local,'rows',None)
+    if rows is None:
+      rows = self.local.rows = []
+    return rows
+
+  def write(self,row):
+    rows = self._rows()
+    rows.append(row)
+    if len(rows) >= self.flush_rows:
+      self.flush()
+
+  def writerows(self,rows):
+    for row in rows:
+      self.write(row)
+
+  def flush(self):
+    rows = self._rows()
+    if not rows:
+      return
+    cur = get_cursor()
+    SQLCopy(cur,self.table,self.columns,rows)
+    cur.close()
+    self.local.rows = []
+
+  def discard(self):
+    """
+    Throws away the rows the calling thread has buffered.
+    """
+    self.local.rows = []
+
+def flush_copy_writers():
+  for writer in copy_writers:
+    writer.flush()
 
 def SQLExec(cur,sql,params=None):
   if params:
@@ -57,33 +176,407 @@ def SQLExec(cur,sql,params=None):
   else:
     cur.execute(sql);
 
+
+# Statements registered with register_statement, by name:
+# (sql with $n placeholders, the parameter key for each n)
+prepared_statements = {}
+
+__placeholder = re.compile(r"%\((\w+)\)s")
+
+def register_statement(name,sql):
+  """
+  Registers sql, a statement with %(key)s placeholders, to be run with
+  SQLExecPrepared(cur,name,params). It is PREPAREd the first time it is
+  run on each connection, and from then on only EXECUTEd, so it is
+  parsed and planned once per connection.
+  """
+  keys = []
+  def number(match):
+    key = match.group(1)
+    if key not in keys:
+      keys.append(key)
+    return "$%d" % (keys.index(key)+1,)
+  pgsql = __placeholder.sub(number,sql).replace("%%","%")
+  if name in prepared_statements and prepared_statements[name][0] != pgsql:
+    raise Exception, "Statement %s is already registered" % (name,)
+  prepared_statements[name] = (pgsql,keys)
+
+def SQLExecPrepared(cur,name,params=None):
+  """
+  Runs the statement registered as name, with the given params dict.
+  """
+  pgsql,keys = prepared_statements[name]
+  conn = cur.connection
+  if name not in conn.prepared:
+    # PREPARE isn't transactional, so this survives a rollback
+    cur.execute("PREPARE %s AS %s" % (name,pgsql))
+    conn.prepared.add(name)
+  if keys:
+    cur.execute("EXECUTE %s (%s)" % (name,", ".join(["%s"]*len(keys))),
+                [params[k] for k in keys])
+  else:
+    cur.execute("EXECUTE %s" % (name,))
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+  """
+  A connection which remembers which statements have been PREPAREd
+  on it.
+  """
+
+  def __init__(self,*args,**kwargs):
+    psycopg2.extensions.connection.__init__(self,*args,**kwargs)
+    self.prepared = set()
+
 def commit():
-  conn.commit();
-
-def get_db_conn(params=db_params):
-  global conn,SDHandler;
-  if conn:
-    close_db_conn();
-  conn = db.connect(**params);
-  SDHandler = ServiceDateHandler(conn,True,True);
+  flush_copy_writers();
+  conn = getattr(local,'conn',None)
+  if conn is not None:
+    conn.commit();
+
+def discard_copy_writers():
+  for writer in copy_writers:
+    writer.discard()
+
+def rollback():
+  discard_copy_writers();
+  conn = getattr(local,'conn',None)
+  if conn is not None:
+    conn.rollback();
+
+
+class ConnectionPool(object):
+  """
+  A thread-safe pool of connections, opened as they are needed, up
+  to maxconn at once. A connection which has sat idle for more than
+  POOL_CHECK_SECONDS is checked with a trivial query before it is
+  handed out again, and replaced if it has gone bad.
+  """
+
+  def __init__(self,params,maxconn=None,statement_timeout=None):
+    if maxconn is None:
+      maxconn = POOL_MAX_CONNS
+    self.params = params
+    self.maxconn = maxconn
+    self.statement_timeout = statement_timeout
+    self.idle = [] # (conn, time it was checked in)
+    self.num_open = 0
+    self.cond = threading.Condition()
+
+  def _connect(self):
+    conn = db.connect(connection_factory=PreparingConnection,**self.params);
+    if self.statement_timeout is not None:
+      cur = conn.cursor()
+      cur.execute("set statement_timeout = %s",(int(self.statement_timeout),))
+      cur.close()
+      conn.commit()
+    return conn
+
+  def _healthy(self,conn,idle_since):
+    if conn.closed:
+      return False
+    if time.time() - idle_since < POOL_CHECK_SECONDS:
+      return True
+    try:
+      cur = conn.cursor()
+      cur.execute("select 1")
+      cur.close()
+      conn.rollback()
+      return True
+    except Exception:
+      return False
+
+  def _close(self,conn):
+    try:
+      conn.close()
+    except Exception:
+      pass
+
+  def checkout(self):
+    """
+    Returns a connection for the caller's sole use until it checks it
+    back in, waiting up to POOL_WAIT_SECONDS if all are in use.
+    """
+    deadline = time.time() + POOL_WAIT_SECONDS
+    self.cond.acquire()
+    try:
+      while True:
+        while self.idle:
+          conn,idle_since = self.idle.pop()
+          if self._healthy(conn,idle_since):
+            return conn
+          self._close(conn)
+          self.num_open -= 1
+        if self.num_open < self.maxconn:
+          self.num_open += 1
+          break
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          raise Exception, "No database connection free after %d seconds" \
+              % (POOL_WAIT_SECONDS,)
+        self.cond.wait(remaining)
+    finally:
+      self.cond.release()
+
+    try:
+      return self._connect()
+    except:
+      self.discard(None)
+      raise
+
+  def checkin(self,conn):
+    """
+    Returns conn to the pool. Anything it hasn't committed is
+    rolled back.
+    """
+    try:
+      if not conn.closed:
+        conn.rollback()
+    except Exception:
+      self._close(conn)
+    if conn.closed:
+      self.discard(conn)
+      return
+    self.cond.acquire()
+    try:
+      self.idle.append((conn,time.time()))
+      self.cond.notify()
+    finally:
+      self.cond.release()
+
+  def discard(self,conn):
+    """
+    Closes conn, a checked out connection, instead of returning it.
+    """
+    if conn is not None:
+      self._close(conn)
+    self.cond.acquire()
+    try:
+      self.num_open -= 1
+      self.cond.notify()
+    finally:
+      self.cond.release()
+
+  def forget(self):
+    """
+    Gives up all the idle connections without closing them, and
+    returns them.
+    """
+    self.cond.acquire()
+    try:
+      ret = [conn for conn,idle_since in self.idle]
+      self.idle = []
+      self.num_open = 0
+      return ret
+    finally:
+      self.cond.release()
+
+  def closeall(self):
+    self.cond.acquire()
+    try:
+      for conn,idle_since in self.idle:
+        self._close(conn)
+      self.num_open -= len(self.idle)
+      self.idle = []
+    finally:
+      self.cond.release()
+
+
+def configure_pool(maxconn=None,statement_timeout=None):
+  """
+  Sets the size of the pool, and the statement timeout (in ms) of
+  its connections. Must be called before the first query.
+  """
+  global pool;
+  if pool is not None:
+    raise Exception, "configure_pool must be called before the pool is used"
+  pool = ConnectionPool(db_params,maxconn,statement_timeout)
+
+def get_pool():
+  global pool;
+  if pool is None:
+    pool = ConnectionPool(db_params,statement_timeout=STATEMENT_TIMEOUT_MS)
+  return pool
+
+# Connections inherited from a parent process; see reconnect_after_fork()
+inherited_conns = []
+
+def reconnect_after_fork():
+  """
+  Gives a forked child process connections of its own. The connections
+  inherited from the parent belong to the parent's sessions, so they
+  are neither used nor closed here (closing them, or letting them be
+  garbage collected, would end the parent's sessions too).
+  """
+  global pool,local;
+  # rows buffered before the fork are the parent's to write
+  discard_copy_writers()
+  conn = getattr(local,'conn',None)
+  if conn is not None:
+    inherited_conns.append(conn);
+  if pool is not None:
+    inherited_conns.extend(pool.forget());
+    pool = ConnectionPool(pool.params,pool.maxconn,pool.statement_timeout)
+  local = threading.local()
+  return get_conn();
+
+def get_db_conn(params=None):
+  """
+  Gives the calling thread a fresh connection, closing the one it had
+  if there is one. (Any connection the thread had is not reused.)
+  """
+  global pool;
+  if params is not None and params != get_pool().params:
+    close_db_conn()
+    pool = ConnectionPool(params,pool.maxconn,pool.statement_timeout)
+  conn = getattr(local,'conn',None)
+  if conn is not None:
+    local.conn = None
+    discard_copy_writers()
+    get_pool().discard(conn)
+  return get_conn()
+
+def get_conn():
+  """
+  Returns the calling thread's connection, checking one out of the pool
+  if this is its first use (or first use since release_conn).
+  """
+  conn = getattr(local,'conn',None)
+  if conn is None:
+    conn = local.conn = get_pool().checkout()
   return conn
 
-def get_cursor():
-  cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+def release_conn():
+  """
+  Returns the calling thread's connection to the pool, rolling back
+  anything it hasn't committed. Threads which handle one request after
+  another (such as WSGI workers) should call this after each request.
+  """
+  discard_copy_writers()
+  conn = getattr(local,'conn',None)
+  if conn is not None:
+    local.conn = None
+    get_pool().checkin(conn)
+
+def get_cursor(name=None):
+  """
+  Returns a DictCursor. If name is given, it is a server-side cursor,
+  which fetches its results from the server a batch at a time.
+  """
+  cur = get_conn().cursor(name,cursor_factory=psycopg2.extras.DictCursor)
   return cur
 
-def close_db_conn():
-  global conn;
-  if conn is None:
-    return;
+def service_date_fingerprint():
+  """
+  Returns an md5 of the calendar tables and service_combinations,
+  which is all a ServiceDateHandler is built from.
+  """
+  cur = get_cursor()
+  SQLExec(cur,"""select md5(
+  coalesce((select string_agg(t::text, ';' order by t::text)
+            from gtf_calendar t),'') || '|' ||
+  coalesce((select string_agg(t::text, ';' order by t::text)
+            from gtf_calendar_dates t),'') || '|' ||
+  coalesce((select string_agg(t::text, ';' order by t::text)
+            from service_combinations t),''))""");
+  ret = cur.fetchone()[0]
+  cur.close()
+  return ret
+
+def _sdh_cache_dir():
+  """
+  Returns SDH_CACHE_DIR, making it (readable and writable only by
+  this user) if need be. Returns None if it exists but isn't a
+  directory private to this user, as then someone else could have
+  put a pickle in it.
+  """
   try:
-    conn.close()
-  except:
+    os.mkdir(SDH_CACHE_DIR,0700)
+  except OSError:
     pass
-  conn = None;
+  try:
+    st = os.lstat(SDH_CACHE_DIR)
+  except OSError:
+    return None
+  if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() \
+        or st.st_mode & 077:
+    print "Not caching service dates: %s is not private" % (SDH_CACHE_DIR,)
+    return None
+  return SDH_CACHE_DIR
+
+def _sdh_cache_file(cachedir,fingerprint):
+  return os.path.join(cachedir, "sdhandler_%d_%s.pickle" 
+                      % (SDH_CACHE_VERSION,fingerprint))
+
+def get_service_date_handler():
+  """
+  Returns the ServiceDateHandler, which is made on first use. If the
+  GTFS calendar hasn't changed since one was last built (by any of
+  this user's processes), that one is loaded from SDH_CACHE_DIR instead
+  of being built again. Building one fills in any missing service
+  combinations, and commits them on a connection of its own, so the
+  calling thread's transaction is left alone.
+  """
+  global SDHandler;
+  if SDHandler is not None:
+    return SDHandler
+  sdh_lock.acquire()
+  try:
+    if SDHandler is None:
+      # everything the handler does goes through get_cursor(), so give
+      # this thread another connection while it is made
+      saved = getattr(local,'conn',None)
+      conn = local.conn = get_pool().checkout()
+      try:
+        SDHandler = _make_service_date_handler()
+        conn.commit()
+      finally:
+        local.conn = saved
+        get_pool().checkin(conn)
+    return SDHandler
+  finally:
+    sdh_lock.release()
 
-get_db_conn();
+def _make_service_date_handler():
+  cachedir = _sdh_cache_dir()
+  if cachedir is not None:
+    fname = _sdh_cache_file(cachedir,service_date_fingerprint())
+    try:
+      f = open(fname,'rb')
+      try:
+        return cPickle.load(f)
+      finally:
+        f.close()
+    except Exception:
+      pass
 
+  handler = ServiceDateHandler(get_conn(),True,True);
+  if cachedir is None:
+    return handler
+  # filling in combos changes the fingerprint
+  fname = _sdh_cache_file(cachedir,service_date_fingerprint())
+  tmpname = "%s.%d.tmp" % (fname,os.getpid())
+  try:
+    f = open(tmpname,'wb')
+    try:
+      cPickle.dump(handler,f,cPickle.HIGHEST_PROTOCOL)
+    finally:
+      f.close()
+    os.rename(tmpname,fname)
+  except (IOError,OSError),e:
+    print "Couldn't cache service dates in %s: %s" % (fname,e)
+  return handler
+
+def close_db_conn():
+  """
+  Closes the calling thread's connection and all idle ones.
+  """
+  conn = getattr(local,'conn',None)
+  if conn is not None:
+    local.conn = None
+    get_pool().discard(conn)
+  if pool is not None:
+    pool.closeall()
 
 
 
@@ -0,0 +1,184 @@
+"""
+gisarray.py: Array versions of the geometry in gisutils.
+
+Every function here takes numpy arrays (or anything numpy can broadcast,
+including plain floats) of latitudes and longitudes, so that a whole
+polyline of segments can be measured against one or many query points
+in a single call. All of the answers are computed in closed form in a
+local meter coordinate system; no geometry objects are constructed.
+
+The conventions (projection center, rounding) follow gisutils exactly,
+so that gisutils' scalar functions can be implemented on top of these.
+"""
+
+# Copyright (c) 2010 Colin Bick, Robert Damphousse
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import numpy as np
+
+
+def latlon_distance_conversion(lat):
+  """
+  Array version of gisutils.latlon_distance_conversion.
+  Given latitudes (in degrees), returns (mperlat,mperlon) arrays.
+  """
+  lat = np.asarray(lat,dtype=np.float64)
+  m1 = 111132.92;
+  m2 = -559.82;
+  m3 = 1.175;
+  m4 = -0.0023;
+  p1 = 111412.84;
+  p2 = -93.5;
+  p3 = 0.118;
+
+  # NB: as in gisutils, the cosines are taken of the degree values.
+  latlen = m1 + (m2 * np.cos(2 * lat)) + (m3 * np.cos(4 * lat)) + \
+      (m4 * np.cos(6 * lat));
+  lonlen = (p1 * np.cos(lat)) + (p2 * np.cos(3 * lat)) + \
+      (p3 * np.cos(5 * lat));
+
+  return (latlen,lonlen);
+
+
+def to_meters(lat,lon,ref_lat,ref_lon):
+  """
+  Translates (lat,lon) to (x,y) meters east and north of
+  (ref_lat,ref_lon), using the length of a degree at ref_lat.
+  """
+  m_per_lat,m_per_lon = latlon_distance_conversion(ref_lat)
+  x = (np.asarray(lon,dtype=np.float64) - ref_lon) * m_per_lon
+  y = (np.asarray(lat,dtype=np.float64) - ref_lat) * m_per_lat
+  return x,y
+
+
+def point_segment_distance(x1,y1,x2,y2,px,py):
+  """
+  Given segments (x1,y1)-(x2,y2) and points (px,py) in a planar
+  coordinate system, returns (dist,frac) where dist is the distance
+  from each point to its segment and frac is the fractional progress
+  along the segment of the closest point.
+
+  Zero-length segments have frac 0.0.
+  """
+  dx,dy = x2-x1, y2-y1
+  seglen2 = dx*dx + dy*dy
+  degenerate = (seglen2 == 0)
+  frac = ((px-x1)*dx + (py-y1)*dy) / np.where(degenerate,1.0,seglen2)
+  frac = np.where(degenerate, 0.0, np.clip(frac,0.0,1.0))
+  cx,cy = x1 + frac*dx, y1 + frac*dy
+  return np.hypot(px-cx,py-cy), frac
+
+
+def circle_intersection(x1,y1,x2,y2,px,py,tol):
+  """
+  Given segments (x1,y1)-(x2,y2), circle centers (px,py) and a radius
+  tol, returns (hit,enter_frac,exit_frac) where hit is a boolean array
+  saying whether each segment passes within tol of its center, and
+  enter_frac/exit_frac are the fractional progress along the segment
+  of the first and last points within the circle.
+
+  Segment endpoints inside the circle give exactly 0.0 and 1.0.
+  Where hit is False, the fractions are meaningless.
+  """
+  dx,dy = x2-x1, y2-y1
+  ox,oy = x1-px, y1-py
+  a = dx*dx + dy*dy
+  b = 2.0 * (dx*ox + dy*oy)
+  c = ox*ox + oy*oy - tol*tol
+  c_end = (x2-px)**2 + (y2-py)**2 - tol*tol
+
+  degenerate = (a == 0)
+  safe_a = np.where(degenerate,1.0,a)
+  disc = b*b - 4*a*c
+  root = np.sqrt(np.where(disc > 0, disc, 0.0))
+  t1 = (-b - root) / (2*safe_a)
+  t2 = (-b + root) / (2*safe_a)
+
+  hit = np.where(degenerate, c <= 0, (disc >= 0) & (t1 <= 1.0) & (t2 >= 0.0))
+  enter_frac = np.where(c <= 0, 0.0, np.clip(t1,0.0,1.0))
+  exit_frac = np.where(degenerate | (c_end <= 0), 1.0, np.clip(t2,0.0,1.0))
+  return hit, enter_frac, exit_frac
+
+
+def distance_meters(lat1,lon1,lat2,lon2):
+  """
+  Array version of gisutils.distance_meters.
+  """
+  lat1,lon1,lat2,lon2 = [np.asarray(v,dtype=np.float64)
+                         for v in (lat1,lon1,lat2,lon2)]
+  m_per_lat,m_per_lon = latlon_distance_conversion((lat1+lat2)/2)
+  return np.hypot((lon2-lon1)*m_per_lon, (lat2-lat1)*m_per_lat)
+
+
+def distance_from_segment_meters(lat1,lon1,lat2,lon2,plat,plon):
+  """
+  Array version of gisutils.distance_from_segment_meters.
+  Each distance is measured in a frame centered on the mean of
+  its segment's endpoints and query point.
+  """
+  lat1,lon1,lat2,lon2,plat,plon = [np.asarray(v,dtype=np.float64)
+                                   for v in (lat1,lon1,lat2,lon2,plat,plon)]
+  midlat = (lat1+lat2+plat)/3.
+  midlon = (lon1+lon2+plon)/3.
+  x1,y1 = to_meters(lat1,lon1,midlat,midlon)
+  x2,y2 = to_meters(lat2,lon2,midlat,midlon)
+  px,py = to_meters(plat,plon,midlat,midlon)
+  return point_segment_distance(x1,y1,x2,y2,px,py)[0]
+
+
+def interp_helper(lat1,lon1,lat2,lon2,plat,plon):
+  """
+  Array version of gisutils.interp_helper.
+  Returns (distance,fraction) arrays.
+  """
+  D_ps = distance_from_segment_meters(lat1,lon1,lat2,lon2,plat,plon)
+  D_12 = distance_meters(lat1,lon1,lat2,lon2)
+  D_p1 = distance_meters(lat1,lon1,plat,plon)
+
+  # gisutils truncates the distances to whole meters here
+  near_start = (D_12 == 0) | (D_p1 < D_ps)
+  leg2 = np.trunc(D_p1)**2 - np.trunc(D_ps)**2
+  frac = np.sqrt(np.where(near_start,0.0,leg2)) / np.where(D_12==0,1.0,D_12)
+
+  dist = np.where(near_start,D_p1,D_ps)
+  frac = np.where(near_start,0.0,frac)
+  return dist,frac
+
+
+def distance_intersect(lat1,lon1,lat2,lon2,plat,plon,tol):
+  """
+  Array version of gisutils.distance_intersect.
+  Returns (hit,enter_frac,exit_frac,min_dist) arrays, where hit
+  is False for segments which never come within tol meters of their
+  point (gisutils returns None in that case).
+
+  The circle is exact, where gisutils used to intersect with shapely's
+  400-gon buffer: distances agree with it to ~1e-13 meters, but the
+  fractions differ by up to ~5e-3 (for segments tens of meters long
+  which graze the circle); see common/tests/test_gisarray.py.
+  """
+  plat = np.asarray(plat,dtype=np.float64)
+  plon = np.asarray(plon,dtype=np.float64)
+  x1,y1 = to_meters(lat1,lon1,plat,plon)
+  x2,y2 = to_meters(lat2,lon2,plat,plon)
+  hit,enter_frac,exit_frac = circle_intersection(x1,y1,x2,y2,0.0,0.0,tol)
+  min_dist = point_segment_distance(x1,y1,x2,y2,0.0,0.0)[0]
+  return hit,enter_frac,exit_frac,min_dist
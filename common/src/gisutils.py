@@ -19,7 +19,7 @@
 # THE SOFTWARE.
 
 import math
-import shapely.geometry as geom
+import gisarray as gisa
 
 def latlon_distance_conversion(lat):
   """
@@ -95,21 +95,11 @@ def distance_from_segment_meters(pt1,pt2,ll):
   and a third (lat,lon) point ll, returns the distance
   in meters of ll from the segment.
   """
-  ## First convert to meter coordinates for proper distance
   lat1,lon1 = map(float,pt1)
   lat2,lon2 = map(float,pt2)
   llat,llon = map(float,ll)
-  midlat = (lat1+lat2+llat)/3.
-  midlon = (lon1+lon2+llon)/3.
-  m_per_lat,m_per_lon = latlon_distance_conversion(midlat);
-  ## Translate to the weighted center
-  y1,x1 = (lat1-midlat)*m_per_lat,(lon1-midlon)*m_per_lon
-  y2,x2 = (lat2-midlat)*m_per_lat,(lon2-midlon)*m_per_lon
-  ly,lx = (llat-midlat)*m_per_lat,(llon-midlon)*m_per_lon
-  ## Compute and return answer
-  sh_line = geom.LineString(( (x1,y1) , (x2,y2) ))
-  sh_pt = geom.Point(( lx,ly ))
-  return sh_pt.distance(sh_line);
+  return float(gisa.distance_from_segment_meters(lat1,lon1,lat2,lon2,
+                                                 llat,llon));
 
 def interp_helper(ll1,ll2,pt):
   """
@@ -118,15 +108,11 @@ def interp_helper(ll1,ll2,pt):
   fraction = fractional progress of the minimum-distance point
   along the segment ll1->ll2
   """
-  D_ps = distance_from_segment_meters(ll1,ll2,pt);
-  D_12 = distance_meters(ll1,ll2);
-  D_p1 = distance_meters(ll1,pt);
-  if D_12 == 0:
-    return D_p1,0.0
-  if D_p1 < D_ps:
-    return D_p1,0.0
-  frac = math.sqrt( int(D_p1)**2 - int(D_ps)**2 ) / D_12;      
-  return (D_ps,frac);
+  lat1,lon1 = map(float,ll1)
+  lat2,lon2 = map(float,ll2)
+  ptlat,ptlon = map(float,pt)
+  dist,frac = gisa.interp_helper(lat1,lon1,lat2,lon2,ptlat,ptlon);
+  return (float(dist),float(frac));
 
 def timefrac_helper(t1,t2,frac):
   """
@@ -152,36 +138,12 @@ def distance_intersect(ll1,ll2,pt,tol):
   Returns None if the ll1-ll2 segment has no points within
   tol meters of pt.
   """
-  ## First convert to meter coordinates for proper distance
   lat1,lon1 = map(float,ll1)
   lat2,lon2 = map(float,ll2)
   ptlat,ptlon = map(float,pt)
-  midlat = ptlat #(lat1+lat2+ptlat)/3.
-  midlon = ptlon #(lon1+lon2+ptlon)/3.
-  m_per_lat,m_per_lon = latlon_distance_conversion(midlat);
-  ## Translate to the weighted center
-  y1,x1 = (lat1-midlat)*m_per_lat,(lon1-midlon)*m_per_lon
-  y2,x2 = (lat2-midlat)*m_per_lat,(lon2-midlon)*m_per_lon
-  pty,ptx = (ptlat-midlat)*m_per_lat,(ptlon-midlon)*m_per_lon
-  
-  intersect_zone = geom.Point((ptx,pty)).buffer(tol,100)
-  simple_point = geom.Point((ptx,pty))
-  seg = geom.LineString(( (x1,y1) , (x2,y2) ))
-  intersect = intersect_zone.intersection(seg);
-  
-  if intersect.is_empty:
+  hit,frac_1,frac_2,min_dist = gisa.distance_intersect(lat1,lon1,lat2,lon2,
+                                                       ptlat,ptlon,tol)
+  if not hit:
     return None
 
-  begin_pt, end_pt = geom.Point((x1,y1)), geom.Point((x2,y2))
-  frac_a = geom.Point( intersect.coords[0] ).distance( begin_pt ) / seg.length
-  frac_b = geom.Point( intersect.coords[1] ).distance( begin_pt ) / seg.length
-
-  frac_1,frac_2 = min(frac_a,frac_b), max(frac_a,frac_b)
-  if begin_pt.distance(simple_point) <= tol:
-    frac_1 = 0.0
-  if end_pt.distance(simple_point) <= tol:
-    frac_2 = 1.0
-
-  min_dist = simple_point.distance(seg)
-  
-  return (frac_1,frac_2,min_dist)
+  return (float(frac_1),float(frac_2),float(min_dist))
@@ -0,0 +1,94 @@
+"""
+Checks gisarray against the shapely geometry which gisutils used
+before it, over a fixed sample of segments and points around SF.
+
+Run with: python -m unittest discover -s common/tests
+"""
+
+import random
+import unittest
+from os import path,sys
+
+sys.path.insert(0,path.join(path.dirname(path.abspath(__file__)),
+                            "../src"))
+import gisarray as gisa
+
+try:
+  import shapely.geometry as geom
+except ImportError:
+  geom = None
+
+# Segments are up to this many degrees long in each direction, and
+# points up to this far from their segment's start.
+SPAN_DEGREES = 0.0008
+NUM_SAMPLES = 20000
+
+# shapely's buffer(tol,100) is a 400-gon inscribed in the circle, so its
+# entry/exit points are off by up to ~tol*pi/400 meters near a tangent,
+# which for these segment lengths is this much of a segment.
+FRAC_TOLERANCE = 5e-3
+DIST_TOLERANCE = 1e-9
+
+
+def shapely_distance_intersect(lat1,lon1,lat2,lon2,plat,plon,tol):
+  """
+  gisutils.distance_intersect as it was written with shapely.
+  """
+  m_per_lat,m_per_lon = gisa.latlon_distance_conversion(plat)
+  y1,x1 = (lat1-plat)*m_per_lat,(lon1-plon)*m_per_lon
+  y2,x2 = (lat2-plat)*m_per_lat,(lon2-plon)*m_per_lon
+  center = geom.Point((0.0,0.0))
+  seg = geom.LineString(( (x1,y1), (x2,y2) ))
+  intersect = center.buffer(tol,100).intersection(seg)
+  if intersect.is_empty:
+    return None
+  begin_pt,end_pt = geom.Point((x1,y1)),geom.Point((x2,y2))
+  frac_a = geom.Point(intersect.coords[0]).distance(begin_pt) / seg.length
+  frac_b = geom.Point(intersect.coords[1]).distance(begin_pt) / seg.length
+  frac_1,frac_2 = min(frac_a,frac_b),max(frac_a,frac_b)
+  if begin_pt.distance(center) <= tol:
+    frac_1 = 0.0
+  if end_pt.distance(center) <= tol:
+    frac_2 = 1.0
+  return frac_1,frac_2,center.distance(seg)
+
+
+def samples(seed):
+  rand = random.Random(seed)
+  for i in xrange(NUM_SAMPLES):
+    lat1,lon1 = 37.7 + 0.1*rand.random(), -122.5 + 0.1*rand.random()
+    yield (lat1, lon1,
+           lat1 + rand.uniform(-1,1)*SPAN_DEGREES,
+           lon1 + rand.uniform(-1,1)*SPAN_DEGREES,
+           lat1 + rand.uniform(-1,1)*SPAN_DEGREES,
+           lon1 + rand.uniform(-1,1)*SPAN_DEGREES,
+           rand.choice([20,50,100]))
+
+
+class DistanceIntersectTest(unittest.TestCase):
+
+  @unittest.skipIf(geom is None, "shapely is not installed")
+  def test_agrees_with_shapely(self):
+    max_frac,max_dist,compared = 0.0,0.0,0
+    for args in samples(2):
+      tol = args[-1]
+      expected = shapely_distance_intersect(*args)
+      hit,frac_1,frac_2,min_dist = gisa.distance_intersect(*args)
+      if expected is None and not hit:
+        continue
+      if expected is None or not hit:
+        # the 400-gon misses segments which only graze the circle
+        self.assertTrue(abs(min_dist - tol) < 1e-4*tol,
+                        "hit=%s but min_dist=%f, tol=%d" % (hit,min_dist,tol))
+        continue
+      compared += 1
+      max_frac = max(max_frac, abs(frac_1-expected[0]),
+                     abs(frac_2-expected[1]))
+      max_dist = max(max_dist, abs(min_dist-expected[2]))
+    self.assertTrue(compared > NUM_SAMPLES/4)
+    self.assertTrue(max_frac < FRAC_TOLERANCE, max_frac)
+    self.assertTrue(max_dist < DIST_TOLERANCE, max_dist)
+
+
+if __name__ == "__main__":
+  unittest.main()
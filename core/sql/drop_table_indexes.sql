@@ -8,6 +8,7 @@ DROP index gpsstop_seq_index;
 DROP index gps_segid_index;
 DROP index segid_track_index;
 DROP index seg_sort_idx;
+DROP index track_time_idx;
 DROP INDEX tripstart_idx;
 DROP INDEX tripstart_time_idx;
 DROP INDEX tripstart_idtime_idx;
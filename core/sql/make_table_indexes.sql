@@ -13,6 +13,7 @@ create index gps_segid_index on gps_stop_times(gps_segment_id);
 
 create index segid_track_index on tracked_routes(gps_segment_id);
 create index seg_sort_idx on tracked_routes(gps_segment_id,reported_update_time);
+create index track_time_idx on tracked_routes(reported_update_time);
 
 
 
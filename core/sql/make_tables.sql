@@ -8,6 +8,9 @@ drop table gps_segments cascade;
 drop table gtf_trip_information cascade;
 drop table gtf_stoptimes_information cascade;
 drop table datamining_table cascade;
+drop table match_watermarks cascade;
+drop table archive_progress cascade;
+drop table gps_schedule_progress cascade;
 
 begin;
 
@@ -144,4 +147,27 @@ create table datamining_table (
   stop_distance numeric
 );
 
+
+create table match_watermarks (
+  route_short_name text primary key,
+  reported_update_time timestamp --newest vehicle_track report matched so far
+);
+
+
+create table gps_schedule_progress (
+  -- a chunk of gps_segment_ids whose gps_stop_times have been committed
+  first_segment_id bigint,
+  last_segment_id bigint,
+  num_segments integer,
+  incremental boolean not null, -- whether done by an --incremental run
+  primary key (first_segment_id, last_segment_id)
+);
+
+
+create table archive_progress (
+  archive text primary key, --file name of an archive of NextBus snapshots
+  members_loaded integer, --snapshots loaded into vehicle_track so far
+  finished boolean
+);
+
 commit;
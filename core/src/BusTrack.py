@@ -26,8 +26,55 @@ BusTrack.py: Interface definition for a BusTrack object
 
 
 import gisutils as gis
+import gisarray as gisa
+import numpy as np
 from math import sqrt
 
+
+class TrackInterpolation(object):
+  """
+  The (lat,lon,time) points along a BusTrack, sorted by time and stored
+  as three contiguous float64 columns: lats, lons and times.
+
+  For compatibility with code written against the old list-of-tuples
+  representation, indexing returns a (lat,lon,time) tuple, slicing
+  returns another TrackInterpolation (sharing the same columns), and
+  iterating yields tuples.
+  """
+  __slots__ = ('lats','lons','times')
+
+  def __init__(self,lats,lons,times):
+    self.lats = np.ascontiguousarray(lats,dtype=np.float64)
+    self.lons = np.ascontiguousarray(lons,dtype=np.float64)
+    self.times = np.ascontiguousarray(times,dtype=np.float64)
+
+  @staticmethod
+  def fromPoints(points):
+    """
+    Given a TrackInterpolation or a list of (lat,lon,time) tuples,
+    returns a TrackInterpolation.
+    """
+    if isinstance(points,TrackInterpolation):
+      return points
+    cols = np.array(points,dtype=np.float64).reshape(-1,3)
+    return TrackInterpolation(cols[:,0],cols[:,1],cols[:,2])
+
+  def __len__(self):
+    return len(self.times)
+
+  def __nonzero__(self):
+    return len(self.times) > 0
+
+  def __getitem__(self,key):
+    if isinstance(key,slice):
+      return TrackInterpolation(self.lats[key],self.lons[key],self.times[key])
+    return (float(self.lats[key]),float(self.lons[key]),float(self.times[key]))
+
+  def __iter__(self):
+    return iter(zip(self.lats.tolist(),self.lons.tolist(),
+                    self.times.tolist()))
+
+
 class BusTrack(object):
   """
   Represents the continuous-time movement of a single bus along
@@ -37,11 +84,14 @@ class BusTrack(object):
 
   def __init__(self):
     self.cached_index = 0;
-    self.interpolation = self._loadInterpolation();
+    interpolation = self._loadInterpolation();
+    if interpolation is not None:
+      interpolation = TrackInterpolation.fromPoints(interpolation);
+    self.interpolation = interpolation;
     self.bounding_box = self._findBoundingBox();
     if self.interpolation:
-      self.min_time = self.interpolation[0][2];
-      self.max_time = self.interpolation[-1][2];
+      self.min_time = float(self.interpolation.times[0]);
+      self.max_time = float(self.interpolation.times[-1]);
 
   def _findBoundingBox(self):
     """
@@ -52,39 +102,68 @@ class BusTrack(object):
     """
     if self.interpolation is None:
       return None
-    initial = (1000,-1000,1000,-1000);
-    def helper(bounds,point):
-      lat,lon = map(float,(point[0],point[1]))
-      return (min(bounds[0],lat), max(bounds[1], lat), 
-              min(bounds[2],lon), max(bounds[3], lon));
-    
-    return reduce(helper, self.interpolation, initial);
+    if not self.interpolation:
+      return (1000,-1000,1000,-1000);
+    lats,lons = self.interpolation.lats,self.interpolation.lons
+    return (float(lats.min()), float(lats.max()),
+            float(lons.min()), float(lons.max()));
 
   def _loadInterpolation(self):
     """
     A private method meant to be overridden by subclasses, which returns
-    a list of (lat,lon,time) tuples, sorted by time. This list of tuples
-    represents points along the bus movement.
+    either a TrackInterpolation or a list of (lat,lon,time) tuples, sorted 
+    by time. These points represent points along the bus movement.
     """
     raise Exception, "Unimplemented"
 
-  def _interpolate(self,pt0,pt1,time):
+  def _interpolate(self,idx,times):
     """
     A private method meant to be overridden by subclasses, which returns
-    a (lat,lon) indicating the estimated position of the vehicle at the
-    given time, provided that time lives between pt0 and pt1.
-    pt0 and pt1 are each (lat,lon,time) tuples.
+    (lats,lons) arrays indicating the estimated positions of the vehicle at
+    the given times, provided that each times[k] lives between the points
+    at idx[k] and idx[k]+1 of the interpolation.
 
     The implementation below is a simple linear interpolation.
     """
-    (lat0,lon0,time0) = pt0
-    (lat1,lon1,time1) = pt1
+    interp = self.interpolation
+    lat0,lon0,time0 = interp.lats[idx],interp.lons[idx],interp.times[idx]
+    lat1,lon1,time1 = interp.lats[idx+1],interp.lons[idx+1],interp.times[idx+1]
     # same time different place?
-    if time1 == time0:
-      return (lat1+lat0)/2,(lon1+lon0)/2
-    ratio = float(time-time0)/(time1-time0)
-    dlat,dlon = (lat1-lat0),(lon1-lon0)
-    return (lat0 + dlat*ratio, lon0 + dlon*ratio)
+    same = (time1 == time0)
+    ratio = (times-time0) / np.where(same,1.0,time1-time0)
+    lats = np.where(same, (lat1+lat0)/2, lat0 + (lat1-lat0)*ratio)
+    lons = np.where(same, (lon1+lon0)/2, lon0 + (lon1-lon0)*ratio)
+    return lats,lons
+
+
+  def _findTimeIndices(self,times):
+    """
+    Given an array of times within the bounding time of the route,
+    returns for each one the index i of the interpolation point
+    beginning the sub-segment in which that time lives, i.e. the
+    smallest i with interpolation time i+1 >= time.
+    """
+    idx = np.searchsorted(self.interpolation.times,times,side='left') - 1
+    return np.clip(idx,0,len(self.interpolation)-2)
+
+
+  def getLocationsAtTimes(self,times):
+    """
+    Given an array of times, returns (lats,lons), two arrays holding
+    the (estimated) locations of the bus at those times. Entries for
+    times before or after the bounding time of the route are NaN.
+    """
+    times = np.asarray(times,dtype=np.float64)
+    lats = np.empty(times.shape)
+    lons = np.empty(times.shape)
+    lats.fill(np.nan)
+    lons.fill(np.nan)
+    inbounds = (times >= self.min_time) & (times <= self.max_time)
+    if inbounds.any():
+      t = times[inbounds]
+      lats[inbounds],lons[inbounds] = self._interpolate(
+        self._findTimeIndices(t), t )
+    return lats,lons
 
 
   def getLocationAtTime(self,time):
@@ -92,21 +171,36 @@ class BusTrack(object):
     Given a time, returns a (lat,lon) location of the (estimated)
     location of the bus at that time. If the time is before or after
     the bounding time of the route, then None is returned.
+
+    As a side effect, sets the internal cached index to the index
+    of the sub-segment containing time.
     """
     if time < self.min_time or time > self.max_time:
       return None
-    if time < self.interpolation[self.cached_index][2]:
-      self.cached_index = 0    
-    
-    # Since time is within our bounds, this won't violate 
-    # the bounds of our list
-    while time > self.interpolation[self.cached_index+1][2]:
-      self.cached_index += 1
-    
-    pt0 = self.interpolation[self.cached_index]
-    pt1 = self.interpolation[self.cached_index+1]
-    
-    return self._interpolate( pt0, pt1, time );
+    idx = self._findTimeIndices(np.array([time],dtype=np.float64))
+    self.cached_index = int(idx[0])
+    lats,lons = self._interpolate( idx, np.array([time],dtype=np.float64) )
+    return (float(lats[0]),float(lons[0]));
+
+
+  def _segmentsFrom(self,starttime):
+    """
+    Returns (lat1,lon1,lat2,lon2,t1,t2), column arrays describing the
+    sub-segments of this track from starttime onward. The first
+    sub-segment begins at the location of the bus at starttime.
+    Leaves the internal cached index at the beginning of that
+    first sub-segment.
+    """
+    startloc = self.getLocationAtTime(starttime);
+    c = self.cached_index
+    interp = self.interpolation
+    lat1 = interp.lats[c:-1].copy()
+    lon1 = interp.lons[c:-1].copy()
+    t1 = interp.times[c:-1].copy()
+    lat1[0],lon1[0] = startloc
+    t1[0] = starttime
+    return (lat1, lon1, interp.lats[c+1:], interp.lons[c+1:],
+            t1, interp.times[c+1:])
 
 
   def getArrivalTimeAtLocation(self,stoploc,tol=10.0,starttime=None):
@@ -123,41 +217,28 @@ class BusTrack(object):
     If this track was never within tol meters of the location, then 
     returns None.
     """
-    ## We'll use the internal cached index here, just as in the
-    ## getLocationAtTime method, in order to speed up sequential
-    ## requests to this method.
-
-    # Some might consider this bad programming practice,
-    # in that we rely on the behavior of another method
-    # to correcty implement this one.
-    # If this ends up causing breakage, then there should
-    # be some kind of "setInternalTime()" method for this class.
     if starttime is None: starttime = self.min_time;
     starttime = max(starttime,self.min_time);
     if starttime > self.max_time:
       return None
 
-    startloc = self.getLocationAtTime(starttime);
-    ll1 = startloc
-    ll2 = self.interpolation[self.cached_index+1][:2]
-    min_dist,frac = gis.interp_helper(ll1,ll2,stoploc);
-    min_time = gis.timefrac_helper(starttime,
-                               self.interpolation[self.cached_index+1][2],
-                               frac);
+    ## Measure every remaining sub-segment against stoploc at once,
+    ## then walk the results in order.
+    lat1,lon1,lat2,lon2,t1,t2 = self._segmentsFrom(starttime);
+    stoplat,stoplon = map(float,stoploc)
+    dists,fracs = gisa.interp_helper(lat1,lon1,lat2,lon2,stoplat,stoplon);
+    times = (t1 + (t2-t1)*fracs).tolist()
+    dists = dists.tolist()
+
+    min_dist,min_time = dists[0],times[0]
     within_tol = (min_dist < tol);
     if str(min_time) == 'nan':
       raise Exception, "WTF"
 
-    for idx in range(self.cached_index+1, len(self.interpolation)-1):
-      pt1 = self.interpolation[idx];
-      pt2 = self.interpolation[idx+1];
-      ll1 = pt1[:2]
-      ll2 = pt2[:2]
-      dist,frac = gis.interp_helper(ll1,ll2,stoploc);
-      
+    for dist,time in zip(dists[1:],times[1:]):
       if dist < min_dist:
         min_dist = dist;
-        min_time = gis.timefrac_helper(pt1[2],pt2[2],frac);
+        min_time = time;
         if str(min_time) == 'nan':
           raise Exception, "WTF"
 
@@ -203,76 +284,58 @@ class BusTrack(object):
     if starttime > self.max_time:
       return ret
 
-    ## Process intersection at first sub-segment
-    startloc = self.getLocationAtTime(starttime);
-    ll1 = startloc
-    ll2 = self.interpolation[self.cached_index+1][:2]
-    t1,t2 = starttime, self.interpolation[self.cached_index+1][2]
-    overall_min_dist = gis.distance_from_segment_meters( ll1, ll2, stoploc )
-    intersect = gis.distance_intersect( ll1, ll2, stoploc, tol )
-
-    if intersect:
-      enter_frac,exit_frac,min_dist = intersect
-      enter_time = gis.timefrac_helper( t1,t2,enter_frac )
-      exit_time = gis.timefrac_helper( t1,t2,exit_frac )
-      if exit_frac == 1.0:
-        current_interval = [ enter_time, exit_time, min_dist ]
-        in_range = True
-      else:
-        ret.append([ enter_time, exit_time, min_dist ])
-
-    ## Process subsequent segments
-    for i in range(self.cached_index+1, len(self.interpolation)-1):
-      llt1 = self.interpolation[i]
-      llt2 = self.interpolation[i+1]
-      ll1,ll2 = llt1[:2],llt2[:2]
+    ## Intersect every remaining sub-segment with the tolerance
+    ## zone at once, then walk the results in order.
+    lat1,lon1,lat2,lon2,t1,t2 = self._segmentsFrom(starttime);
+    stoplat,stoplon = map(float,stoploc)
+    hits,enter_fracs,exit_fracs,min_dists = \
+        gisa.distance_intersect(lat1,lon1,lat2,lon2,stoplat,stoplon,tol);
+    enter_times = (t1 + (t2-t1)*enter_fracs).tolist()
+    exit_times = (t1 + (t2-t1)*exit_fracs).tolist()
 
+    for i,hit in enumerate(hits.tolist()):
       if len(ret) > 0 and findjustone:
         return ret
 
-      overall_min_dist = min( overall_min_dist, 
-                              gis.distance_from_segment_meters(ll1,ll2,stoploc))
-
-      intersect = gis.distance_intersect( ll1,ll2,stoploc,tol )
-      if intersect is None:
+      if not hit:
         if in_range:
           ret.append(current_interval)
           in_range = False
           current_interval = None
-        else:
-          pass
+        continue
 
-      else: # intersect is not None
-        enter_frac,exit_frac,min_dist = intersect
-        enter_time = gis.timefrac_helper( llt1[2],llt2[2],enter_frac )
-        exit_time  = gis.timefrac_helper( llt1[2],llt2[2],exit_frac )
+      enter_frac,exit_frac = float(enter_fracs[i]),float(exit_fracs[i])
+      enter_time,exit_time = enter_times[i],exit_times[i]
+      min_dist = float(min_dists[i])
 
-        if not in_range: # just entered range of stoploc
-          if exit_frac == 1.0:
-            current_interval = [ enter_time, exit_time, min_dist ]
-            in_range = True
-          else:
-            ret.append([ enter_time, exit_time, min_dist ])
+      if not in_range: # just entered range of stoploc
+        if exit_frac == 1.0:
+          current_interval = [ enter_time, exit_time, min_dist ]
+          in_range = True
+        else:
+          ret.append([ enter_time, exit_time, min_dist ])
 
-        else: # in_range
-          if enter_frac != 0.0:
-            raise Exception, "While in range, found enter_frac of %f" % (enter_frac,)
+      else: # in_range
+        if enter_frac != 0.0:
+          raise Exception, "While in range, found enter_frac of %f" % (enter_frac,)
+        else:
+          current_interval[1] = exit_time
+          current_interval[2] = min(current_interval[2],min_dist)
+          if exit_frac == 1.0: # we're still in range
+            pass
           else:
-            current_interval[1] = exit_time
-            current_interval[2] = min(current_interval[2],min_dist)
-            if exit_frac == 1.0: # we're still in range
-              pass
-            else:
-              ret.append( current_interval )
-              in_range = False
-              current_interval = None
+            ret.append( current_interval )
+            in_range = False
+            current_interval = None
 
     else: # end "for i in range..."
       if in_range:
         ret.append(current_interval)
     
     if not ret: # empty list
-      print "--- No arrival, min dist was:",overall_min_dist
+      overall_min_dist = gisa.distance_from_segment_meters(lat1,lon1,lat2,lon2,
+                                                           stoplat,stoplon)
+      print "--- No arrival, min dist was:",overall_min_dist.min()
 
     return ret
 
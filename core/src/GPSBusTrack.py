@@ -38,10 +38,12 @@ for matching tracking data to the GTFS schedule.
 
 import dbqueries as db
 import math
-from BusTrack import BusTrack
-from GTFSBusTrack import GTFSBusSchedule,GTFSBusTrack
+import numpy as np
+from BusTrack import BusTrack, TrackInterpolation
+from GTFSBusTrack import GTFSBusSchedule,GTFSBusTrack,GTFSScheduleStack
 import GPSDataTools as gpstool
 import gisutils as gis
+import gisarray as gisa
 
 
 class GPSSchedule(object):
@@ -50,13 +52,19 @@ class GPSSchedule(object):
   loads arrival time data as cached in the database (the results 
   from a GPSBusSchedule matchup).
   """
-  def __init__(self,segment_id):
+  def __init__(self,segment_id,arrival_schedule=None,header=None):
     """
-    Loads segment_id's gps schedule from database
+    Loads segment_id's gps schedule from database. Either part can be
+    given instead: arrival_schedule as from dbqueries.load_gps_schedule,
+    and header as from dbqueries.load_gps_segment_header.
     """
-    self.arrival_schedule = db.load_gps_schedule(segment_id);
+    if arrival_schedule is None:
+      arrival_schedule = db.load_gps_schedule(segment_id);
+    if header is None:
+      header = db.load_gps_segment_header(segment_id);
+    self.arrival_schedule = arrival_schedule
     self.trip_id, self.trip_date, self.vehicle_id, self.schedule_error, \
-        self.schedule_offset = db.load_gps_segment_header(segment_id);
+        self.schedule_offset = header;
 
   def getNumTimePoints(self,arrival_schedule=None):
     """
@@ -116,12 +124,15 @@ class GPSBusSchedule(object):
     If offset is specified, then that offset is applied against GTFS
     data, otherwise the offset specified in the database is used.
     segment can be either the segment_id in the tracked_routes table
-    stored in the database, or it can be a GPSBusTrack object.
+    stored in the database, a TrackedVehicleSegment loaded from there
+    (with useCorrectedGTFS=False), or it can be a GPSBusTrack object.
     """
 
+    tracked = isinstance(segment,gpstool.TrackedVehicleSegment)
     if isinstance(segment,basestring) or isinstance(segment,long):
       self.segment = gpstool.TrackedVehicleSegment(segment,
                                                    useCorrectedGTFS=False);
+      tracked = True
     else:
       self.segment = segment
 
@@ -134,7 +145,7 @@ class GPSBusSchedule(object):
       
     self.schedule = self.segment.schedule;
 
-    if isinstance(segment,basestring) or isinstance(segment,long):
+    if tracked:
       self.bustrack = GPSBusTrack(self.segment);
     else:
       self.bustrack = segment
@@ -233,27 +244,25 @@ class GPSBusTrack(BusTrack):
 
   def __load(self, segment):
     self.segment = segment;
-    self.reports = segment.reports
+    self.reports = gpstool.ReportBatch.asBatch(segment.reports)
 
   def _loadInterpolation(self):
     ## WARNING: assumes no bus runs more than 24 hours
-    p0 = self.reports[0];
-    p0 = (float(p0.lat), float(p0.lon), p0.timeInSecondsIntoDay());
-    last_pt = p0;
-    interp = [p0];
-
-    for vrep in self.reports[1:]:
-      pt = [float(vrep.lat), float(vrep.lon), vrep.timeInSecondsIntoDay()]
-      if pt[2] < p0[2]:
-        if pt[2]-last_pt[2]+(24*60*60) > 600:
-          print "## WARNING: JUMP FROM %d to %d" % (last_pt[2],pt[2]+24*60*60)
-        pt[2] += 24*60*60; # We're moving into the next day
-      if tuple(pt) == last_pt:
-        continue
-      last_pt = tuple(pt)
-      interp.append(last_pt);
+    lats = self.reports.lats
+    lons = self.reports.lons
+    times = self.reports.timesInSecondsIntoDay().astype(np.float64)
+
+    # Times before the first report mean we've moved into the next day
+    nextday = (times < times[0])
+    wrapped = times + nextday*(24*60*60)
+    for i in np.flatnonzero(nextday[1:] & (np.diff(wrapped) > 600)):
+      print "## WARNING: JUMP FROM %d to %d" % (wrapped[i],wrapped[i+1])
 
-    return interp;
+    # Drop repeated reports
+    keep = np.ones(len(times),dtype=bool)
+    keep[1:] = (np.diff(lats) != 0) | (np.diff(lons) != 0) \
+        | (np.diff(wrapped) != 0)
+    return TrackInterpolation(lats[keep],lons[keep],wrapped[keep]);
 
 
   def findLaunchTime(self,tol=50):
@@ -265,22 +274,30 @@ class GPSBusTrack(BusTrack):
     time that the bus arrived at the start point, then search for
     the launch from there.
     """
+    interp = self.interpolation
     if self.segment.shape:
       arrived = False
       begin_pt = self.segment.shape.points[0];
     else:
       arrived = True
-      begin_pt = self.interpolation[0][:2];
-    for i,interp_pt in enumerate(self.interpolation):
-      dist = gis.distance_meters(begin_pt,interp_pt[:2]);
-      #print i,"dist:",dist
-      if not arrived and dist <= tol:
-        print "arrived at",interp_pt[2],"(%d steps)..."%(i,),
-        arrived = True
-      elif arrived and dist > tol:
-        print "launched at",interp_pt[2]
-        return interp_pt[2];
-    return None
+      begin_pt = interp[0][:2];
+    begin_lat,begin_lon = map(float,begin_pt)
+    dists = gisa.distance_meters(begin_lat,begin_lon,interp.lats,interp.lons)
+
+    first = 0
+    if not arrived:
+      near = np.flatnonzero(dists <= tol)
+      if len(near) == 0:
+        return None
+      first = near[0]
+      print "arrived at",interp.times[first],"(%d steps)..."%(first,),
+      first += 1
+    far = np.flatnonzero(dists[first:] > tol)
+    if len(far) == 0:
+      return None
+    launch_time = float(interp.times[first+far[0]])
+    print "launched at",launch_time
+    return launch_time
 
   def getMatchingGTFSTripID(self,search_size=20,oob_threshold=0.5):
     """
@@ -311,23 +328,21 @@ class GPSBusTrack(BusTrack):
                                            start_time,num_results=search_size);
     print "Route %s (%s) launched at %d on %s" % \
         (route_id,dir_id,start_time,start_date)
-    # dts is a list of ( (trip_id,offset_seconds), (distance,oob_frac) ) tuples
-    dts = map( lambda r: \
-                 (r,
-                  self.measureDistanceFromGTFSTrip(r[0],r[1],
-                                                   penalize_gps_oob=True,
-                                                   penalize_gtfs_oob=False)
-                  ),
-               matches );
-    # We want to filter out trips that are too far away from our
-    # time window, and from there, return the trip with the 
-    # minimum distance metric.
-    dts = filter(lambda dt: dt[1][1] <= oob_threshold, dts);
-    if len(dts) == 0:
+    if not matches:
+      print "@@@ NO CANDIDATE TRIPS FOUND @@@"
+      return None
+    # Score every candidate at once, then filter out trips that are 
+    # too far away from our time window, and from there, return the
+    # trip with the minimum distance metric.
+    dists,oob_fracs = self.measureDistancesFromGTFSTrips(matches,
+                                                         penalize_gps_oob=True,
+                                                         penalize_gtfs_oob=False)
+    candidates = np.flatnonzero(oob_fracs <= oob_threshold)
+    if len(candidates) == 0:
       print "@@@ NO MATCHES FOUND WITHIN TIME WINDOW @@@"
       return None
-    ret_index = dts.index(min(dts,key=lambda dt:dt[1][0]));
-    return dts[ret_index][0][0],dts[ret_index][0][1],dts[ret_index][1][0];
+    best = candidates[np.argmin(dists[candidates])]
+    return matches[best][0],matches[best][1],float(dists[best]);
 
 
   def measureDistanceFromGTFSTrip(self,trip_id,
@@ -422,86 +437,123 @@ class GPSBusTrack(BusTrack):
     then the distance returned from this route with a GTFS trip 
     with no overlap in time will be 0!
     """
-    schedule = GTFSBusSchedule(trip_id,offset=offset_seconds);
-    #'bounding boxes' of our time interval and of the GTFS trip's time interval
-    bbox = self.getRouteTimeInterval(); 
-    sched_bbox = schedule.getRouteTimeInterval();
-    oob_count = 0 #count of gtfs stop times that are out of bounds
-    vstops = 0 #number of virtual stops that we penalized for
+    dists,oob_fracs = self.measureDistancesFromGTFSTrips([(trip_id,
+                                                           offset_seconds)],
+                                                         penalize_gps_oob,
+                                                         penalize_gtfs_oob)
+    return float(dists[0]),float(oob_fracs[0])
 
-    ret = 0.0
-    
+
+  def measureDistancesFromGTFSTrips(self,trip_offsets,
+                                    penalize_gps_oob=True,
+                                    penalize_gtfs_oob=True):
+    """
+    Given a list of (trip_id,offset_seconds) pairs, returns
+
+    (distances, oob_fracs)
+
+    two arrays holding, for each pair, the values that 
+    measureDistanceFromGTFSTrip would return for it. The schedules
+    of all the trips are loaded with a single query and measured
+    against this track all at once.
+
+    Trips with no schedule data get a distance of infinity and an
+    oob_frac of 1.0.
+    """
+    stack = GTFSScheduleStack(trip_offsets)
+    num = len(stack)
+    counts = stack.counts
+    if counts.sum() == 0:
+      return np.repeat(np.inf,num),np.ones(num)
+    nonempty = counts > 0
+    first = np.where(nonempty,stack.starts,0)
+    last = np.where(nonempty,stack.starts+counts-1,0)
+
+    #'bounding boxes' of our time interval and of the GTFS trips' intervals
+    bbox = self.getRouteTimeInterval(); 
+    sched_begin,sched_end = stack.times[first],stack.times[last]
+    sqdist = np.zeros(num) #sum of squared distances for each trip
+    vstops = np.zeros(num,dtype=int) #number of virtual stops penalized for
 
     if penalize_gps_oob:
-      ## To penalize for being too far outside the GTFS window,
-      ## we need to calculate a number of "virtual stops" for which
-      ## we were outside of that window, based on the number of stops
-      ## the GTFS schedule makes in its time window.
-      ## For each of these virtual stops, we penalize the square of
-      ## the distance from our position at that time, to the closest-
-      ## in-time position of the GTFS trip.
-      
-      # We use the total number of stops in the GTFS schedule divided
-      # by the length in time of the schedule to approximate how many
-      # virtual stops we should penalize for.
-      stops_per_time = len(schedule.interpolation)/float(sched_bbox[1]
-                                                         -sched_bbox[0])
-      # If we start before the GTFS trip
-      if bbox[0] < sched_bbox[0]:
-        # oob_box is the out-of-bounds window
-        oob_box=( bbox[0] , min(sched_bbox[0],bbox[1]) )
-        # oob_time is the time spent out of bounds
-        oob_time = oob_box[1] - oob_box[0]
-        # loc1 is the starting location of the GTFS trip
-        loc1 = schedule.interpolation[0][:2];
-        # n is the number of 'virtual stops' we're penalizing for
-        n = int( stops_per_time * oob_time );
-        for i in range(n):
-          T_i = bbox[0] + i * float(oob_time)/n
-          loc2 = self.getLocationAtTime(T_i);
-          if not loc2: print "ERROR SOMETHING IS TERRIBLY WRONG"
-          ret += gis.distance_meters(loc2[:2],loc1)**2
-        vstops += n
-
-
-      # If we end after the GTFS trip
-      if bbox[1] > sched_bbox[1]:
-        # oob_box is the out-of-bounds window
-        oob_box=( max(sched_bbox[1],bbox[0]) , bbox[1] )
-        # oob_time is the time spent out of bounds
-        oob_time = oob_box[1] - oob_box[0]
-        # loc1 is the ending location of the GTFS trip
-        loc1 = schedule.interpolation[-1][:2]
-        # n is the number of 'virtual stops' to penalize for
-        n = int( stops_per_time * oob_time );
-        for i in range(n):
-          T_i = bbox[1] - i * float(oob_time)/n
-          loc2 = self.getLocationAtTime(T_i);
-          if not loc2: print "ERROR SOMETHING IS TERRIBLY WRONG 2"
-          ret += gis.distance_meters(loc2[:2],loc1)**2
-        vstops += n
-
-
-    ## Now check along the GTFS route
-    for i,pt in enumerate(schedule.interpolation):
-      stoptime = pt[2] #- offset_seconds
-      myloc = self.getLocationAtTime(stoptime);
-      if myloc is None: # then GTFS is out of bounds of GPS time window
-        oob_count += 1
-        if penalize_gtfs_oob: # so penalize for it, if we're supposed to
-          if stoptime < bbox[0]:
-            myloc = self.interpolation[0]
-          else:
-            myloc = self.interpolation[-1]
-      if myloc:
-        ret += gis.distance_meters( myloc[:2], pt[:2] )**2
-
-    ret = math.sqrt( ret/(len(schedule.interpolation)+vstops) )
-    print "  Matching id",trip_id,"start time:",
-    print schedule.interpolation[0][2], #-offset_seconds,
-    print "  distance: %9.2f OOB count: %2d/%2d"%(ret,oob_count,
-                                                  len(schedule.interpolation))
-    return ret,float(oob_count)/len(schedule.interpolation)
+      ## See measureDistanceFromGTFSTrip for the details of the
+      ## virtual stops penalized for here.
+      span = np.where(sched_end > sched_begin, sched_end-sched_begin, np.nan)
+      stops_per_time = counts / span
+
+      # Trips that start after we do
+      oob_time = np.minimum(sched_begin,bbox[1]) - bbox[0]
+      n = self._numVirtualStops(stops_per_time,oob_time,
+                                nonempty & (bbox[0] < sched_begin))
+      sqdist += self._virtualStopDistances(n,oob_time,bbox[0],1.0,
+                                           stack.lats[first],
+                                           stack.lons[first])
+      vstops += n
+
+      # Trips that end before we do
+      oob_time = bbox[1] - np.maximum(sched_end,bbox[0])
+      n = self._numVirtualStops(stops_per_time,oob_time,
+                                nonempty & (bbox[1] > sched_end))
+      sqdist += self._virtualStopDistances(n,oob_time,bbox[1],-1.0,
+                                           stack.lats[last],
+                                           stack.lons[last])
+      vstops += n
+
+    ## Now check along the GTFS routes
+    stoptimes = stack.times
+    mylats,mylons = self.getLocationsAtTimes(stoptimes);
+    oob = np.isnan(mylats) # then GTFS is out of bounds of GPS time window
+    oob_count = np.bincount(stack.schedule,weights=oob,minlength=num)
+    if penalize_gtfs_oob: # so penalize for it, if we're supposed to
+      early = oob & (stoptimes < bbox[0])
+      late = oob & ~early
+      mylats[early],mylons[early] = self.interpolation[0][:2]
+      mylats[late],mylons[late] = self.interpolation[-1][:2]
+    valid = ~np.isnan(mylats)
+    d = gisa.distance_meters(mylats[valid],mylons[valid],
+                             stack.lats[valid],stack.lons[valid])
+    sqdist += np.bincount(stack.schedule[valid],weights=d**2,minlength=num)
+
+    safe_counts = np.where(nonempty,counts,1)
+    dists = np.where(nonempty, np.sqrt(sqdist/(safe_counts+vstops)), np.inf)
+    oob_fracs = np.where(nonempty, oob_count/safe_counts, 1.0)
+
+    for i,(trip_id,offset) in enumerate(stack.trip_offsets):
+      if not nonempty[i]:
+        print "  Matching id",trip_id,"has no schedule data"
+        continue
+      print "  Matching id",trip_id,"start time:",
+      print sched_begin[i], #-offset_seconds,
+      print "  distance: %9.2f OOB count: %2d/%2d"%(dists[i],oob_count[i],
+                                                    counts[i])
+    return dists,oob_fracs
+
+
+  def _numVirtualStops(self,stops_per_time,oob_time,mask):
+    """
+    Returns the number of virtual stops to penalize for in each
+    out-of-bounds window of oob_time seconds, or 0 where mask is False.
+    """
+    n = np.where(mask, stops_per_time * oob_time, 0)
+    return np.trunc(np.where(np.isnan(n),0,n)).astype(int)
+
+
+  def _virtualStopDistances(self,n,oob_time,edge_time,direction,lats,lons):
+    """
+    For each trip i, fabricates n[i] evenly spaced times covering the
+    oob_time[i] seconds from edge_time in the given direction (1.0 or 
+    -1.0), and returns the sum of squared distances in meters between 
+    this track's location at those times and (lats[i],lons[i]).
+    """
+    trip = np.repeat(np.arange(len(n)),n)
+    if len(trip) == 0:
+      return np.zeros(len(n))
+    step = np.arange(len(trip)) - np.repeat(np.cumsum(n)-n,n)
+    T = edge_time + direction * (step * oob_time[trip] / n[trip])
+    mylats,mylons = self.getLocationsAtTimes(T);
+    if np.isnan(mylats).any(): print "ERROR SOMETHING IS TERRIBLY WRONG"
+    d = gisa.distance_meters(mylats,mylons,lats[trip],lons[trip])
+    return np.bincount(trip,weights=d**2,minlength=len(n))
 
  
 if __name__ == "__main__":
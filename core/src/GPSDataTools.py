@@ -29,6 +29,8 @@ individual trips.
 
 import dbqueries as db
 import datetime
+import calendar
+import numpy as np
 from time import time
 from sys import argv
 from kml_objects import *
@@ -46,10 +48,16 @@ def now():
   return str(int(time()))
 
 
+EPOCH = datetime.datetime(1970,1,1)
+
+
 class VehicleReport(object):
   """
   POD structure representing a single row in the GPS log.
   """
+  __slots__ = ('vehicle_id','lat','lon','route_tag','dirtag',
+               'reported_update_time')
+
   def __init__(self,id,lat,lon,routetag,dirtag,reported_update_time):
     self.vehicle_id = id
     self.lat = lat
@@ -81,19 +89,123 @@ vehicle %s on route %s, dirtag %s:  %s, %s, time %s
     h,m,s = t.hour,t.minute,t.second
     return s + 60*( m + 60*h )
 
+
+class ReportBatch(object):
+  """
+  Column storage for a sequence of VehicleReports, for when there are
+  too many of them to keep as objects. The columns are numpy arrays:
+
+    vehicles -- index into vehicle_ids of each report's vehicle
+    lats, lons -- float64 positions
+    times -- reported_update_time in whole seconds since 1970-01-01
+             (the times are naive, as in the database)
+    routes, dirtags -- index into tags of each report's route tag
+                       and dirtag
+
+  Indexing with an integer gives a VehicleReport, and with a slice
+  gives a ReportBatch. Iterating gives VehicleReports.
+  """
+  def __init__(self,vehicles,lats,lons,times,routes,dirtags,
+               vehicle_ids,tags):
+    self.vehicles = vehicles
+    self.lats = lats
+    self.lons = lons
+    self.times = times
+    self.routes = routes
+    self.dirtags = dirtags
+    self.vehicle_ids = vehicle_ids
+    self.tags = tags
+
+  @staticmethod
+  def fromReports(reports):
+    """
+    Builds a ReportBatch from an iterable of VehicleReports.
+    """
+    vehicle_ids,tags = [],[]
+    vehicle_codes,tag_codes = {},{}
+    def code(value,values,codes):
+      c = codes.get(value)
+      if c is None:
+        c = codes[value] = len(values)
+        values.append(value)
+      return c
+
+    vehicles,lats,lons,times,routes,dirtags = [],[],[],[],[],[]
+    for r in reports:
+      vehicles.append(code(r.vehicle_id,vehicle_ids,vehicle_codes))
+      lats.append(float(r.lat))
+      lons.append(float(r.lon))
+      times.append(calendar.timegm(r.reported_update_time.timetuple()))
+      routes.append(code(r.route_tag,tags,tag_codes))
+      dirtags.append(code(r.dirtag,tags,tag_codes))
+
+    return ReportBatch(np.array(vehicles,dtype=np.int32),
+                       np.array(lats,dtype=np.float64),
+                       np.array(lons,dtype=np.float64),
+                       np.array(times,dtype=np.int64),
+                       np.array(routes,dtype=np.int32),
+                       np.array(dirtags,dtype=np.int32),
+                       vehicle_ids,tags)
+
+  @staticmethod
+  def asBatch(reports):
+    """
+    Returns reports if it is already a ReportBatch, otherwise
+    builds one from it.
+    """
+    if isinstance(reports,ReportBatch):
+      return reports
+    return ReportBatch.fromReports(reports)
+
+  def __len__(self):
+    return len(self.times)
+
+  def __getitem__(self,idx):
+    if isinstance(idx,slice):
+      return ReportBatch(self.vehicles[idx],self.lats[idx],self.lons[idx],
+                         self.times[idx],self.routes[idx],self.dirtags[idx],
+                         self.vehicle_ids,self.tags)
+    return VehicleReport(self.vehicle_ids[self.vehicles[idx]],
+                         float(self.lats[idx]),float(self.lons[idx]),
+                         self.tags[self.routes[idx]],
+                         self.tags[self.dirtags[idx]],
+                         self.datetime(idx))
+
+  def __iter__(self):
+    for i in xrange(len(self)):
+      yield self[i]
+
+  def datetime(self,idx):
+    return EPOCH + datetime.timedelta(seconds=int(self.times[idx]))
+
+  def datetimes(self):
+    return [EPOCH + datetime.timedelta(seconds=t)
+            for t in self.times.tolist()]
+
+  def timesInSecondsIntoDay(self):
+    """
+    Returns an array of VehicleReport.timeInSecondsIntoDay() values.
+    """
+    return self.times % 86400
+
+
 class VehicleSegment(object):
   """
   A list of VehicleReports, representing a single trip made by
-  a vehicle.
+  a vehicle. The reports are kept as a ReportBatch.
   """
   def __init__(self,reports):
-    self.reports = reports
-    self.dirtag = reports[-1].dirtag
-    self.routetag = reports[-1].route_tag
-    self.lations = [[r.lat,r.lon] for r in reports]
+    self.reports = ReportBatch.asBatch(reports)
+    last = self.reports[-1]
+    self.dirtag = last.dirtag
+    self.routetag = last.route_tag
     self.shape = None
     self.valid = True
 
+  @property
+  def lations(self):
+    return np.column_stack((self.reports.lats,self.reports.lons))
+
   def getGTFSRouteInfo(self):
     """
     Returns (routeID,directionID) for this trip.
@@ -125,7 +237,8 @@ class VehicleSegment(object):
     else:
       trip_id,offset,error = tinfo
     trip_date = self.reports[0].reported_update_time
-    rows=[(r.lat,r.lon,r.reported_update_time) for r in self.reports]
+    rows=zip(self.reports.lats.tolist(),self.reports.lons.tolist(),
+             self.reports.datetimes())
     veh_id = self.reports[0].vehicle_id;
     segID = db.export_gps_route(trip_id, trip_date, veh_id, error, offset, rows);
     return segID, tinfo
@@ -137,14 +250,20 @@ class TrackedVehicleSegment(object):
   already been identified with a GTFS trip ID and all the associated
   information.
   """
-  def __init__(self,segment_id,useCorrectedGTFS=True):
+  def __init__(self,segment_id,useCorrectedGTFS=True,route_data=None):
+    """
+    Loads segment_id from the database, unless its route_data (as
+    returned by dbqueries.load_gps_route) is given.
+    """
+    if route_data is None:
+      route_data = db.load_gps_route(segment_id);
     self.segment_id = segment_id;
     self.trip_id, self.trip_date, self.vehicle_id, self.schedule_error, \
-        self.offset, self.route = db.load_gps_route(segment_id);
+        self.offset, self.route = route_data;
 
-    self.reports = map(lambda llr: VehicleReport(self.vehicle_id,llr[0],llr[1],
-                                                 None,None,llr[2]),
-                       self.route);
+    self.reports = ReportBatch.fromReports(
+      VehicleReport(self.vehicle_id,llr[0],llr[1],None,None,llr[2])
+      for llr in self.route);
 
     if self.trip_id is not None:
       if useCorrectedGTFS:
@@ -185,7 +304,6 @@ class Vehicle(object):
   """  
   def __init__(self,vehicle_id):
     self.vehicle_id = vehicle_id;
-    self.reports = []
     self.segments = []
 
 class GShape(object):
@@ -194,17 +312,57 @@ class GShape(object):
     self.points=[]
     self.dirtag = ''
 
+
+def split_reports(reports):
+  """
+  Given an iterable of VehicleReports ordered by vehicle and then by
+  time, yields lists of consecutive reports from the same vehicle on
+  the same dirtag with no more than THRESH_TIME_BETWEEN_REPORTS seconds
+  between reports. Each list is yielded as soon as the report which
+  ends it is read. The last list of reports for each vehicle is never
+  yielded, since the vehicle may not be done with it.
+  """
+  last_report = None
+  run = []
+  for report in reports:
+    if last_report is None or report.vehicle_id != last_report.vehicle_id:
+      run = []
+    else:
+      report_delay = report.reported_update_time - last_report.reported_update_time
+      report_delay_seconds = 86400*report_delay.days + report_delay.seconds
+      if report.dirtag != last_report.dirtag \
+            or report_delay_seconds > THRESH_TIME_BETWEEN_REPORTS:
+        yield run
+        run = []
+    run.append(report)
+    last_report = report
+
+
 class Route(object):
   """
   Represents the set of vehicle trips belonging to a particular route.
   Upon initialization, all VehicleReports are found for that route,
   and subsequently segmented into appropriate VehicleSegments.
+
+  If stream is True, nothing is loaded up front; instead
+  stream_segments() reads the reports and yields the segments one at
+  a time, so that only one segment per vehicle need be in memory.
+
+  If since is given, only reports from since onwards are loaded, and
+  segments which start with a report that has already been exported
+  are marked invalid, so that reloading an overlapping period doesn't
+  export the same segment twice.
   """
-  def __init__(self,route_short_name,tzdiff=0):
+  def __init__(self,route_short_name,tzdiff=0,since=None,stream=False):
     self.route_short_name = str(route_short_name)
+    self.tzdiff = tzdiff
+    self.since = since
+    self.stream = stream
+    self.last_report_time = None
     self.dirtags=[]
     self.shapes = {}
     self._vehicles = {}
+    self._exported = None
     
     print "Loading Dirtags..."
     self.load_route_dirtags()
@@ -214,42 +372,31 @@ class Route(object):
     print "Loading Shapes..."
     self.load_shapes()
     print "\tLoaded %s shapes: %s" % (len(self.shapes),', '.join([ shape_id for shape_id,shape in self.shapes.items()]))
-    
-    
-    
-    self.load_vehicle_reports(tzdiff)
-    print "\tFound %s vehicles" % len(self._vehicles)
-    
-    print "Finding route segments..."
-    self.find_segments()
-    
-    
-    if self.shapes:
-      self.filter_by_endpoint()
-    else:
+
+    if not self.shapes:
       print "No shapes found, skipping shape check"
-       
-    self.filter_by_report_time()
+    
+    if not stream:
+      self.load_segments()
 
     
   def load_route_dirtags(self):
     self.dirtags.extend(db.get_route_dirtags(self.route_short_name));
       
 
-  def load_vehicle_reports(self,tzdiff):
-    print "Loading vehicle reports..."
-    rows = db.get_vehicle_reports(self.dirtags,tzdiff);
-    print "\tDB fetch complete (%d rows).  Sorting into objects.." % (len(rows),)
-
-    def helper(row):
-      vehicle_id = row['id']
-      vehicle = self._vehicles.get(vehicle_id);
-      if vehicle is None:
-        vehicle = Vehicle(vehicle_id);
-        self._vehicles[vehicle_id] = vehicle;
-      vehicle.reports.append(VehicleReport(*row))
-
-    map( helper, rows );
+  def vehicle_reports(self):
+    """
+    Yields the VehicleReports for this route, ordered by vehicle and
+    then by time, as they are read from the database.
+    """
+    for row in db.iter_vehicle_reports(self.dirtags,self.tzdiff,self.since):
+      report = VehicleReport(*row)
+      # record the newest report time as it is in the db
+      report_time = report.reported_update_time \
+          - datetime.timedelta(hours=self.tzdiff)
+      if self.last_report_time is None or report_time > self.last_report_time:
+        self.last_report_time = report_time
+      yield report
 
     
   def load_shapes(self):  
@@ -266,81 +413,117 @@ class Route(object):
       gshape.points.append([row['shape_pt_lat'],row['shape_pt_lon']])
 
 
-  def find_segments(self):
-    dropped = 0
-    for vehicle in self.vehicles():
-      #print "\tSegmenting Vehicle %s..." % vehicle.vehicle_id
-
-      last_report = vehicle.reports[0]
-      reports=[last_report]
-
-      for report in vehicle.reports[1:]:
-        report_delay = report.reported_update_time - last_report.reported_update_time
-        report_delay_seconds = 86400*report_delay.days + report_delay.seconds
-        if report.dirtag != last_report.dirtag \
-              or report_delay_seconds > THRESH_TIME_BETWEEN_REPORTS:
-          if len(reports) > THRESH_MINIMUM_REPORTS:
-            seg = VehicleSegment(reports);
-            seg.shape = self.shape_for_dirtag(seg.dirtag)
-            vehicle.segments.append(seg);
-          else:
-            dropped += 1
-          reports=[]
-        reports.append(report)
-        last_report = report
-      #print "\t\t%s segments found" % len(vehicle.segments)
-    print "\tFound %d segments" % len([s for s in self.segments()])
-    print "\tDropped %d segments for being too short" % (dropped,)
-    print "\tRemoving vehicles that have no segments..." 
-    c=0
-    for vehicle in self.vehicles():
-      if not vehicle.segments:
-        c+=1
-        del self._vehicles[vehicle.vehicle_id]
-    print "\tRemoved %d vehicles"%c
+  def filters(self):
+    """
+    Returns the list of checks, in order, that a segment must pass.
+    Each takes a segment and marks it invalid if it fails.
+    """
+    ret = []
+    if self.shapes:
+      ret.append(self.check_endpoint)
+    ret.append(self.check_report_time)
+    if self.since is not None:
+      ret.append(self.check_exported)
+    return ret
 
-  def filter_by_endpoint(self):
-    print "Filtering segments by comparing segment endpoints to possible gtf_shape(s)..."
-    c=0
-    for seg in self.segments(return_valid_only=True):
-      seg_start_lation = seg.lations[0]
-      seg_end_lation = seg.lations[-1]
 
-      s = seg.shape #self.shape_for_dirtag(seg.dirtag)
-      if s is None:
+  def stream_segments(self,valid_only=True):
+    """
+    Reads the reports for this route and yields its VehicleSegments
+    as soon as they are complete, each one run through filters().
+    If valid_only, segments which fail a filter are not yielded.
+    """
+    filters = self.filters()
+    found = dropped = 0
+    invalid = dict((f.__name__,0) for f in filters)
+
+    for reports in split_reports(self.vehicle_reports()):
+      if len(reports) <= THRESH_MINIMUM_REPORTS:
+        dropped += 1
         continue
+      found += 1
+      seg = VehicleSegment(reports);
+      seg.shape = self.shape_for_dirtag(seg.dirtag)
+      for f in filters:
+        f(seg)
+        if not seg.valid:
+          invalid[f.__name__] += 1
+          break
+      if seg.valid or not valid_only:
+        yield seg
+
+    print "\tFound %d segments" % (found,)
+    print "\tDropped %d segments for being too short" % (dropped,)
+    for f in filters:
+      print "\t%s marked invalid by %s" % (invalid[f.__name__],f.__name__)
 
-      shape_start_lation = s.points[0]#.lation
-      shape_end_lation = s.points[-1]#.lation
 
-      start_point_distance = calcDistance(shape_start_lation,seg_start_lation)
-      end_point_distance = calcDistance(shape_end_lation,seg_end_lation)
+  def load_segments(self):
+    print "Loading vehicle reports and finding route segments..."
+    for seg in self.stream_segments(valid_only=False):
+      vehicle_id = seg.reports[0].vehicle_id
+      vehicle = self._vehicles.get(vehicle_id);
+      if vehicle is None:
+        vehicle = Vehicle(vehicle_id);
+        self._vehicles[vehicle_id] = vehicle;
+      vehicle.segments.append(seg)
+    print "\tFound %s vehicles with segments" % len(self._vehicles)
 
-      if start_point_distance > THRESH_SEG_ENDPOINT_TO_SHAPE_ENDPOINT:
-        seg.valid = False
-        c+=1
-      else:
-        seg.valid = True
-    print "\t%s marked as invalid" % c
+
+  def check_endpoint(self,seg):
+    s = seg.shape #self.shape_for_dirtag(seg.dirtag)
+    if s is None:
+      return
+
+    seg_start_lation = seg.lations[0]
+    shape_start_lation = s.points[0]#.lation
+
+    start_point_distance = calcDistance(shape_start_lation,seg_start_lation)
+
+    if start_point_distance > THRESH_SEG_ENDPOINT_TO_SHAPE_ENDPOINT:
+      seg.valid = False
+    else:
+      seg.valid = True
+
+  def check_report_time(self,seg):
+    reports = seg.reports
+    # as timedelta.seconds, ignoring whole days
+    delays = np.diff(reports.times) % 86400
+    for i in np.flatnonzero(delays > THRESH_TIME_BETWEEN_REPORTS):
+      seg.valid = False
+      dist = calcDistance( (reports.lats[i],reports.lons[i]),
+                           (reports.lats[i+1],reports.lons[i+1]) )
+      print "Distance:",dist
+    if not seg.valid:
+      print "Invalid, max delay:",delays.max()
+
+  def check_exported(self,seg):
+    if self._exported is None:
+      self._exported = db.get_exported_report_times(self.dirtags,self.since,
+                                                    self.tzdiff)
+    first = seg.reports[0]
+    if (first.vehicle_id,first.reported_update_time) in self._exported:
+      seg.valid = False
+
+  def filter_by_endpoint(self):
+    print "Filtering segments by comparing segment endpoints to possible gtf_shape(s)..."
+    self._apply_filter(self.check_endpoint)
 
   def filter_by_report_time(self):
     print "Filtering by comparing times between reports..."
+    self._apply_filter(self.check_report_time)
+
+  def filter_exported(self):
+    print "Filtering segments which have already been exported..."
+    self._apply_filter(self.check_exported)
+
+  def _apply_filter(self,check):
     c=0
     for seg in self.segments(return_valid_only=True):
-      last = seg.reports[0]
-      avg=[]
-      for r in seg.reports[1:]:
-        t=int((r.reported_update_time - last.reported_update_time).seconds)
-        avg.append(t)
-        if t > THRESH_TIME_BETWEEN_REPORTS:
-          seg.valid = False
-          dist = calcDistance( (last.lat,last.lon) , (r.lat,r.lon) )
-          print "Distance:",dist
-        last = r
+      check(seg)
       if not seg.valid:
         c+=1
-        print "Invalid, max delay:",max(avg)
-    print "\t%s marked invalid" % c   
+    print "\t%s marked invalid" % c
                
   def segments(self,return_valid_only=False):
     sorted_vehicles = self._vehicles.items()
@@ -368,6 +551,15 @@ class Route(object):
       seg.valid = True
 
   def export_segments(self,valid_only=True):
+    """
+    Exports the segments of this route. A streaming Route reads,
+    checks and exports its segments one at a time.
+    """
+    if self.stream:
+      for i,seg in enumerate(self.stream_segments(valid_only)):
+        print "Exporting segment %d..."%(i+1,)
+        seg.export_segment();
+      return
     segs = list(self.segments(valid_only));
     for i,seg in enumerate(segs):
       print "Exporting (%d/%d)..."%(i+1,len(segs))
@@ -376,7 +568,6 @@ class Route(object):
         
 
 
-
 def calcDistance(lation1,lation2):                      
     """
     Caclulate distance between two lat lons in meters
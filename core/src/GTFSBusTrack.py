@@ -10,6 +10,9 @@ GTFSBusTrack -- A BusTrack (also representing a scheduled trip) that applies
 more involved processing and heuristics to the data provided by the GTFS 
 schedule, including shape data.
 
+GTFSScheduleStack -- The GTFSBusSchedule interpolations of several trips,
+stacked into shared arrays so that they can be measured all at once.
+
 
 """
 
@@ -33,9 +36,30 @@ schedule, including shape data.
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import dbqueries as db
+import gtfscache
 import gisutils as gis
-from BusTrack import BusTrack
+import numpy as np
+from BusTrack import BusTrack, TrackInterpolation
+
+
+def schedule_points(stops,offset=0):
+  """
+  Given a list of GTFS stop rows (as returned by dbqueries.getGTFSTripData)
+  and an offset in seconds, returns the face-value interpolation of that
+  schedule as a list of (lat,lon,time) tuples, with 'offset' seconds
+  subtracted from each time.
+  """
+  points = []
+  for stop in stops:
+    points.append( (stop['stop_lat'],
+                    stop['stop_lon'],
+                    stop['arrival_time_seconds']-offset));
+    # If the bus sits there for a while, then add a point
+    if stop['arrival_time_seconds'] != stop['departure_time_seconds']:
+      points.append( (stop['stop_lat'],
+                      stop['stop_lon'],
+                      stop['departure_time_seconds']-offset));
+  return points
 
 
 
@@ -63,11 +87,11 @@ class GTFSBusSchedule(BusTrack):
   def __hash__(self):
     return hash(self.trip_id) * 7 - self.offset;
 
-  ## Loads data about this trip from the database
+  ## Loads data about this trip from the (cached) database
   def __load(self):
-    (trip_data,self.stops,self.shape) = db.getGTFSTripData(self.trip_id);
+    (trip_data,self.stops,self.shape) = gtfscache.get_trip_data(self.trip_id);
     self.set_attributes(trip_data);
-    route_data = db.getGTFSRouteData(self.route_id);
+    route_data = gtfscache.get_route_data(self.route_id);
     self.set_attributes(route_data);
 
   def _loadInterpolation(self):
@@ -76,17 +100,48 @@ class GTFSBusSchedule(BusTrack):
     try to extract any more information out of it, nor apply
     any heuristics to it.
     """
-    interpolation = []
-    for stop in self.stops:
-      interpolation.append( (stop['stop_lat'],
-                             stop['stop_lon'],
-                             stop['arrival_time_seconds']-self.offset));
-      # If the bus sits there for a while, then add a point
-      if stop['arrival_time_seconds'] != stop['departure_time_seconds']:
-        interpolation.append( (stop['stop_lat'],
-                               stop['stop_lon'],
-                               stop['departure_time_seconds']-self.offset));
-    return interpolation
+    return gtfscache.get_interpolation(
+      self.trip_id, self.offset, None,
+      lambda: TrackInterpolation.fromPoints(schedule_points(self.stops,
+                                                            self.offset)) )
+
+
+
+class GTFSScheduleStack(object):
+  """
+  The interpolations that GTFSBusSchedule would build for a list of
+  (trip_id,offset) pairs, concatenated into shared lats, lons and times
+  columns. The points of the i'th schedule are those whose entry in
+  'schedule' equals i; they run from starts[i] for counts[i] points.
+
+  The interpolations come from (and are added to) the GTFS cache; all
+  of the trips missing from it are fetched together.
+  """
+
+  def __init__(self,trip_offsets):
+    self.trip_offsets = list(trip_offsets)
+    trips = gtfscache.get_trips_data(
+      [tid for tid,off in self.trip_offsets
+       if not gtfscache.has_interpolation(tid,off,None)] );
+
+    def builder(trip_id,offset):
+      stops = trips.get(str(trip_id),(None,[],[]))[1]
+      return lambda: TrackInterpolation.fromPoints(schedule_points(stops,
+                                                                   offset))
+
+    interps = [gtfscache.get_interpolation(trip_id, offset, None,
+                                           builder(trip_id,offset))
+               for trip_id,offset in self.trip_offsets]
+    self.lats = np.concatenate([[]] + [i.lats for i in interps])
+    self.lons = np.concatenate([[]] + [i.lons for i in interps])
+    self.times = np.concatenate([[]] + [i.times for i in interps])
+    self.counts = np.array([len(i) for i in interps],dtype=int)
+    self.starts = np.cumsum(self.counts) - self.counts
+    self.schedule = np.repeat(np.arange(len(self.counts)),self.counts)
+
+  def __len__(self):
+    return len(self.trip_offsets)
+
 
 
 
@@ -115,26 +170,30 @@ class GTFSBusTrack(GTFSBusSchedule):
     ## index i >= begin_idx that is within tol meters
     ## of the stop's location.
 
-    last_pt = self.shape[begin_idx]
-    min_dist,min_pt = 1e10,None
-    for i,pt in enumerate(self.shape[begin_idx+1:]):
-      dist = gis.distance_from_segment_meters( (last_pt['shape_pt_lat'],
-                                                last_pt['shape_pt_lon']),
-                                               (pt['shape_pt_lat'],
-                                                pt['shape_pt_lon']),
-                                               (stop['stop_lat'],
-                                                stop['stop_lon']) );
-      if dist <= tol:
-        return i+begin_idx; #really it's i+begin_idx+1 - 1
-      if dist < min_dist:
-        min_dist,min_pt = dist,pt
-      last_pt = pt
+    shape_index = gtfscache.get_shape_index(self.shape_id,self.shape)
+    i,min_dist = shape_index.find_segment(stop['stop_lat'],stop['stop_lon'],
+                                          begin_idx,tol)
+    if i is not None:
+      return i
     print "Returning none (DOH!)"
     print "  Min dist was %f meters" % (min_dist,)
     return None
 
 
   def _loadInterpolation(self):
+    """
+    Returns the (cached) interpolation built by _buildInterpolation.
+    """
+    def build():
+      interp = self._buildInterpolation()
+      if interp is not None:
+        interp = TrackInterpolation.fromPoints(interp)
+      return interp
+    return gtfscache.get_interpolation(self.trip_id, self.offset,
+                                       self.use_shape, build)
+
+
+  def _buildInterpolation(self):
     ## The idea here is to put all the space/time information
     ## we have about this route into order so that we can make
     ## as good an interpolation as possible.
@@ -220,22 +279,24 @@ class GTFSBusTrack(GTFSBusSchedule):
     ##       places but at the same time.
     
     ## 1. Eliminate redundancies
-    last_point = interpolation[0]
+    ## (into a new list, rather than removing from this one as we go)
+    kept = interpolation[:1]
     for point in interpolation[1:]:
+      last_point = kept[-1]
       if point[0] == last_point[0] and point[1] == last_point[1]:
         if not (point[2] or last_point[2]):
           print "Duplicate Shape Points????"
         elif not point[2]:
-          interpolation.remove(point);
-          continue; # don't want to set last_point to the removed one
+          continue; # drop it, and compare the next one to last_point
         elif not last_point[2]:
-          interpolation.remove(last_point);
+          kept.pop();
         elif point[2] == last_point[2]:
           print "Duplicate Time Points????"
-          interpolation.remove(last_point);
+          kept.pop();
         else:  # point[2] != last_point[2]:
           pass # leave them both in
-      last_point = point
+      kept.append(point)
+    interpolation = kept
 
     ## 2. Interpolate times for shape points (if we used them)
     if self.use_shape:
@@ -37,24 +37,49 @@ we will make fair use of it here.
 
 
 import dbqueries as db
+import dbutils
 import gisutils as gis
 import GPSBusTrack as gps
 import GPSDataTools as gpstool
 import GTFSBusTrack as gtfs
+import gtfscache
+import bisect
+import datetime
+import multiprocessing
+import time
+import traceback
 
 
+# Number of GPS segments loaded from the database at a time
+SEGMENT_BATCH_SIZE = 500
+
+def segment_batches(seg_ids,batch_size=SEGMENT_BATCH_SIZE):
+  """
+  Splits the list seg_ids into lists of at most batch_size.
+  """
+  for i in xrange(0,len(seg_ids),batch_size):
+    yield seg_ids[i:i+batch_size]
+
 
 
 ### EARLYBIRDS ###
 
 def fix_all_earlybirds():
   segs = db.get_segment_IDs();
-  for i,seg_id in enumerate(segs):
-    correct_earlybird(seg_id);
-    print "%6.2f%%" % (100*i/float(len(segs)),)
-
-
-def correct_earlybird( segment_id, early_tolerance=300, late_tolerance=0 ):
+  i = 0
+  for batch in segment_batches(segs):
+    headers = db.load_gps_segment_headers(batch);
+    schedules = db.load_gps_schedules(batch);
+    for seg_id in batch:
+      sched = gps.GPSSchedule(seg_id, schedules.get(seg_id,[]),
+                              headers[seg_id]);
+      correct_earlybird(seg_id, sched=sched);
+      print "%6.2f%%" % (100*i/float(len(segs)),)
+      i += 1
+
+
+def correct_earlybird( segment_id, early_tolerance=300, late_tolerance=0,
+                       sched=None ):
   """
   Checks to see if the arrival schedule for segment_id is consistently
   early as specified by early_tolerance, and if so, assigns it to the 
@@ -67,17 +92,25 @@ def correct_earlybird( segment_id, early_tolerance=300, late_tolerance=0 ):
   after reassignment; if the mean lateness is greater than this amount,
   then the reassignment is not made. Can be None to specify we don't care
   how late we are after reassignment.
+
+  sched is segment_id's GPSSchedule, if it is already loaded.
   """
 
-  sched = gps.GPSSchedule(segment_id);
+  if sched is None:
+    sched = gps.GPSSchedule(segment_id);
   earliness,lateness = sched.getEarlyAndLateMeans();
   if earliness > early_tolerance and lateness <= late_tolerance:
     prev_trips = db.get_previous_trip_ID(sched.trip_id,sched.trip_date,
                                          sched.schedule_offset,
                                          numtrips=20);
+    # every candidate is tried against the same GPS points
+    route_data = db.load_gps_route(segment_id);
       
     for prev_trip_id,new_offset in prev_trips:
-      bus_new = gps.GPSBusSchedule(segment_id,prev_trip_id,new_offset);
+      segment = gpstool.TrackedVehicleSegment(segment_id,
+                                              useCorrectedGTFS=False,
+                                              route_data=route_data);
+      bus_new = gps.GPSBusSchedule(segment,prev_trip_id,new_offset);
       bt = bus_new.getGPSBusTrack();
       new_early,new_late = sched.getEarlyAndLateMeans(bus_new.getGPSSchedule());
       print "  ",new_early,new_late
@@ -123,42 +156,239 @@ def correct_earlybird( segment_id, early_tolerance=300, late_tolerance=0 ):
 
 ### GPS<->GTFS MATCHUPS ###
 
-def load_and_cache_routes(routes = ['18'],tzdiff=0):
+# How far before a route's watermark incremental matching starts loading
+# reports, so that segments still open at the last run get completed.
+# Should be longer than any single trip.
+MATCH_OVERLAP = datetime.timedelta(hours=4)
+
+def load_and_cache_routes(routes = ['18'],tzdiff=0,workers=1,
+                          incremental=False):
+  if workers > 1:
+    load_and_cache_routes_parallel(routes,tzdiff,workers,incremental);
+    return
   for route in routes:
     print "Caching route",route,"..."
-    load_and_cache_route(route,tzdiff);
+    load_and_cache_route(route,tzdiff,incremental);
     print "... done caching route."
 
-def load_and_cache_route( route_name, tzdiff=0 ):
+def load_and_cache_route( route_name, tzdiff=0, incremental=False ):
   """
   Given a route_short_name, loads all data available for that route 
   from GPS data, matches to GTFS schedule, and exports all valid trips found.
-  """
 
-  # Load the data
-  rte = gpstool.Route( route_name, tzdiff=tzdiff );
-  
-  # Export valid segments
+  If incremental is True, only the GPS data newer than the route's
+  watermark (less MATCH_OVERLAP) is loaded, and segments that were
+  exported by an earlier run are skipped. Either way the watermark is
+  advanced to the newest report loaded.
+  """
+  since = None
+  if incremental:
+    watermark = db.get_match_watermark(route_name);
+    if watermark is not None:
+      since = watermark - MATCH_OVERLAP
+
+  # Load the data and export valid segments as they are found
+  rte = gpstool.Route( route_name, tzdiff=tzdiff, since=since, stream=True );
   rte.export_segments(True);
-    
+
+  if rte.last_report_time is not None:
+    db.set_match_watermark(route_name,rte.last_report_time);
+
+
+def order_routes_by_size(routes,incremental=False):
+  """
+  Returns routes sorted so that those with the most GPS reports (to
+  be matched, if incremental) come first.
+  """
+  sizes = db.get_route_sizes(since_watermark=incremental);
+  return sorted(routes, key=lambda r: sizes.get(r,0), reverse=True)
+
+
+def _init_route_worker():
+  dbutils.reconnect_after_fork();
+
+
+def _cache_route_task(args):
+  route,tzdiff,incremental = args
+  try:
+    load_and_cache_route(route,tzdiff,incremental);
+    db.commit();
+  except Exception:
+    traceback.print_exc();
+    dbutils.rollback();
+    return route,False
+  return route,True
+
+
+def load_and_cache_routes_parallel(routes,tzdiff,workers,incremental=False):
+  """
+  Like load_and_cache_routes, but spreads the routes over a pool of
+  worker processes, each with its own database connection. Every route
+  is committed as soon as it is done. Routes are handed out largest
+  first, so that a big route started last doesn't hold up the end of
+  the run.
+  """
+  routes = order_routes_by_size(routes,incremental);
+  # built once here, the workers inherit it
+  gtfscache.get_trip_index();
+  # the workers can't see anything the parent hasn't committed
+  db.commit();
+  tasks = [(route,tzdiff,incremental) for route in routes]
+  failed = []
+
+  pool = multiprocessing.Pool(workers,_init_route_worker);
+  try:
+    results = pool.imap_unordered(_cache_route_task,tasks,chunksize=1);
+    for i,(route,ok) in enumerate(results):
+      if not ok:
+        failed.append(route)
+      print "Route %s %s (%d/%d)." % (route, ok and "done" or "FAILED",
+                                      i+1, len(tasks))
+    pool.close();
+  except:
+    pool.terminate();
+    raise
+  finally:
+    pool.join();
+
+  if failed:
+    raise Exception, "Failed to cache routes: %s" % (", ".join(failed),)
 
 
 
 ### GPS SCHEDULES ###
 
-def create_all_actual_timetables():
-  for seg_id in db.get_segment_IDs(True):
-    create_actual_timetable(seg_id)
+# Number of GPS segments committed at a time by create_all_actual_timetables
+SCHEDULE_CHUNK_SIZE = 2000
+
+def create_all_actual_timetables(incremental=False,workers=1):
+  """
+  Creates actual timetables for all matched segments, or if incremental
+  is True, only for those which don't have one yet.
+
+  The segments are done in chunks, each committed (and recorded in
+  gps_schedule_progress) as soon as it is done, by a pool of workers
+  worker processes. If the run is interrupted, running it again the
+  same way skips every segment within a chunk which was finished, even
+  if the segments have changed since and are chunked differently; once
+  every chunk is done the progress is cleared. Progress left by an
+  interrupted run of the other kind is thrown away.
+  """
+  if db.clear_schedule_progress(incremental):
+    print "Discarding the progress of an interrupted %s run." % \
+        (incremental and "full" or "incremental",)
+    db.commit();
+  seg_ids = db.get_segment_IDs(True,unexported_only=incremental)
+  finished = finished_segment_ranges(
+    db.get_finished_schedule_chunks(incremental))
+  todo = [s for s in seg_ids if not in_segment_ranges(finished,s)]
+  if len(todo) < len(seg_ids):
+    print "Skipping %d segments finished by an earlier run." % \
+        (len(seg_ids)-len(todo),)
+  tasks = list(segment_batches(todo,SCHEDULE_CHUNK_SIZE))
+
+  failed = []
+  start = time.time()
+  total = sum(map(len,tasks))
+  processed = 0
+  for i,(chunk,ok) in enumerate(_run_schedule_chunks(tasks,incremental,
+                                                     workers)):
+    if ok:
+      processed += len(chunk)
+    else:
+      failed.append((chunk[0],chunk[-1]))
+    elapsed = time.time() - start
+    rate = processed / max(elapsed,1e-6)
+    if rate > 0:
+      eta = "%d:%02d" % divmod(int((total-processed)/rate/60), 60)
+    else:
+      eta = "?"
+    print "Chunk %d-%d %s (%d/%d): %.1f segments/s, ETA %s h:mm" % \
+        (chunk[0], chunk[-1], ok and "done" or "FAILED", i+1, len(tasks),
+         rate, eta)
+
+  if failed:
+    raise Exception, "Failed to create timetables for segments %s" \
+        % (", ".join(["%d-%d" % f for f in failed]),)
+  db.clear_schedule_progress();
+  db.commit();
 
 
-def create_actual_timetable( segment_id ):
+def finished_segment_ranges(chunks):
+  """
+  Given (first_segment_id, last_segment_id) chunks sorted by first ID,
+  returns (firsts, lasts) lists of the disjoint ranges they cover.
+  (Chunks from different runs may overlap.)
+  """
+  firsts,lasts = [],[]
+  for first,last in chunks:
+    if lasts and first <= lasts[-1]:
+      lasts[-1] = max(lasts[-1],last)
+    else:
+      firsts.append(first)
+      lasts.append(last)
+  return firsts,lasts
+
+
+def in_segment_ranges(ranges,seg_id):
+  firsts,lasts = ranges
+  i = bisect.bisect_right(firsts,seg_id) - 1
+  return i >= 0 and seg_id <= lasts[i]
+
+
+def _run_schedule_chunks(tasks,incremental,workers):
+  """
+  Yields (chunk,ok) as each chunk of segment IDs is done, in this
+  process or in a pool of workers.
+  """
+  tasks = [(chunk,incremental) for chunk in tasks]
+  if workers <= 1:
+    for task in tasks:
+      yield _schedule_chunk_task(task)
+    return
+
+  # the workers can't see anything the parent hasn't committed
+  db.commit();
+  pool = multiprocessing.Pool(workers,_init_route_worker);
+  try:
+    for result in pool.imap_unordered(_schedule_chunk_task,tasks,chunksize=1):
+      yield result
+    pool.close();
+  except:
+    pool.terminate();
+    raise
+  finally:
+    pool.join();
+
+
+def _schedule_chunk_task(args):
+  chunk,incremental = args
+  try:
+    for batch in segment_batches(chunk):
+      routes = db.load_gps_routes(batch);
+      for seg_id in batch:
+        create_actual_timetable(seg_id, routes[seg_id])
+    db.finish_schedule_chunk(chunk[0],chunk[-1],len(chunk),incremental);
+    db.commit();
+  except Exception:
+    traceback.print_exc();
+    dbutils.rollback();
+    return chunk,False
+  return chunk,True
+
+
+def create_actual_timetable( segment_id, route_data=None ):
   """
   Given a segment id from the cached trips data, finds actual arrival
   times at each of the GTFS scheduled stops and stores in the database.
+  route_data is the segment's data as from dbqueries.load_gps_route,
+  if it is already loaded.
   """
   # Load the data
   print "Loading segment",segment_id,"..."
-  bus = gps.GPSBusSchedule(segment_id);
+  bus = gps.GPSBusSchedule(
+    gpstool.TrackedVehicleSegment(segment_id, useCorrectedGTFS=False,
+                                  route_data=route_data));
   print "ok"
   
   # Export the data
@@ -181,7 +411,7 @@ def populate_trip_information(trip_id):
   Given a GTFS trip ID, populates information about that trip into the database.
   """
 
-  trip_info,stops,shape = db.getGTFSTripData(trip_id);
+  trip_info,stops,shape = gtfscache.get_trip_data(trip_id);
   arrive_times = map(lambda s:s['arrival_time_seconds'],stops);
   depart_times = map(lambda s:s['departure_time_seconds'],stops);
   if len(arrive_times) == 0:
@@ -257,6 +487,17 @@ def auto_populate_rid_dirtags():
 
 if __name__=="__main__":
   from os import sys
+  workers = 1
+  if '--workers' in sys.argv:
+    i = sys.argv.index('--workers')
+    try:
+      workers = int(sys.argv[i+1])
+    except:
+      raise Exception, "--workers requires a number of processes"
+    del sys.argv[i:i+2]
+  incremental = '--incremental' in sys.argv
+  if incremental:
+    sys.argv.remove('--incremental')
   if len(sys.argv) <= 1:
     print "Usage: %s cmd" %(sys.argv[0],)
     print " where cmd (and its effect) is one of the following:"
@@ -265,7 +506,13 @@ if __name__=="__main__":
                match_trips [timezonediff] -- match gtfs<-> gps trips
                  timezonediff is the hours to add to the time recorded in the DB
                  in order to match up with the times listed in the GTFS data.
+                 With --workers N, N routes are matched at a time.
+                 With --incremental, only GPS data newer than the last
+                 run (plus some overlap) is matched.
                gps_schedules -- from gps trips find actual schedules
+                 With --incremental, only segments without one are done.
+                 With --workers N, N chunks of segments are done at a time.
+                 An interrupted run resumes where it left off.
                fix_earlybirds -- fix too-early gps trips
           """
     sys.exit(0)
@@ -277,11 +524,12 @@ if __name__=="__main__":
       tzdiff = int(sys.argv[2])
     except:
       raise Exception, "Required to enter timezone diff (integer) for match_trips"
-    load_and_cache_routes(db.get_route_names(),tzdiff)
+    load_and_cache_routes(db.get_route_names(),tzdiff,workers,incremental)
   elif arg == 'gps_schedules':
-    create_all_actual_timetables()
+    create_all_actual_timetables(incremental,workers)
   elif arg == 'fix_earlybirds':
     fix_all_earlybirds()
   elif arg == 'populate_ridtags':
     auto_populate_rid_dirtags()
   db.commit()
+  gtfscache.print_stats()
@@ -30,8 +30,45 @@ mydir = path.abspath(path.dirname(sys.argv[0]))
 dbdir = mydir+"/../../common/src/"
 sys.path.append(dbdir)
 
-from dbutils import SQLExec, get_cursor, SDHandler, commit
+from dbutils import SQLExec, SQLCopy, CopyWriter, get_cursor, \
+    get_service_date_handler, commit, rollback, \
+    register_statement, SQLExecPrepared
 import datetime
+import itertools
+
+
+## Statements run over and over with new parameters; see
+## dbutils.register_statement
+
+register_statement("gtfs_trip_header",
+                   "select * from gtf_trips where trip_id=%(id)s")
+register_statement("gtfs_trip_stops",
+                   """select * from gtf_stop_times natural join gtf_stops
+                        where trip_id=%(id)s order by stop_sequence""")
+register_statement("gtfs_shape",
+                   """select * from gtf_shapes where shape_id = %(id)s
+                        order by shape_pt_sequence""")
+register_statement("route_for_dirtag",
+                   """select route_id from routeid_dirtag
+                        where dirtag=%(dirtag)s""")
+register_statement("route_for_routetag",
+                   """select route_id from gtf_routes gr 
+                        where gr.route_short_name=%(routetag)s""")
+register_statement("gps_segment_header",
+                   """select trip_id, trip_date, vehicle_id, schedule_error,
+                          schedule_offset_seconds
+                        from gps_segments
+                        where gps_segment_id=%(segID)s""")
+register_statement("gps_route",
+                   """select lat, lon, reported_update_time
+                        from tracked_routes
+                        where gps_segment_id=%(segID)s
+                        order by reported_update_time""")
+register_statement("gps_schedule",
+                   """select * from gps_stop_times 
+                        where gps_segment_id=%(segid)s
+                        order by stop_sequence asc""")
+
 
 def get_all_trip_ids():
   cur = get_cursor()
@@ -65,21 +102,17 @@ def update_routes(vehicle_data):
     print "empty list"
     return
 
-  query_start = "insert into vehicle_track (" \
-      + ",".join(vehicle_data[0].keys()) + ", reported_update_time) values (" \
-      + ",".join(map(lambda attr: "%(" + attr + ")s",vehicle_data[0].keys())) \
-      + ","
+  keys = vehicle_data[0].keys()
 
-  query_end = ")"
+  def rows():
+    for vdata in vehicle_data:
+      # date_trunc('second',update_time) - secsSinceReport seconds
+      reported = vdata['update_time'].replace(microsecond=0) \
+          - datetime.timedelta(seconds=int(vdata['secsSinceReport']))
+      yield [vdata[k] for k in keys] + [reported]
 
   cur = get_cursor();
-  for vdata in vehicle_data:
-    q = ("date_trunc('second',TIMESTAMP '%(update_time)s') - " \
-        + "interval '%(secsSinceReport)s seconds'") \
-        % vdata
-    q = query_start + q + query_end
-    #print q
-    SQLExec(cur,q,vdata);
+  SQLCopy(cur,"vehicle_track",keys + ["reported_update_time"],rows());
   cur.close();
   
 
@@ -158,20 +191,13 @@ def getGTFSTripData(trip_id):
   if not isinstance(trip_id,basestring):
     trip_id = str(trip_id);
 
-  SQLExec(cur,"select * from gtf_trips where trip_id=%(id)s",
-          {'id':trip_id});
+  SQLExecPrepared(cur,"gtfs_trip_header",{'id':trip_id});
   trip_header = cur.next();
 
-  SQLExec(cur,
-          "select * from gtf_stop_times natural join gtf_stops \
-              where trip_id=%(id)s order by stop_sequence",
-          {'id':trip_id});
+  SQLExecPrepared(cur,"gtfs_trip_stops",{'id':trip_id});
   stops = [row for row in cur];
 
-  SQLExec(cur,
-          "select * from gtf_shapes where shape_id = %(id)s \
-              order by shape_pt_sequence",
-          {'id':trip_header['shape_id']});
+  SQLExecPrepared(cur,"gtfs_shape",{'id':trip_header['shape_id']});
   shape = [row for row in cur];
   
   cur.close();
@@ -179,6 +205,50 @@ def getGTFSTripData(trip_id):
 
 
 
+def getGTFSTripDataMany(trip_ids):
+  """
+  Batched version of getGTFSTripData. Given a collection of trip IDs,
+  returns a dict mapping each trip ID to its (trip_header, trip, shape)
+  tuple, as getGTFSTripData would return it. Three queries are made
+  regardless of the number of trips. Unknown trip IDs are left out.
+  """
+  trip_ids = [str(tid) for tid in trip_ids]
+  if not trip_ids:
+    return {}
+  cur = get_cursor();
+
+  SQLExec(cur,"select * from gtf_trips where trip_id = any(%(ids)s)",
+          {'ids':trip_ids});
+  headers = dict([(row['trip_id'],row) for row in cur])
+
+  SQLExec(cur,
+          """select * from gtf_stop_times natural join gtf_stops
+               where trip_id = any(%(ids)s)
+               order by trip_id, stop_sequence""",
+          {'ids':headers.keys()});
+  stops = {}
+  for row in cur:
+    stops.setdefault(row['trip_id'],[]).append(row)
+
+  shape_ids = list(set([h['shape_id'] for h in headers.values()
+                        if h['shape_id'] is not None]))
+  SQLExec(cur,
+          """select * from gtf_shapes where shape_id = any(%(ids)s)
+               order by shape_id, shape_pt_sequence""",
+          {'ids':shape_ids});
+  shapes = {}
+  for row in cur:
+    shapes.setdefault(row['shape_id'],[]).append(row)
+
+  cur.close();
+  ret = {}
+  for trip_id,header in headers.items():
+    ret[trip_id] = (header, stops.get(trip_id,[]),
+                    shapes.get(header['shape_id'],[]))
+  return ret;
+
+
+
 
 def get_route_for_dirtag(dirtag,routetag=None):
   """
@@ -187,16 +257,11 @@ def get_route_for_dirtag(dirtag,routetag=None):
   attempts to make a match based off the routetag alone.
   """
   cur = get_cursor();
-  SQLExec(cur,
-          """Select route_id from routeid_dirtag where dirtag=%(dirtag)s""",
-          {'dirtag':dirtag});
+  SQLExecPrepared(cur,"route_for_dirtag",{'dirtag':dirtag});
   ret = [r[0] for r in cur];
 
   if not ret and routetag:
-    SQLExec(cur,
-            """select route_id from gtf_routes gr 
-               where gr.route_short_name=%(routetag)s""",
-            {'routetag':routetag})
+    SQLExecPrepared(cur,"route_for_routetag",{'routetag':routetag})
     ret = [r[0] for r in cur]  
 
   cur.close()
@@ -246,10 +311,16 @@ def get_route_dirtags(route_short_name):
   return ret;
 
 
-def get_vehicle_reports(dirtags,tzdiff=0):
+# distinguishes the server-side cursors of iter_vehicle_reports
+_report_cursor_ids = itertools.count()
+
+def iter_vehicle_reports(dirtags,tzdiff=0,since=None,batch_size=10000):
   """
-  Given a list of dirtags, returns a list of dictlike rows of 
-  vehicle tracking reports, sorted in ascending order of update time.
+  Given a list of dirtags, yields dictlike rows of vehicle tracking
+  reports, sorted by vehicle id and then ascending update time. Rows
+  are read from a server-side cursor, batch_size rows at a time.
+  If since is given, only reports with a reported_update_time
+  (before adding tzdiff) at or after since are returned.
   Keys:
   'id',
   'lat',
@@ -259,26 +330,29 @@ def get_vehicle_reports(dirtags,tzdiff=0):
   'reported_update_time'
   """
   if len(dirtags) == 0:
-    return []
+    return
   p = {}
   for i,d in enumerate(dirtags):
     p['k'+str(i)] = d;
+  dirtag_list = ','.join(map(lambda k: "%("+k+")s", p.keys()))
+  since_clause = ""
+  if since is not None:
+    p['since'] = since
+    since_clause = "and reported_update_time >= %(since)s"
   sql = """SELECT id,lat,lon,routetag,dirtag,
                reported_update_time + interval '%d hours'
+                 as reported_update_time
              from vehicle_track 
-             where dirtag IN ( %s )
-           order by reported_update_time asc""" \
-      % (int(tzdiff), ','.join(map(lambda k: "%("+k+")s", p.keys())) )
+             where dirtag IN ( %s ) %s
+           order by id, reported_update_time asc""" \
+      % (int(tzdiff), dirtag_list, since_clause )
 
-  cur = get_cursor();
-  print "Executing..."
+  cur = get_cursor("vehicle_reports_%d" % (_report_cursor_ids.next(),));
+  cur.itersize = batch_size
   SQLExec(cur, sql, p);
-  print "Retrieving..."
-  ret = cur.fetchall();
-  print "...done."
-
+  for row in cur:
+    yield row
   cur.close();
-  return ret;
 
 
 def get_shapes_for_route(route_short_name):
@@ -320,8 +394,58 @@ def get_serviceIDs_for_date(date):
   Given a datetime.date object, returns a list of GTFS service ID's
   active for that date.
   """
-  global SDHandler
-  return SDHandler.effective_service_ids(date);
+  return get_service_date_handler().effective_service_ids(date);
+
+
+def get_serviceIDs_for_dates(dates):
+  """
+  Given a list of datetime.date objects, returns a list with the
+  GTFS service IDs active on each date.
+  """
+  return get_service_date_handler().service_ids_for_dates(dates);
+
+
+def service_id_dates(day):
+  """
+  Returns [day before, day, day after], the days whose service can
+  have trips running on day.
+  """
+  one_day = datetime.timedelta(days=1)
+  return [day - one_day, day, day + one_day]
+
+
+def get_trip_departures():
+  """
+  Returns a list of (trip_id, route_id, direction_id, service_id,
+  first_departure) rows for every GTFS trip with trip information.
+  """
+  cur = get_cursor()
+  SQLExec(cur,"""select trip_id, route_id, direction_id, service_id,
+                        first_departure
+                   from gtf_trips natural join gtf_trip_information""");
+  ret = [tuple(r) for r in cur]
+  cur.close()
+  return ret
+
+
+def get_gtfs_fingerprint():
+  """
+  Returns a string which changes whenever the GTFS feed is reloaded:
+  an md5 of every trip's header and first departure, along with the
+  numbers of stop times and shape points.
+  """
+  cur = get_cursor()
+  SQLExec(cur,"""select md5(coalesce(string_agg(t::text, ';' order by t::text),
+                                     ''))
+                          || ':' || (select count(*) from gtf_stop_times)
+                          || ':' || (select count(*) from gtf_shapes)
+                   from (select trip_id, route_id, direction_id, service_id,
+                                shape_id, first_departure
+                           from gtf_trips natural left outer join
+                                gtf_trip_information) t""");
+  ret = cur.fetchone()[0]
+  cur.close()
+  return ret
 
 
 def get_previous_trip_ID(trip_id, start_date, offset, numtrips=10):
@@ -330,49 +454,21 @@ def get_previous_trip_ID(trip_id, start_date, offset, numtrips=10):
   finds the immediately previous GTFS trip ID with the same direction and 
   route. The start_date is necessary in cases close to midnight.
   """
-  
-  cur = get_cursor();
-
-  SQLExec(cur,"select route_id,direction_id from gtf_trips where trip_id=%(tid)s",
-          {'tid':trip_id});
-  routeinfo = list(cur)[0];
-  route_id,dir_id = map(lambda s:routeinfo[s], 
-                        "route_id,direction_id".split(","));
-  
-  SQLExec(cur,"""select first_departure as mintime
-                   from gtf_trip_information where trip_id=%(tid)s""",
-          {'tid':trip_id});
+  import gtfscache
+  index = gtfscache.get_trip_index();
+  trip = index.trips.get(str(trip_id))
+  if trip is None:
+    return None
+  route_id,dir_id,service_id,first_departure = trip
 
   # start_time is the time the bus started for the date start_date
-  start_time = list(cur)[0]['mintime'] - offset;
-
-
-  yesterday_ids = map(lambda sid: "'"+str(sid)+"'",
-                      get_serviceIDs_for_date(start_date - 
-                                              datetime.timedelta(days=1)));
-  today_ids = map(lambda sid: "'"+str(sid)+"'", 
-                  get_serviceIDs_for_date(start_date));
-  sql = """(select trip_id, 0 as offset,
-                  abs(first_departure- %(start_time)s) as diff 
-             from gtf_trips natural join gtf_trip_information
-             where direction_id=%(dir_id)s and route_id=%(route_id)s
-               and service_id in (""" + ','.join(today_ids) + """)
-               and first_departure < %(start_time)s
-           union
-           select trip_id, 86400 as offset,
-                 abs(first_departure-86400- %(start_time)s ) as diff
-             from gtf_trips natural join gtf_trip_information
-             where direction_id=%(dir_id)s and route_id=%(route_id)s
-               and service_id in (""" + ','.join(yesterday_ids) + """)
-               and first_departure-86400 < %(start_time)s
-           ) order by diff limit """ + str(numtrips)
-
-  SQLExec(cur,sql,
-          {'start_time':start_time,'dir_id':dir_id,'route_id':route_id});
-  
-  ret = [(r['trip_id'],r['offset']) for r in cur]
+  start_time = first_departure - offset;
 
-  cur.close()
+  yesterday_ids,today_ids = \
+      get_serviceIDs_for_dates(service_id_dates(start_date)[:2])
+  ret = index.nearest(route_id,dir_id,
+                      [(0,today_ids),(86400,yesterday_ids)],
+                      start_time,numtrips,before=True)
 
   if len(ret) == 0:
     return None
@@ -401,49 +497,20 @@ def get_best_matching_trip_ID(route_id, dir_id, start_date, start_time,
   is found for 03:00 today, then the offset returned is 0. If a match
   is found for 27:00 yesterday, then the offset returned is 86400.
   """
-  yesterday_ids = map(lambda sid: "'"+str(sid)+"'",
-                      get_serviceIDs_for_date(start_date - 
-                                               datetime.timedelta(days=1)));
+  import gtfscache
+  yesterday_ids,today_ids,tomorrow_ids = \
+      get_serviceIDs_for_dates(service_id_dates(start_date))
   print "  Yesterday's IDs:",yesterday_ids
-
-  today_ids = map(lambda sid: "'"+str(sid)+"'", 
-                    get_serviceIDs_for_date(start_date));
   print "  Today's IDs:",today_ids
   print "  (today is",start_date,")"
-
-  tomorrow_ids = map(lambda sid: "'"+str(sid)+"'",
-                     get_serviceIDs_for_date(start_date +
-                                              datetime.timedelta(days=1)));
   print "  Tomorrow's IDs:",tomorrow_ids
 
-  sql = """(select trip_id, 0 as offset,
-                  abs(first_departure-%(start_time)s) as diff 
-             from gtf_trips natural join gtf_trip_information
-             where direction_id=%(dir_id)s and route_id=%(route_id)s
-               and service_id in (""" + ','.join(today_ids) + """)
-           union
-           select trip_id, 86400 as offset,
-                 abs(first_departure-86400-%(start_time)s) as diff
-             from gtf_trips natural join gtf_trip_information
-             where direction_id=%(dir_id)s and route_id=%(route_id)s
-               and service_id in (""" + ','.join(yesterday_ids) + """)
-           union
-           select trip_id, -86400 as offset,
-                 abs(first_departure+86400-%(start_time)s) as diff
-             from gtf_trips natural join gtf_trip_information
-             where direction_id=%(dir_id)s and route_id=%(route_id)s
-               and service_id in (""" + ','.join(tomorrow_ids) + """)
-           ) order by diff limit """ + str(num_results)
-
-  cur = get_cursor()
-  SQLExec(cur,sql,
-          {'start_time':start_time,'dir_id':dir_id,'route_id':route_id});
-  
-  ret = [(r['trip_id'],r['offset']) for r in cur]
+  ret = gtfscache.get_trip_index().nearest(
+    route_id,dir_id,
+    [(0,today_ids),(86400,yesterday_ids),(-86400,tomorrow_ids)],
+    start_time,num_results)
   if len(ret) == 0:
     ret = None
-
-  cur.close()
   return ret
 
 
@@ -484,11 +551,6 @@ def export_gps_route( trip_id, trip_date, vehicle_id,
                %(gtfs_error)s, %(offset)s
          ) RETURNING gps_segment_id"""
 
-  sql2 = """insert into tracked_routes (
-               gps_segment_id, lat, lon, reported_update_time
-             ) VALUES (
-               %(seg_id)s,%(lat)s,%(lon)s,%(reported_update_time)s
-             )"""
   cur = get_cursor()
 
   
@@ -497,11 +559,10 @@ def export_gps_route( trip_id, trip_date, vehicle_id,
            'gtfs_error':str(gtfs_error),'offset':offset_seconds});
   segment_id = list(cur.fetchall())[0][0];
   
-  for lat,lon,reported_update_time in gps_data:
-    SQLExec(cur,sql2,
-            {'lat':lat,'lon':lon,
-             'reported_update_time':reported_update_time,
-             'seg_id':str(segment_id)});
+  SQLCopy(cur,"tracked_routes",
+          ("gps_segment_id","lat","lon","reported_update_time"),
+          ((segment_id,lat,lon,reported_update_time)
+           for lat,lon,reported_update_time in gps_data));
 
   cur.close()
   return segment_id
@@ -515,13 +576,8 @@ def load_gps_segment_header(segment_id):
   is the measured error between the GPS route and the GTFS schedule, and 
   offset is the number of seconds to substract from any GTFS schedule times.
   """
-  sql_header = """select trip_id, trip_date, vehicle_id, schedule_error,
-                    schedule_offset_seconds
-                  from gps_segments
-                  where gps_segment_id=%(segID)s"""
-
   cur = get_cursor()
-  SQLExec(cur,sql_header,{'segID':segment_id});
+  SQLExecPrepared(cur,"gps_segment_header",{'segID':segment_id});
   header = [r for r in cur][0];
   cur.close()
 
@@ -548,13 +604,8 @@ def load_gps_route(segment_id):
   
   
 
-  sql = """select lat, lon, reported_update_time
-           from tracked_routes
-           where gps_segment_id=%(segID)s
-           order by reported_update_time"""
-
   cur = get_cursor()  
-  SQLExec(cur,sql,{'segID':segment_id});
+  SQLExecPrepared(cur,"gps_route",{'segID':segment_id});
   res = [r for r in cur];
   cur.close();
 
@@ -566,6 +617,51 @@ def load_gps_route(segment_id):
 
 
 
+def load_gps_segment_headers(segment_ids):
+  """
+  Batched version of load_gps_segment_header. Given a collection of
+  segment IDs, returns a dict mapping each to its
+     (trip_id,trip_date,vehicle_id,schedule_error,offset)
+  Unknown segment IDs are left out.
+  """
+  cur = get_cursor()
+  SQLExec(cur,"""select gps_segment_id, trip_id, trip_date, vehicle_id,
+                        schedule_error, schedule_offset_seconds
+                   from gps_segments
+                   where gps_segment_id = any(%(ids)s)""",
+          {'ids':list(segment_ids)});
+  ret = dict([(r[0],tuple(r[1:])) for r in cur])
+  cur.close()
+  return ret
+
+
+def load_gps_routes(segment_ids):
+  """
+  Batched version of load_gps_route. Given a collection of segment IDs,
+  returns a dict mapping each to the tuple load_gps_route would return
+  for it. Two queries are made regardless of the number of segments.
+  Unknown segment IDs are left out.
+  """
+  segment_ids = list(segment_ids)
+  headers = load_gps_segment_headers(segment_ids)
+
+  cur = get_cursor()
+  SQLExec(cur,"""select gps_segment_id, lat, lon, reported_update_time
+                   from tracked_routes
+                   where gps_segment_id = any(%(ids)s)
+                   order by gps_segment_id, reported_update_time""",
+          {'ids':segment_ids});
+  routes = {}
+  for seg_id,rows in itertools.groupby(cur,lambda r:r[0]):
+    routes[seg_id] = [[r[1],r[2],r[3]] for r in rows]
+  cur.close()
+
+  ret = {}
+  for seg_id,header in headers.items():
+    ret[seg_id] = header + (routes.get(seg_id,[]),)
+  return ret
+
+
 def correct_gps_schedule( segment_id, trip_id, gtfs_error, offset_seconds,
                        gps_data ):
   sql1="""update gps_segments set trip_id=%(tid)s,schedule_error=%(gerr)s,
@@ -606,21 +702,10 @@ def export_gps_schedule(segment_id,schedule):
          """actual_arrival_time_seconds,actual_departure_time_seconds,"""\
          """seconds_since_last_stop,prev_stop_id"""
   keys = keystr.split(",")
-  
-  sql = """insert into gps_stop_times (gps_segment_id,"""+keystr+""")
-
-           values
-
-           (%(gps_seg_id)s,""" \
-            +",".join(map(lambda k: "%("+k+")s", keys)) + """)"""
 
   cur = get_cursor()
-  for row in schedule:
-    params = {}
-    params['gps_seg_id']=segment_id
-    for key in keys:
-      params[key]=row[key]
-    SQLExec(cur,sql,params);
+  SQLCopy(cur,"gps_stop_times",["gps_segment_id"]+keys,
+          [[segment_id]+[row[key] for key in keys] for row in schedule]);
   cur.close()
 
 
@@ -645,16 +730,32 @@ def load_gps_schedule(segment_id):
   The rows will be in order of increasing stop sequence.
   """
   
-  sql = """select * from gps_stop_times 
-             where gps_segment_id=%(segid)s
-             order by stop_sequence asc"""
   cur = get_cursor();
-  SQLExec(cur,sql,{'segid':segment_id});
+  SQLExecPrepared(cur,"gps_schedule",{'segid':segment_id});
   ret = list(cur);
   cur.close();
   return ret;
 
 
+def load_gps_schedules(segment_ids):
+  """
+  Batched version of load_gps_schedule. Given a collection of segment
+  IDs, returns a dict mapping each to its list of gps_stop_times rows
+  (in order of increasing stop sequence), in one query. Segments with
+  no schedule are left out.
+  """
+  cur = get_cursor();
+  SQLExec(cur,"""select * from gps_stop_times
+                   where gps_segment_id = any(%(ids)s)
+                   order by gps_segment_id, stop_sequence asc""",
+          {'ids':list(segment_ids)});
+  ret = {}
+  for seg_id,rows in itertools.groupby(cur,lambda r:r['gps_segment_id']):
+    ret[seg_id] = list(rows)
+  cur.close();
+  return ret;
+
+
 def export_trip_information(trip_id,first_arrive,first_depart,
                          trip_length,trip_duration,total_stops):
   """
@@ -684,29 +785,35 @@ def export_trip_stop_information(trip_id,stop_sequence,stop_number,
   the cumulative distance from the beginning of the trip to this stop in
   meters, and the time in seconds it takes (according to the schedule) to
   get to this stop from the previous stop, pushes it to the database.
+
+  Rows are buffered and written in bulk; they reach the database no
+  later than the next commit().
   """
-  
-  sql="""insert into gtf_stoptimes_information (trip_id, stop_sequence,
-           trip_stop_number,prev_stop_distance_meters,
-           cumulative_distance_meters,travel_time_seconds)
-         values
-           (%(tid)s,%(seq)s,%(num)s,%(dist)s,%(cdist)s,%(time)s)"""
-  cur = get_cursor()
-  if prev_stop_distance is not None:
-    prev_stop_distance = str(prev_stop_distance)
-  SQLExec(cur,sql,{'tid':trip_id,'seq':stop_sequence,'num':stop_number,
-                   'dist':prev_stop_distance,
-                   'cdist':str(cumulative_distance),
-                   'time':prev_stop_travel_time});
-  cur.close()
+  trip_stop_writer.write((trip_id,stop_sequence,stop_number,
+                          prev_stop_distance,cumulative_distance,
+                          prev_stop_travel_time))
 
+trip_stop_writer = CopyWriter("gtf_stoptimes_information",
+                              ("trip_id","stop_sequence","trip_stop_number",
+                               "prev_stop_distance_meters",
+                               "cumulative_distance_meters",
+                               "travel_time_seconds"))
 
-def get_segment_IDs(scheduled_only=True):
+
+def get_segment_IDs(scheduled_only=True,unexported_only=False):
+  """
+  Returns the IDs of GPS segments in increasing order; only those
+  matched to a GTFS trip if scheduled_only, and only those with no rows
+  in gps_stop_times if unexported_only.
+  """
   cur = get_cursor();
+  sql = "select gps_segment_id from gps_segments gs where true"
   if scheduled_only:
-    sql = "select gps_segment_id from gps_segments where trip_id is not null"
-  else:
-    sql = "select gps_segment_id from gps_segments"
+    sql += " and trip_id is not null"
+  if unexported_only:
+    sql += """ and not exists (select 1 from gps_stop_times gst
+                               where gst.gps_segment_id = gs.gps_segment_id)"""
+  sql += " order by gps_segment_id"
   SQLExec(cur,sql)
   seg_ids = [s['gps_segment_id'] for s in cur]
   cur.close()
@@ -720,6 +827,207 @@ def get_route_names():
   return ret
 
 
+def get_match_watermark(route_short_name):
+  """
+  Returns the reported_update_time of the newest vehicle report
+  that has been matched for the route, or None if the route has
+  never been matched.
+  """
+  cur = get_cursor()
+  SQLExec(cur,"""select reported_update_time from match_watermarks
+                 where route_short_name=%(rsn)s""",
+          {'rsn':route_short_name});
+  row = cur.fetchone()
+  cur.close()
+  if row is None:
+    return None
+  return row[0]
+
+
+def set_match_watermark(route_short_name,reported_update_time):
+  """
+  Records reported_update_time as the newest vehicle report
+  matched for the route.
+  """
+  params = {'rsn':route_short_name,'time':reported_update_time}
+  cur = get_cursor()
+  SQLExec(cur,"""update match_watermarks set reported_update_time=%(time)s
+                 where route_short_name=%(rsn)s""", params);
+  if cur.rowcount == 0:
+    SQLExec(cur,"""insert into match_watermarks
+                     (route_short_name,reported_update_time)
+                   values (%(rsn)s,%(time)s)""", params);
+  cur.close()
+
+
+def get_finished_schedule_chunks(incremental):
+  """
+  Returns the sorted list of (first_segment_id, last_segment_id) chunks
+  recorded by finish_schedule_chunk for runs of the given kind.
+  """
+  cur = get_cursor()
+  SQLExec(cur,"""select first_segment_id, last_segment_id
+                   from gps_schedule_progress
+                   where incremental = %(inc)s
+                 order by first_segment_id""", {'inc':incremental});
+  ret = [(r[0],r[1]) for r in cur]
+  cur.close()
+  return ret
+
+
+def finish_schedule_chunk(first_segment_id,last_segment_id,num_segments,
+                          incremental):
+  """
+  Records that the gps_stop_times of the chunk of segments from
+  first_segment_id to last_segment_id are done, by a run which was
+  incremental or not. Should be committed along with them.
+  """
+  cur = get_cursor()
+  SQLExec(cur,"""insert into gps_schedule_progress
+                     (first_segment_id, last_segment_id, num_segments,
+                      incremental)
+                   values (%(first)s, %(last)s, %(num)s, %(inc)s)""",
+          {'first':first_segment_id,'last':last_segment_id,
+           'num':num_segments,'inc':incremental});
+  cur.close()
+
+
+def clear_schedule_progress(incremental=None):
+  """
+  Deletes the recorded chunks; if incremental is given, only those
+  recorded by runs of the other kind. Returns how many were deleted.
+  """
+  cur = get_cursor()
+  if incremental is None:
+    SQLExec(cur,"delete from gps_schedule_progress");
+  else:
+    SQLExec(cur,"""delete from gps_schedule_progress
+                   where incremental <> %(inc)s""", {'inc':incremental});
+  ret = cur.rowcount
+  cur.close()
+  return ret
+
+
+def get_archive_progress(archive):
+  """
+  Returns (members_loaded, finished) for the archive of NextBus
+  snapshots, as last recorded by set_archive_progress, or (0, False)
+  if none of it has been loaded.
+  """
+  cur = get_cursor()
+  SQLExec(cur,"""select members_loaded,finished from archive_progress
+                 where archive=%(archive)s""",
+          {'archive':archive});
+  row = cur.fetchone()
+  cur.close()
+  if row is None:
+    return 0,False
+  return row[0],row[1]
+
+
+def set_archive_progress(archive,members_loaded,finished=False):
+  """
+  Records that the first members_loaded snapshots of the archive have
+  been loaded, and whether that is all of them.
+  """
+  params = {'archive':archive,'loaded':members_loaded,'finished':finished}
+  cur = get_cursor()
+  SQLExec(cur,"""update archive_progress 
+                 set members_loaded=%(loaded)s, finished=%(finished)s
+                 where archive=%(archive)s""", params);
+  if cur.rowcount == 0:
+    SQLExec(cur,"""insert into archive_progress
+                     (archive,members_loaded,finished)
+                   values (%(archive)s,%(loaded)s,%(finished)s)""", params);
+  cur.close()
+
+
+def get_latest_vehicle_reports(before,window_seconds=3600):
+  """
+  Returns each vehicle's newest vehicle_track row retrieved before the
+  time before, looking back no further than window_seconds. Keys:
+  'id',
+  'routetag',
+  'dirtag',
+  'lat',
+  'lon',
+  'reported_update_time'
+  """
+  cur = get_cursor()
+  SQLExec(cur,"""select distinct on (id)
+                        id, routetag, dirtag, lat, lon, reported_update_time
+                   from vehicle_track
+                   where update_time < %(before)s
+                     and reported_update_time >= %(before)s - %(window)s
+                 order by id, update_time desc""",
+          {'before':before,
+           'window':datetime.timedelta(seconds=window_seconds)});
+  ret = cur.fetchall()
+  cur.close()
+  return ret
+
+
+def get_exported_report_times(dirtags,since,tzdiff=0):
+  """
+  Returns the set of (vehicle_id,reported_update_time) pairs which
+  have already been exported into tracked_routes, for vehicles which
+  have reported on any of the dirtags since the time since.
+
+  As with iter_vehicle_reports, since is compared against the
+  vehicle_track times, while the tracked_routes times (which were
+  exported with tzdiff hours added) are returned as they are.
+  """
+  if len(dirtags) == 0:
+    return set()
+  cur = get_cursor()
+  SQLExec(cur,"""select gs.vehicle_id, tr.reported_update_time
+                   from tracked_routes tr
+                   inner join gps_segments gs
+                     on gs.gps_segment_id = tr.gps_segment_id
+                 where tr.reported_update_time
+                         >= %%(since)s + interval '%d hours'
+                   and gs.vehicle_id in
+                     (select distinct id from vehicle_track
+                      where dirtag = any(%%(dirtags)s)
+                        and reported_update_time >= %%(since)s)"""
+          % (int(tzdiff),),
+          {'since':since,'dirtags':list(dirtags)});
+  ret = set((r[0],r[1]) for r in cur)
+  cur.close()
+  return ret
+
+
+# percent of vehicle_track's pages get_route_sizes looks at
+ROUTE_SIZE_SAMPLE_PERCENT = 1
+
+def get_route_sizes(since_watermark=False):
+  """
+  Returns a dict mapping route_short_name to an estimate of the number
+  of vehicle tracking reports on that route's dirtags, a rough measure
+  of how much work matching the route will be. The reports are counted
+  in a ROUTE_SIZE_SAMPLE_PERCENT sample of vehicle_track, so only the
+  proportions mean anything. If since_watermark is True, only reports
+  from each route's match watermark onwards are counted. Routes with
+  no reports (in the sample) are left out.
+  """
+  cur = get_cursor()
+  SQLExec(cur,"""select gr.route_short_name, count(*)
+                   from vehicle_track tablesample system (%(pct)s) vt
+                   inner join routeid_dirtag rd on vt.dirtag = rd.dirtag
+                   inner join gtf_routes gr on gr.route_id = rd.route_id
+                   left outer join match_watermarks mw
+                     on mw.route_short_name = gr.route_short_name
+                   where not %(since_watermark)s
+                     or mw.reported_update_time is null
+                     or vt.reported_update_time >= mw.reported_update_time
+                 group by gr.route_short_name""",
+          {'pct':ROUTE_SIZE_SAMPLE_PERCENT,
+           'since_watermark':since_watermark});
+  ret = dict((r[0],int(r[1])) for r in cur)
+  cur.close()
+  return ret
+
+
 def populate_routeid_dirtag(deletefirst=False):
   """
   Populates routeid_dirtag table with all distinct instances of 
@@ -748,50 +1056,32 @@ def export_lateness_data( gpssched, sched_error ):
   which records observations of lateness along with their attributes.
   """
   
-  sql = """
-insert into datamining_table dt
-( gps_segment_id, gtfs_trip_id, rms_schedule_error, vehicle_id,
-  route_name, vehicle_type, service_id, direction_id,
-  stop_lat, stop_lon, stop_id, stop_sequence,
-  scheduled_arrival_time, scheduled_departure_time,
-  actual_arrival_time, lateness, prev_stop_id )
-values
-( null, %(trip_id)s, %(sched_err)s, %(vehid)s,
-  %(routename)s, %(vehtype)s, %(service_id)s, %(dir_id)s,
-  %(stoplat)s,%(stoplon)s,%(stopid)s,%(stopseq)s,
-  %(sched_arr)s,%(sched_dep)s,%(actual_arr)s,%(lateness)s,
-  %(prev_stop_id)s )
-"""
+  columns = ( "gps_segment_id", "gtfs_trip_id", "rms_schedule_error",
+              "vehicle_id", "route_name", "vehicle_type", "service_id",
+              "direction_id", "stop_lat", "stop_lon", "stop_id",
+              "stop_sequence", "scheduled_arrival_time",
+              "scheduled_departure_time", "actual_arrival_time",
+              "lateness", "prev_stop_id" )
   
   gtfs = gpssched.getGTFSSchedule()
 
-  basedict = { 'trip_id' : gtfs.trip_id,
-               'sched_err' : sched_error,
-               'vehid' : gpssched.segment.vehicle_id,
-               'routename' : gtfs.route_short_name,
-               'vehtype' : gtfs.route_type,
-               'service_id' : gtfs.service_id,
-               'dir_id' : gtfs.direction_id
-               }
+  base = [ None, gtfs.trip_id, sched_error, gpssched.segment.vehicle_id,
+           gtfs.route_short_name, gtfs.route_type, gtfs.service_id,
+           gtfs.direction_id ]
 
-  cur = get_cursor()
-  
+  rows = []
   for arrival in gpssched.getGPSSchedule():
     print dict(arrival)
-    stopdict = dict(basedict)
-    stopdict.update ( { 'stoplat' : arrival['stop_lat'],
-                        'stoplon' : arrival['stop_lon'],
-                        'stopid' : arrival['stop_id'],
-                        'stopseq' : arrival['stop_sequence'],
-                        'sched_arr' : arrival['arrival_time_seconds'],
-                        'sched_dep' : arrival['departure_time_seconds'],
-                        'actual_arr' : arrival['actual_arrival_time_seconds'],
-                        'lateness' : arrival['actual_arrival_time_seconds'] \
-                          - arrival['departure_time_seconds'],
-                        'prev_stop_id' : arrival['prev_stop_id']
-                        } )
-    SQLExec(cur, sql, stopdict)
-
+    rows.append( base + [ arrival['stop_lat'], arrival['stop_lon'],
+                          arrival['stop_id'], arrival['stop_sequence'],
+                          arrival['arrival_time_seconds'],
+                          arrival['departure_time_seconds'],
+                          arrival['actual_arrival_time_seconds'],
+                          arrival['actual_arrival_time_seconds'] \
+                            - arrival['departure_time_seconds'],
+                          arrival['prev_stop_id'] ] )
 
+  cur = get_cursor()
+  SQLCopy(cur, "datamining_table", columns, rows)
   cur.close()
   
@@ -0,0 +1,417 @@
+"""
+gtfscache.py: A process-local cache of GTFS data.
+
+The same GTFS trips are looked at over and over while matching and
+scheduling (once per candidate during matching, again for the matched
+GPSBusSchedule, again when correcting early birds, ...). Everything here
+sits in front of the corresponding dbqueries functions, so that each
+trip is fetched from the database once per process for as long as it
+stays in the cache.
+
+Four bounded, least-recently-used caches are kept:
+
+  trips -- (trip_header, stops, shape) per trip_id, as returned by
+           dbqueries.getGTFSTripData
+  routes -- gtf_routes rows per route_id
+  interpolations -- built BusTrack interpolations per
+                    (trip_id, offset, use_shape)
+  shapes -- a ShapeIndex per shape_id, shared by every trip on the shape
+
+along with a TripIndex of every trip's first departure, used to find
+candidate trips without going to the database.
+
+Whenever the TripIndex is asked for, and at most every
+FEED_CHECK_SECONDS, the feed's fingerprint is checked against the one
+it had when the index was built; if the feed has been reloaded since,
+everything is cleared and built again from the new feed.
+
+Note that cached rows are shared between everyone who asks for them,
+so they must not be modified.
+
+Everything here may be used from several threads at once (as
+RealtimeSim's matching pool does). Two threads which miss on the same
+key may both build it, but only one copy is kept.
+"""
+
+# Copyright (c) 2010 Colin Bick, Robert Damphousse
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import dbqueries as db
+import gisarray as gisa
+import numpy as np
+import threading
+import time
+from collections import OrderedDict
+
+TRIP_CACHE_SIZE = 10000
+ROUTE_CACHE_SIZE = 1000
+INTERPOLATION_CACHE_SIZE = 20000
+SHAPE_CACHE_SIZE = 2000
+# seconds between checks for a reloaded GTFS feed
+FEED_CHECK_SECONDS = 300
+
+
+class LRUCache(object):
+  """
+  A dictionary holding at most maxsize entries. When it is full,
+  the least recently used entry is evicted to make room. Keeps
+  count of hits, misses and evictions. Thread-safe.
+  """
+
+  def __init__(self,maxsize):
+    self.maxsize = maxsize
+    self.lock = threading.Lock()
+    self.entries = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def __len__(self):
+    return len(self.entries)
+
+  def __contains__(self,key):
+    return key in self.entries
+
+  def lookup(self,key):
+    """
+    Returns (True,value) if key is cached, and marks it as most
+    recently used. Otherwise returns (False,None).
+    """
+    self.lock.acquire()
+    try:
+      try:
+        value = self.entries.pop(key)
+      except KeyError:
+        self.misses += 1
+        return False,None
+      self.entries[key] = value
+      self.hits += 1
+      return True,value
+    finally:
+      self.lock.release()
+
+  def store(self,key,value):
+    self.lock.acquire()
+    try:
+      self.entries.pop(key,None)
+      self.entries[key] = value
+      while len(self.entries) > self.maxsize:
+        self.entries.popitem(last=False)
+        self.evictions += 1
+    finally:
+      self.lock.release()
+
+  def clear(self):
+    self.lock.acquire()
+    try:
+      self.entries.clear()
+    finally:
+      self.lock.release()
+
+  def stats(self):
+    """
+    Returns a dict with keys 'size', 'hits', 'misses', 'evictions'.
+    """
+    self.lock.acquire()
+    try:
+      return {'size':len(self.entries), 'hits':self.hits,
+              'misses':self.misses, 'evictions':self.evictions}
+    finally:
+      self.lock.release()
+
+
+class TripIndex(object):
+  """
+  All GTFS trips, grouped by (route_id, direction_id, service_id).
+  Each group holds its trips' first departure times (in seconds into
+  the day) in sorted order, along with the matching trip IDs.
+
+  self.trips maps each trip_id to
+  (route_id, direction_id, service_id, first_departure).
+  """
+
+  def __init__(self,rows):
+    """
+    Builds the index from (trip_id, route_id, direction_id, service_id,
+    first_departure) rows, as returned by dbqueries.get_trip_departures.
+    """
+    self.trips = {}
+    groups = {}
+    for trip_id,route_id,dir_id,service_id,first_departure in rows:
+      if first_departure is None:
+        continue
+      self.trips[str(trip_id)] = (route_id,dir_id,service_id,first_departure)
+      key = self.key(route_id,dir_id,service_id)
+      groups.setdefault(key,[]).append((first_departure,str(trip_id)))
+
+    self.groups = {}
+    for key,group in groups.items():
+      group.sort()
+      self.groups[key] = (np.array([g[0] for g in group],dtype=np.float64),
+                          [g[1] for g in group])
+
+  @staticmethod
+  def key(route_id,dir_id,service_id):
+    if dir_id is not None:
+      dir_id = int(dir_id)
+    return (str(route_id),dir_id,str(service_id))
+
+  def nearest(self,route_id,dir_id,service_ids_by_offset,start_time,k,
+              before=False):
+    """
+    Finds the k trips on route_id in direction dir_id whose first
+    departure is nearest to start_time.
+
+    service_ids_by_offset is a list of (offset, service_ids) pairs;
+    the trips of each service_id are considered with offset seconds
+    subtracted from their times. (So yesterday's trips have an offset
+    of 86400, and tomorrow's -86400.) If before is True, only trips
+    departing before start_time are considered.
+
+    Returns a list of (trip_id, offset) pairs, nearest first.
+    """
+    candidates = []
+    for offset,service_ids in service_ids_by_offset:
+      target = start_time + offset
+      for service_id in service_ids:
+        group = self.groups.get(self.key(route_id,dir_id,service_id))
+        if group is None:
+          continue
+        departures,trip_ids = group
+        i = np.searchsorted(departures,target)
+        # the k nearest in this group are within k places of i
+        lo,hi = max(0,i-k), min(len(departures),i+k)
+        if before:
+          hi = i
+        for j in xrange(lo,hi):
+          candidates.append((abs(departures[j]-target),trip_ids[j],offset))
+    candidates.sort()
+    return [(trip_id,offset) for diff,trip_id,offset in candidates[:k]]
+
+
+class ShapeIndex(object):
+  """
+  A GTFS shape's points as arrays of floats, for placing stops along
+  the shape. Segment i runs from point i to point i+1.
+  """
+
+  # segments looked at in the first pass of a search; each further
+  # pass looks at twice as many
+  SEARCH_WINDOW = 32
+
+  def __init__(self,shape):
+    """
+    Builds the index from gtf_shapes rows in shape_pt_sequence order.
+    """
+    self.lats = np.array([float(pt['shape_pt_lat']) for pt in shape],
+                         dtype=np.float64)
+    self.lons = np.array([float(pt['shape_pt_lon']) for pt in shape],
+                         dtype=np.float64)
+
+  def __len__(self):
+    return len(self.lats)
+
+  def find_segment(self,lat,lon,begin_idx=0,tol=20):
+    """
+    Finds the first segment at index i >= begin_idx which comes within
+    tol meters of (lat,lon), as measured by
+    gisutils.distance_from_segment_meters.
+
+    Returns (i,None), or (None,min_dist) if there is no such segment,
+    where min_dist is the closest any of them came.
+
+    Segments are measured a window at a time, starting at begin_idx,
+    so finding a stop costs about as much as the stretch of shape
+    between it and begin_idx.
+    """
+    lat,lon = float(lat),float(lon)
+    num_segments = len(self.lats) - 1
+    start,width = begin_idx,self.SEARCH_WINDOW
+    min_dist = 1e10
+    while start < num_segments:
+      end = min(num_segments,start+width)
+      dists = gisa.distance_from_segment_meters(
+        self.lats[start:end], self.lons[start:end],
+        self.lats[start+1:end+1], self.lons[start+1:end+1], lat, lon)
+      hits = np.flatnonzero(dists <= tol)
+      if len(hits):
+        return start + int(hits[0]),None
+      min_dist = min(min_dist,float(dists.min()))
+      start,width = end,2*width
+    return None,min_dist
+
+
+trips = LRUCache(TRIP_CACHE_SIZE)
+routes = LRUCache(ROUTE_CACHE_SIZE)
+interpolations = LRUCache(INTERPOLATION_CACHE_SIZE)
+shapes = LRUCache(SHAPE_CACHE_SIZE)
+trip_index = None
+# db.get_gtfs_fingerprint() as of the last check, and when that was
+feed_fingerprint = None
+feed_checked = None
+# held while checking the feed and building the TripIndex
+index_lock = threading.RLock()
+
+
+def get_trip_data(trip_id):
+  """
+  Cached version of dbqueries.getGTFSTripData.
+  """
+  trip_id = str(trip_id)
+  found,data = trips.lookup(trip_id)
+  if not found:
+    data = db.getGTFSTripData(trip_id)
+    trips.store(trip_id,data)
+  return data
+
+
+def get_trips_data(trip_ids):
+  """
+  Cached version of dbqueries.getGTFSTripDataMany. All trips which
+  are not already cached are fetched together.
+  """
+  ret = {}
+  missing = []
+  for trip_id in set(map(str,trip_ids)):
+    found,data = trips.lookup(trip_id)
+    if found:
+      ret[trip_id] = data
+    else:
+      missing.append(trip_id)
+  if missing:
+    fetched = db.getGTFSTripDataMany(missing)
+    for trip_id,data in fetched.items():
+      trips.store(trip_id,data)
+    ret.update(fetched)
+  return ret
+
+
+def get_route_data(route_id):
+  """
+  Cached version of dbqueries.getGTFSRouteData.
+  """
+  route_id = str(route_id)
+  found,data = routes.lookup(route_id)
+  if not found:
+    data = db.getGTFSRouteData(route_id)
+    routes.store(route_id,data)
+  return data
+
+
+def has_interpolation(trip_id,offset,use_shape):
+  """
+  Returns True if an interpolation is cached for (trip_id,offset,use_shape).
+  """
+  return (str(trip_id),offset,use_shape) in interpolations
+
+
+def get_interpolation(trip_id,offset,use_shape,build):
+  """
+  Returns the interpolation cached for (trip_id,offset,use_shape),
+  calling build() to make it (and caching the result) if there isn't
+  one. By convention use_shape is None for face-value GTFSBusSchedule
+  interpolations, and True/False for GTFSBusTrack interpolations.
+  """
+  key = (str(trip_id),offset,use_shape)
+  found,interp = interpolations.lookup(key)
+  if not found:
+    interp = build()
+    interpolations.store(key,interp)
+  return interp
+
+
+def get_shape_index(shape_id,shape):
+  """
+  Returns the ShapeIndex cached for shape_id, building it from the
+  gtf_shapes rows in shape if there isn't one.
+  """
+  shape_id = str(shape_id)
+  found,index = shapes.lookup(shape_id)
+  if not found:
+    index = ShapeIndex(shape)
+    shapes.store(shape_id,index)
+  return index
+
+
+def check_feed():
+  """
+  Clears everything if the GTFS feed has changed since the last check.
+  Checks at most every FEED_CHECK_SECONDS, unless nothing is cached.
+  """
+  global feed_fingerprint,feed_checked
+  now = time.time()
+  if trip_index is not None and feed_checked is not None \
+        and now - feed_checked < FEED_CHECK_SECONDS:
+    return
+  fingerprint = db.get_gtfs_fingerprint()
+  if fingerprint != feed_fingerprint:
+    if feed_fingerprint is not None:
+      print "GTFS feed has changed, clearing the GTFS cache"
+    clear()
+    feed_fingerprint = fingerprint
+  feed_checked = now
+
+
+def get_trip_index():
+  """
+  Returns the TripIndex, building it if need be, or if the GTFS feed
+  has changed since it was built.
+  """
+  global trip_index
+  index_lock.acquire()
+  try:
+    check_feed()
+    if trip_index is None:
+      trip_index = TripIndex(db.get_trip_departures())
+    return trip_index
+  finally:
+    index_lock.release()
+
+
+def clear():
+  """
+  Empties all caches. This happens by itself (see check_feed) when
+  the GTFS feed changes.
+  """
+  global trip_index,feed_fingerprint
+  index_lock.acquire()
+  try:
+    trips.clear()
+    routes.clear()
+    interpolations.clear()
+    shapes.clear()
+    trip_index = None
+    feed_fingerprint = None
+  finally:
+    index_lock.release()
+
+
+def stats():
+  """
+  Returns a dict mapping cache name to that cache's stats() dict.
+  """
+  return {'trips':trips.stats(), 'routes':routes.stats(),
+          'interpolations':interpolations.stats(), 'shapes':shapes.stats()}
+
+
+def print_stats():
+  for name,st in sorted(stats().items()):
+    print "GTFS %s cache: %d entries, %d hits, %d misses, %d evictions" % \
+        (name,st['size'],st['hits'],st['misses'],st['evictions'])
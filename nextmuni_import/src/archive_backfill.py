@@ -0,0 +1,187 @@
+"""
+Loads tarballs of archived NextBus .xml snapshots into the DB, without
+extracting them to disk.
+
+Each snapshot in a tarball is named by its retrieve time, as for
+archive_saver. Snapshots are parsed in a pool of worker processes, and
+a vehicle report which is identical to the same vehicle's report in
+the previous snapshot is only stored once. Only a few snapshots per
+worker are read from the tarball at a time, and their new reports
+are written as soon as they are parsed. (Tarballs must be loaded in
+order of time for this: when a run starts, each vehicle's previous
+report is taken to be its newest one already in vehicle_track from
+before the first snapshot loaded.) Every chunk of snapshots is
+stored in one transaction along with how far into the tarball it got
+(in archive_progress), so an interrupted backfill picks up where it
+left off when rerun with the same tarballs.
+"""
+
+import datetime
+import multiprocessing
+import tarfile
+from cStringIO import StringIO
+from os import path
+
+from route_scraper import iter_vehicles,archive_retrieve_time,db
+
+# snapshots per transaction (and progress update)
+CHUNK_SIZE = 500
+# snapshots handed to each worker at a time
+PARSE_BATCH_PER_WORKER = 4
+
+
+def _parse_member(args):
+  """
+  Parses one snapshot, given (member name, xml data). Returns the
+  list of vehicles, or None if it couldn't be parsed.
+  """
+  name,data = args
+  fname = path.basename(name)
+  try:
+    try:
+      retrieve_time = archive_retrieve_time(fname[:fname.find(".")])
+    except ValueError:
+      # not named by its retrieve time; look inside instead
+      retrieve_time = None
+    return list(iter_vehicles(StringIO(data),None,retrieve_time))
+  except Exception,e:
+    print "Couldn't parse %s: %s" % (name,e)
+    return None
+
+
+def iter_batches(tarname,skip=0,batch_size=PARSE_BATCH_PER_WORKER):
+  """
+  Reads the snapshots in tarname in order, skipping the first skip
+  of them, and yields lists of up to batch_size (name, data) pairs.
+  """
+  tar = tarfile.open(tarname,'r|*')
+  try:
+    batch = []
+    for member in tar:
+      if not member.isfile():
+        continue
+      if skip > 0:
+        skip -= 1
+        continue
+      f = tar.extractfile(member)
+      batch.append((member.name,f.read()))
+      f.close()
+      if len(batch) == batch_size:
+        yield batch
+        batch = []
+    if batch:
+      yield batch
+  finally:
+    tar.close()
+
+
+class ReportDeduper(object):
+  """
+  Remembers each vehicle's latest report, to drop the reports which
+  were repeated unchanged in the following snapshot.
+  """
+
+  def __init__(self):
+    self.last = {}
+
+  def seed(self,before):
+    """
+    Starts each vehicle off with its newest report in the database
+    from before the time before, if nothing has been seen yet.
+    """
+    if self.last:
+      return
+    for row in db.get_latest_vehicle_reports(before):
+      # the values as parsed from the feed (all strings)
+      self.last[row['id']] = (row['reported_update_time'],
+                              str(row['lat']), str(row['lon']),
+                              row['routetag'], row['dirtag'])
+
+  def is_new(self,vehdata):
+    # the same as the reported_update_time db.update_routes stores
+    reported = vehdata['update_time'].replace(microsecond=0) \
+        - datetime.timedelta(seconds=int(vehdata['secsSinceReport']))
+    key = (reported, vehdata['lat'], vehdata['lon'],
+           vehdata['routeTag'], vehdata['dirTag'])
+    if self.last.get(vehdata['id']) == key:
+      return False
+    self.last[vehdata['id']] = key
+    return True
+
+
+def backfill_archive(tarname,pool,workers,dedupe,chunk_size=CHUNK_SIZE):
+  """
+  Loads every snapshot in tarname which hasn't been loaded already,
+  with a pool of the given number of workers.
+  """
+  archive = path.basename(tarname)
+  loaded,finished = db.get_archive_progress(archive)
+  if finished:
+    print "%s already loaded, skipping." % (archive,)
+    return
+  if loaded:
+    print "Resuming %s after %d snapshots." % (archive,loaded)
+
+  # never more snapshots at once than go in a transaction
+  batch_size = min(chunk_size, PARSE_BATCH_PER_WORKER*workers)
+  in_chunk,new_reports = 0,0
+  for batch in iter_batches(tarname,loaded,batch_size):
+    parsed = [v for v in pool.map(_parse_member,batch) if v]
+    if parsed:
+      dedupe.seed(min([v[0]['update_time'] for v in parsed]))
+    reports = []
+    for vehicles in parsed:
+      reports.extend([v for v in vehicles if dedupe.is_new(v)])
+    if reports:
+      db.update_routes(reports)
+    new_reports += len(reports)
+    loaded += len(batch)
+    in_chunk += len(batch)
+    if in_chunk + batch_size > chunk_size:
+      db.set_archive_progress(archive,loaded)
+      db.commit()
+      print "%s: %d snapshots, %d new reports" % (archive,loaded,new_reports)
+      in_chunk,new_reports = 0,0
+
+  db.set_archive_progress(archive,loaded,finished=True)
+  db.commit()
+  if in_chunk:
+    print "%s: %d snapshots, %d new reports" % (archive,loaded,new_reports)
+
+
+def backfill(tarnames,workers=None,chunk_size=CHUNK_SIZE):
+  """
+  Loads the tarballs in order, parsing with a pool of worker
+  processes (by default, one per CPU).
+  """
+  if workers is None:
+    workers = multiprocessing.cpu_count()
+  dedupe = ReportDeduper()
+  pool = multiprocessing.Pool(workers)
+  try:
+    for tarname in tarnames:
+      backfill_archive(tarname,pool,workers,dedupe,chunk_size)
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+
+
+if __name__=="__main__":
+  import sys
+  workers = None
+  if '--workers' in sys.argv:
+    i = sys.argv.index('--workers')
+    try:
+      workers = int(sys.argv[i+1])
+    except:
+      raise Exception, "--workers requires a number of processes"
+    del sys.argv[i:i+2]
+  if len(sys.argv) < 2:
+    print "Usage: %s [--workers N] archive.tar.gz ..." % (sys.argv[0],)
+    print "  Archives are loaded in the order given, so give them in"
+    print "  order of time."
+    sys.exit(1)
+  backfill(sys.argv[1:],workers)
@@ -2,16 +2,17 @@
 Takes archived set of nextbus .xml files and dumps them to the DB.
 """
 
-from route_scraper import parse_xml,db
+from route_scraper import parse_stream,archive_retrieve_time,db
 from os import path
 
 def save_data(xmlfile):
-  f = open(xmlfile,'r')
-  lines = "\n".join(f.readlines())
-  f.close()
-  xmlfile = path.basename(xmlfile)
-  time_retrieved = xmlfile[:xmlfile.find(".")]
-  vals = parse_xml(None,lines,time_retrieved=time_retrieved)
+  fname = path.basename(xmlfile)
+  time_retrieved = fname[:fname.find(".")]
+  f = open(xmlfile,'rb')
+  try:
+    vals = parse_stream(None,f,archive_retrieve_time(time_retrieved))
+  finally:
+    f.close()
   db.update_routes(vals)
   db.commit()
   
@@ -21,7 +21,12 @@
 # THE SOFTWARE.
 
 import urllib as url
-import xml.dom.minidom as xml
+import httplib
+import urlparse
+import random
+import traceback
+import xml.etree.cElementTree as etree
+from cStringIO import StringIO
 import time
 import datetime as dt
 
@@ -32,6 +37,12 @@ sys.path.append(coredir)
 import dbqueries as db
 
 
+feed_URL = "http://webservices.nextbus.com/service/publicXMLFeed?command=vehicleLocations&a=sf-muni&t=0"
+
+attributes = [ 'id', 'routeTag', 'dirTag', 'lat', 'lon', 'secsSinceReport', 
+               'predictable', 'heading' ];
+
+
 def read_routes(fname):
   f = open(fname,'r');
   lines = f.readlines();
@@ -41,85 +52,281 @@ def read_routes(fname):
   return lines;
 
 
+def archive_retrieve_time(time_retrieved):
+  """
+  Given the retrieve time an archived file is named by, returns it
+  as a datetime.
+  """
+  fstr = '%Y-%m-%dT%H-%M-%S'
+  dstr = time_retrieved[:-5]
+  return dt.datetime.strptime(dstr,fstr)
+  # time.strftime(fstr,time.gmtime())
+  # > '2010-10-19T22-38-47+0000'
+  # tar -ztf *.tar.gz
+  # > '2010-09-01T23-50-01-0700.tar.gz'
+
+
+def iter_vehicles(stream,routes=None,retrieve_time=None):
+  """
+  Yields a dict for each vehicle in the NextBus vehicleLocations XML
+  read from the file-like stream, mapping each of attributes (and
+  'update_time') to its value. Vehicles whose routeTag isn't in
+  routes are skipped, unless routes is None.
+
+  The document is parsed as it is read, and each vehicle element is
+  thrown away once it has been looked at, so the whole document is
+  never held in memory. However if retrieve_time (a datetime) is None,
+  it is taken from the document's retrieveTime element, and since that
+  can come after the vehicles, nothing is yielded until the end.
+  """
+  if routes:
+    routes = set(routes)
+  pending = []
+  root = None
+  for event,elem in etree.iterparse(stream,events=('start','end')):
+    if root is None:
+      root = elem
+    if event != 'end':
+      continue
+    if elem.tag == 'vehicle':
+      if (not routes) or (elem.get('routeTag','') in routes):
+        vehdata = dict([(attr,elem.get(attr,'')) for attr in attributes])
+        if retrieve_time is None:
+          pending.append(vehdata)
+        else:
+          vehdata['update_time'] = retrieve_time
+          yield vehdata
+      root.clear()
+    elif elem.tag == 'retrieveTime' and retrieve_time is None:
+      retrieve_time = dt.datetime.fromtimestamp(int(elem.get("time")))
+
+  if pending and retrieve_time is None:
+    raise Exception, "No retrieveTime found"
+  for vehdata in pending:
+    vehdata['update_time'] = retrieve_time
+    yield vehdata
+
+
+def parse_stream(routes,stream,retrieve_time=None):
+  """
+  Returns the list of vehicles which iter_vehicles finds in stream.
+  """
+  updated_data = list(iter_vehicles(stream,routes,retrieve_time))
+  if updated_data:
+    print "Retrieve time:",updated_data[0]['update_time'].ctime()
+  return updated_data
+
+
 def parse_xml(routes,xmldata,time_retrieved=None):
-  """time_retrieved should be in seconds since epoch"""
-  # parse xml for the route
-  doc = xml.parseString(xmldata);
-
-  if time_retrieved is None:
-    retrieve_time = dt.datetime.fromtimestamp( 
-      int(doc.getElementsByTagName('retrieveTime')[0].getAttribute("time"))
-      )
-  else:
-    fstr = '%Y-%m-%dT%H-%M-%S'
-    dstr = time_retrieved[:-5]
-    retrieve_time = dt.datetime.strptime(dstr,fstr)
-    # time.strftime(fstr,time.gmtime())
-    # > '2010-10-19T22-38-47+0000'
-    # tar -ztf *.tar.gz
-    # > '2010-09-01T23-50-01-0700.tar.gz'
-    # retrieve_time = dt.datetime.fromtimestamp(int(time_retrieved))
-  print "Retrieve time:",retrieve_time.ctime()
-
-  attributes = [ 'id', 'routeTag', 'dirTag', 'lat', 'lon', 'secsSinceReport', 
-                 'predictable', 'heading' ];
-  updated_data = [];
-  # Save the tracking data
-  vehicles = doc.getElementsByTagName('vehicle');
-  for vehicle in vehicles:
-    vehdata = {'update_time':retrieve_time}
-    for attr in attributes:
-      vehdata[attr] = vehicle.getAttribute(attr);
-    if (not routes) or (vehdata['routeTag'] in routes):
-      updated_data.append(vehdata);
-
-  return updated_data;
+  """
+  Returns the list of vehicles in the XML string xmldata.
+  time_retrieved should be the retrieve time an archived file is
+  named by, if the data doesn't say when it was retrieved.
+  """
+  retrieve_time = None
+  if time_retrieved is not None:
+    retrieve_time = archive_retrieve_time(time_retrieved)
+  return parse_stream(routes,StringIO(xmldata),retrieve_time)
 
-def get_updated_routes(routes):
-  format_URL = "http://webservices.nextbus.com/service/publicXMLFeed?command=vehicleLocations&a=sf-muni&t=0"
 
-  attributes = [ 'id', 'routeTag', 'dirTag', 'lat', 'lon', 'secsSinceReport', 
-                 'predictable', 'heading' ];
-  updated_data = [];
+class FeedSession(object):
+  """
+  Fetches the vehicleLocations feed from feed_url again and again.
+  For http URLs one connection is kept open between fetches (and
+  reopened if the server drops it); anything else, such as a file://
+  URL standing in for the feed in tests, is opened with urllib.
+  """
+
+  def __init__(self,feed_url=None):
+    if feed_url is None:
+      feed_url = feed_URL
+    self.feed_url = feed_url
+    parts = urlparse.urlsplit(feed_url)
+    self.persistent = (parts.scheme == 'http')
+    self.host = parts.netloc
+    self.path = urlparse.urlunsplit(('','',parts.path or '/',parts.query,''))
+    self.conn = None
+
+  def _request(self):
+    if self.conn is None:
+      self.conn = httplib.HTTPConnection(self.host)
+    self.conn.request('GET',self.path)
+    resp = self.conn.getresponse()
+    if resp.status != 200:
+      resp.read()
+      raise Exception, "Feed returned HTTP %d %s" % (resp.status,resp.reason)
+    return resp
+
+  def fetch(self,routes):
+    """
+    Retrieves the feed, and returns the vehicles on routes
+    (or on all routes, if routes is None) as for parse_stream.
+    """
+    retrieve_time = dt.datetime.now();
+    if not self.persistent:
+      resp = url.urlopen(self.feed_url);
+      try:
+        return parse_stream(routes,resp,retrieve_time)
+      finally:
+        resp.close();
+
+    try:
+      resp = self._request()
+    except (httplib.HTTPException,IOError):
+      # the kept-alive connection went stale; try once more on a new one
+      self.close()
+      resp = self._request()
+    try:
+      ret = parse_stream(routes,resp,retrieve_time)
+      # leave the connection ready for the next request
+      resp.read()
+    except:
+      self.close()
+      raise
+    if resp.will_close:
+      self.close()
+    return ret
+
+  def close(self):
+    if self.conn is not None:
+      self.conn.close()
+      self.conn = None
 
+
+def get_updated_routes(routes):
   # Retrieve/parse xml for the route
-  retrieve_time = dt.datetime.now();
-  resp = url.urlopen(format_URL);
-  respdata = "".join(resp.readlines());
-  resp.close();
-  doc = xml.parseString(respdata);
+  session = FeedSession()
+  try:
+    return session.fetch(routes)
+  finally:
+    session.close()
+
+
+class ScrapeStats(object):
+  """
+  Keeps the per-cycle latencies (in seconds) of scrape_loop.
+  """
+
+  def __init__(self):
+    self.cycles = 0
+    self.failures = 0
+    self.vehicles = 0
+    self.totals = {'fetch':0.0,'write':0.0,'cycle':0.0}
+    self.maxes = {'fetch':0.0,'write':0.0,'cycle':0.0}
+
+  def record(self,num_vehicles,**times):
+    self.cycles += 1
+    self.vehicles += num_vehicles
+    for key,secs in times.items():
+      self.totals[key] += secs
+      self.maxes[key] = max(self.maxes[key],secs)
+
+  def summary(self):
+    if not self.cycles:
+      return "No cycles completed (%d failed)." % (self.failures,)
+    return ("%d cycles (%d failed), %.1f vehicles/cycle; "
+            "mean/max seconds: fetch %.2f/%.2f, write %.2f/%.2f, "
+            "cycle %.2f/%.2f") % \
+        (self.cycles, self.failures, float(self.vehicles)/self.cycles,
+         self.totals['fetch']/self.cycles, self.maxes['fetch'],
+         self.totals['write']/self.cycles, self.maxes['write'],
+         self.totals['cycle']/self.cycles, self.maxes['cycle'])
+
+
+def scrape_loop(routes,interval=60.0,jitter=5.0,feed_url=None,
+                max_cycles=None,summary_every=60):
+  """
+  Scrapes the feed every interval seconds (give or take up to jitter
+  seconds, at random) and stores the vehicles on routes, until
+  max_cycles have been done or forever if max_cycles is None.
+  The feed and database connections are kept open throughout, and a
+  failed cycle is reported and rolled back without stopping the loop.
 
-  # Save the tracking data
-  vehicles = doc.getElementsByTagName('vehicle');
-  for vehicle in vehicles:
-    vehdata = {'update_time':retrieve_time}
-    for attr in attributes:
-      vehdata[attr] = vehicle.getAttribute(attr);
-    if (not routes) or (vehdata['routeTag'] in routes):
-      updated_data.append(vehdata);
+  Returns the ScrapeStats.
+  """
+  session = FeedSession(feed_url)
+  stats = ScrapeStats()
+  try:
+    while max_cycles is None or stats.cycles+stats.failures < max_cycles:
+      start = time.time()
+      try:
+        updated_routes = session.fetch(routes)
+        fetched = time.time()
+        db.update_routes(updated_routes);
+        db.commit();
+        done = time.time()
+        stats.record(len(updated_routes), fetch=fetched-start,
+                     write=done-fetched, cycle=done-start)
+        print "%s: %d vehicles, fetch %.2fs, write %.2fs" % \
+            (time.ctime(start), len(updated_routes),
+             fetched-start, done-fetched)
+      except Exception:
+        stats.failures += 1
+        print "%s: scrape failed:" % (time.ctime(start),)
+        traceback.print_exc()
+        session.close()
+        db.rollback()
+        done = time.time()
 
-  return updated_data;
+      if (stats.cycles+stats.failures) % summary_every == 0:
+        print stats.summary()
+      sys.stdout.flush()
+
+      if max_cycles is None or stats.cycles+stats.failures < max_cycles:
+        wait = interval - (done-start) + random.uniform(-jitter,jitter)
+        if wait > 0:
+          time.sleep(wait)
+  finally:
+    session.close()
+  return stats
 
 
 if __name__ == "__main__":
+  opts = {'--loop':None,'--jitter':5.0,'--url':None}
+  for opt in opts.keys():
+    if opt in sys.argv:
+      i = sys.argv.index(opt)
+      try:
+        opts[opt] = sys.argv[i+1]
+        if opt != '--url':
+          opts[opt] = float(opts[opt])
+      except:
+        raise Exception, "%s requires a value" % (opt,)
+      del sys.argv[i:i+2]
+
   if len(sys.argv) < 2:
     print
-    print "Usage: %s filename" % sys.argv
+    print "Usage: %s [--loop SECONDS [--jitter SECONDS]] [--url URL] filename" \
+        % sys.argv[0]
     print "  The file should have a line-by-line listing of route ID's."
     print "  You may comment out lines with a #"
     print
-    print "  *** To retrieve ALL route ID's, try '%s ALL'." % sys.argv
+    print "  *** To retrieve ALL route ID's, try '%s ALL'." % sys.argv[0]
+    print
+    print "  With --loop, keeps running and scrapes every SECONDS seconds"
+    print "  (+/- up to --jitter seconds, default 5). --url fetches the feed"
+    print "  from URL instead of from NextBus."
     print
     sys.exit(1)
 
-  print "Retrieving data on",time.ctime(),"..."
-  sys.stdout.flush()
   fname = sys.argv[1]
   if fname=="ALL":
     routes = None
   else:
     routes = read_routes(fname);
-  updated_routes = get_updated_routes(routes);
+
+  if opts['--loop'] is not None:
+    try:
+      scrape_loop(routes,opts['--loop'],opts['--jitter'],opts['--url'])
+    except KeyboardInterrupt:
+      pass
+    sys.exit(0)
+
+  print "Retrieving data on",time.ctime(),"..."
+  sys.stdout.flush()
+  session = FeedSession(opts['--url'])
+  updated_routes = session.fetch(routes);
+  session.close()
   db.update_routes(updated_routes);
   db.commit();
   print "... Done (",time.ctime(),").\n"
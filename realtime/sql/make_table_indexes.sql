@@ -2,12 +2,17 @@
 
 begin;
 
-create index obs_attr_ix 
+-- these two must be unique, for rtqueries' "on conflict" upserts
+create unique index obs_attr_ix 
   on observation_attributes (trip_id, stop_sequence, day_of_week);
 
-create index simpl_late_ix
+create unique index simpl_late_ix
   on simplified_lateness_observations (minutes_late, observed_stop_id);
 
+-- in case observation_attributes was filled before the sequence existed
+select setval('observed_stop_id_seq', coalesce(max(observed_stop_id)+1,0), false)
+  from observation_attributes;
+
 alter table observation_attributes add constraint obs_attr_pkey
   primary key (observed_stop_id);
 
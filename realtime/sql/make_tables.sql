@@ -1,5 +1,6 @@
 drop table observation_attributes cascade;
 drop table simplified_lateness_observations cascade;
+drop sequence observed_stop_id_seq;
 
 begin;
 
@@ -11,9 +12,11 @@ begin;
 -- The primary difference is that it discretizes the observations
 -- to the resolution of one minute, instead of one second.
 
+create sequence observed_stop_id_seq minvalue 0 start with 0;
+
 create table observation_attributes (
   -- unique reference (primary key)
-  observed_stop_id integer,
+  observed_stop_id integer default nextval('observed_stop_id_seq'),
 
   -- identifying values
   trip_id text,
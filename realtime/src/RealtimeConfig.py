@@ -1,3 +1,5 @@
+import os
+import dbutils
 from dbutils import read_config
 
 config = {}
@@ -13,12 +15,27 @@ def init_config():
   defaults = {
     'store_intermediate' : 'False',
     'min_lateness_minutes' : '-20',
-    'max_lateness_minutes' : '40'
+    'max_lateness_minutes' : '40',
+    'lateness_hist_file' : "'lateness_hist.npy'",
+    'listen_backlog' : '128',
+    'worker_threads' : '4',
+    'match_threads' : '4',
+    'max_pending_feeds' : '32',
+    'max_pending_writes' : '256',
+    'db_batch_size' : '50',
+    'web_statement_timeout_ms' : '10000'
     }
 
   for key,default in defaults.items():
     config[key] = eval(conf_params.get(key,default))
 
+  # so that the daemon and the web workers find the same file, wherever
+  # they were started from, a relative path is taken to be relative to
+  # the config directory holding db.config
+  config_dir = os.path.dirname(os.path.abspath(dbutils.config_file))
+  config['lateness_hist_file'] = os.path.join(config_dir,
+                                              config['lateness_hist_file'])
+
 
 init_config()
 
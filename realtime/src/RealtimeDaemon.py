@@ -1,5 +1,8 @@
 import socket
 import asyncore
+import threading
+import traceback
+import Queue
 from os import sys
 
 import RealtimeSim
@@ -7,6 +10,10 @@ from RealtimeConfig import config
 import dbqueries as db
 import rtqueries as rtdb
 import GPSBusTrack
+from latenesshist import open_histograms
+
+# how often (in seconds) the event loop rechecks whether it can accept
+POLL_SECONDS = 0.5
 
 class RDConnHandler(asyncore.dispatcher):
   """
@@ -42,18 +49,51 @@ class RDConnHandler(asyncore.dispatcher):
 
 class RealtimeDaemon(asyncore.dispatcher):
   """
-  
+  Accepts NextBus XML feed pushes. The event loop only reads the
+  data; each feed is handed to a pool of worker threads, which parse
+  it and update the vehicle tracks. Feeds are parsed in parallel but
+  applied to the tracks one at a time, in the order they arrived. The
+  tracks which ended are matched to GTFS trips in the simulation's
+  pool, and the matches are handed on to a single thread which writes
+  them to the database in batches, and then adds the lateness
+  observations it committed to lateness_hists (if given).
+
+  Both hand-offs go through bounded queues. While the feed queue is
+  full, no new connections are accepted, so they wait in the listen
+  backlog instead of piling up in memory.
   """
 
-  def __init__(self,port):
+  def __init__(self,port,lateness_hists=None):
     asyncore.dispatcher.__init__(self)
     print "Port:",port
     self.create_socket(socket.AF_INET,socket.SOCK_STREAM)
+    self.set_reuse_addr()
     self.bind(('',port))
-    self.listen(5)
+    self.listen(config['listen_backlog'])
 
     self.rtsim = RealtimeSim.RealtimeSimulation();
+    self.lateness_hists = lateness_hists
+    # Feeds are numbered as they arrive, and feed number n is only
+    # applied (by whichever worker has it) once next_to_apply is n.
+    self.received = 0
+    self.next_to_apply = 0
+    self.apply_turn = threading.Condition()
+
+    self.feeds = Queue.Queue(config['max_pending_feeds'])
+    self.matches = Queue.Queue(config['max_pending_writes'])
 
+    self.threads = [threading.Thread(target=self.feed_worker)
+                    for i in range(config['worker_threads'])]
+    self.threads.append(threading.Thread(target=self.db_writer))
+    for t in self.threads:
+      t.setDaemon(True)
+      t.start()
+
+
+  def readable(self):
+    # backpressure: leave new connections in the listen backlog
+    # until the workers catch up
+    return not self.feeds.full()
 
   def handle_accept(self):
     client,addr = self.accept()
@@ -64,37 +104,129 @@ class RealtimeDaemon(asyncore.dispatcher):
     print "Daemon closed."
 
   def data_received(self,data):
-    result = self.rtsim.updateVehicles(xml=data)
-    if result:
-      print result
-      ((trip_id, offset, error), segment) = result
-      gpssched = GPSBusTrack.GPSBusSchedule( segment = segment,
-                                             trip_id = trip_id,
-                                             offset = offset );
-
-      if config['store_intermediate'] is True:
-        db.export_lateness_data( gpssched, error )
-      rtdb.record_observations( gpssched )
-
-      print "GTFS Matchup Discovered"
-      print "Trip:",trip_id
-      for actual_arrival in gpssched.getGPSSchedule():
-        if actual_arrival['actual_arrival_time_seconds']:
-          lateness = int(actual_arrival['actual_arrival_time_seconds']
-                         - actual_arrival['departure_time_seconds'])
-        else:
-          lateness = None
-        print "  Arrived at stop %s at time %s, which was %s seconds late" \
-            % (actual_arrival['stop_id'], 
-               actual_arrival['actual_arrival_time_seconds'],
-               lateness)
-    # in all cases
-    db.commit()
-
+    # only blocks if connections accepted before the queue filled up
+    # all finish at once
+    self.feeds.put((self.received,data))
+    self.received += 1
+
+  def feed_worker(self):
+    """
+    Parses feeds from the feed queue and applies them to the vehicle
+    tracks, queueing all the resulting GTFS matches for the database
+    writer.
+    """
+    while True:
+      seq,data = self.feeds.get()
+      try:
+        update = RealtimeSim.parse_update(data)
+      except Exception:
+        print "Error parsing feed:"
+        traceback.print_exc()
+        update = None
+      try:
+        ended = self.apply_in_order(seq,update)
+        for result in self.rtsim.matchTracks(ended):
+          self.matches.put(result)
+      except Exception:
+        print "Error processing feed:"
+        traceback.print_exc()
+
+  def apply_in_order(self,seq,update):
+    """
+    Waits until every feed received before feed number seq has been
+    applied, then applies update (None if the feed couldn't be parsed)
+    and returns the tracks which ended.
+    """
+    self.apply_turn.acquire()
+    try:
+      while self.next_to_apply != seq:
+        self.apply_turn.wait()
+      try:
+        if update is None:
+          return []
+        return self.rtsim.applyUpdate(update=update)
+      finally:
+        self.next_to_apply += 1
+        self.apply_turn.notify_all()
+    finally:
+      self.apply_turn.release()
+
+  def db_writer(self):
+    """
+    Writes the GTFS matches from the match queue to the database,
+    committing once per batch of up to config['db_batch_size']. If
+    a batch fails, its matches are retried one per transaction, so
+    that one bad match only loses itself. Lateness observations are
+    added to the histograms only once they have been committed.
+    """
+    while True:
+      batch = [self.matches.get()]
+      try:
+        while len(batch) < config['db_batch_size']:
+          batch.append(self.matches.get_nowait())
+      except Queue.Empty:
+        pass
+
+      try:
+        counts = []
+        for result in batch:
+          counts.extend(self.record_match(result))
+        db.commit()
+      except Exception:
+        print "Error writing %d matches, retrying one at a time:" \
+            % (len(batch),)
+        traceback.print_exc()
+        db.rollback()
+        counts = []
+        for result in batch:
+          try:
+            match_counts = self.record_match(result)
+            db.commit()
+          except Exception:
+            print "Error writing match:",result
+            traceback.print_exc()
+            db.rollback()
+          else:
+            counts.extend(match_counts)
+
+      if self.lateness_hists is not None:
+        for osid,minutes,num in counts:
+          self.lateness_hists.add(osid,minutes,num)
+
+  def record_match(self,result):
+    """
+    Records a match, returning the lateness counts it added (as
+    rtqueries.record_observations does). Doesn't commit.
+    """
+    print result
+    ((trip_id, offset, error), segment) = result
+    gpssched = GPSBusTrack.GPSBusSchedule( segment = segment,
+                                           trip_id = trip_id,
+                                           offset = offset );
+
+    if config['store_intermediate'] is True:
+      db.export_lateness_data( gpssched, error )
+    counts = rtdb.record_observations( gpssched )
+
+    print "GTFS Matchup Discovered"
+    print "Trip:",trip_id
+    for actual_arrival in gpssched.getGPSSchedule():
+      if actual_arrival['actual_arrival_time_seconds']:
+        lateness = int(actual_arrival['actual_arrival_time_seconds']
+                       - actual_arrival['departure_time_seconds'])
+      else:
+        lateness = None
+      print "  Arrived at stop %s at time %s, which was %s seconds late" \
+          % (actual_arrival['stop_id'], 
+             actual_arrival['actual_arrival_time_seconds'],
+             lateness)
+    return counts
 
 
 if __name__ == "__main__":
   import time
-  rd = RealtimeDaemon(5000 + (int(time.time())%60) );
-  asyncore.loop()
+  # keep the histograms the web interface reads up to date
+  rd = RealtimeDaemon(5000 + (int(time.time())%60),
+                      lateness_hists = open_histograms(writable=True));
+  asyncore.loop(timeout=POLL_SECONDS)
 
@@ -10,10 +10,13 @@ sfmtadir = mydir + "/../../nextmuni_import/src/"
 sys.path.append(sfmtadir)
 
 from RealtimeConfig import config
+import dbutils
 import GPSDataTools
 import GPSBusTrack
 import datetime
+import traceback
 import route_scraper
+from multiprocessing.pool import ThreadPool
 
 
 class GPSTrackState(object):
@@ -37,19 +40,8 @@ class GPSTrackState(object):
     """
     Updates history with GPSDataTools.VehicleReport vreport. If the 
     vehicle changes routes, the last set of reports for the previous 
-    route are collected into a GPSBusTrack.GPSBusTrack, and a
-    GTFS match is attempted.
-
-    If no GTFS match is discovered, or the vehicle didn't change
-    routes, returns None.
-
-    Otherwise, returns ( (trip_id,offset,error), segment )
-      where (trip_id, offset, error) are the gtfs matchup info
-      as returned by GPSBusTrack.getMatchingGTFSTripID().
-
-      If intermediate values are stored in the database, segment is 
-      the segment_id of the stored TrackedVehicleSegment. Otherwise
-      segment is the GPSBusTrack used to find the matching GTFS trip.
+    route are returned as a list, ready for matchTrack(). Otherwise
+    returns None.
     """
     if self.track and vreport == self.track[-1]:
       return None
@@ -58,26 +50,7 @@ class GPSTrackState(object):
 
     if self.track and (vreport.route_tag != self.last_routetag 
                        or vreport.dirtag != self.last_dirtag):
-      veh_seg = GPSDataTools.VehicleSegment(self.track)
-
-      if config['store_intermediate'] is True:
-        segment, gtfsinfo = veh_seg.export_segment()
-      else:
-        segment = GPSBusTrack.GPSBusTrack(veh_seg)
-        gtfsinfo = segment.getMatchingGTFSTripID()
-
-      if gtfsinfo is None and len(self.track) > 1:
-        print "Segment ended but no GTFS trip found (%d interp pts)" \
-            % ( len(self.track), )
-        print " Old route tag: %s, Old dir tag: %s" \
-            % (self.last_routetag, self.last_dirtag)
-        print " GPS Track:"
-        print "  " + "\n  ".join(map(str,self.track))
-      
-      elif gtfsinfo is not None:
-        ret = gtfsinfo, segment
-
-      
+      ret = self.track
       self.track = []
       
     self.last_routetag = vreport.route_tag
@@ -86,8 +59,77 @@ class GPSTrackState(object):
     return ret
 
 
+def matchTrack(track):
+  """
+  Collects the reports in track (as returned by 
+  GPSTrackState.updateTrack) into a GPSBusTrack.GPSBusTrack, and 
+  attempts a GTFS match.
+
+  If no GTFS match is discovered, returns None.
+
+  Otherwise, returns ( (trip_id,offset,error), segment )
+    where (trip_id, offset, error) are the gtfs matchup info
+    as returned by GPSBusTrack.getMatchingGTFSTripID().
+
+    If intermediate values are stored in the database, segment is 
+    the segment_id of the stored TrackedVehicleSegment. Otherwise
+    segment is the GPSBusTrack used to find the matching GTFS trip.
+  """
+  veh_seg = GPSDataTools.VehicleSegment(track)
+
+  if config['store_intermediate'] is True:
+    segment, gtfsinfo = veh_seg.export_segment()
+  else:
+    segment = GPSBusTrack.GPSBusTrack(veh_seg)
+    gtfsinfo = segment.getMatchingGTFSTripID()
+
+  if gtfsinfo is None:
+    if len(track) > 1:
+      print "Segment ended but no GTFS trip found (%d interp pts)" \
+          % ( len(track), )
+      print " Old route tag: %s, Old dir tag: %s" \
+          % (track[-1].route_tag, track[-1].dirtag)
+      print " GPS Track:"
+      print "  " + "\n  ".join(map(str,track))
+    return None
+
+  return gtfsinfo, segment
+
+
+
+
 
 
+def parse_update(xml = None):
+  """
+  Returns the vehicles in the NextBus XML data xml, as parsed by
+  route_scraper. If xml is None, the feed is scraped.
+  """
+  if xml is None:
+    return route_scraper.get_updated_routes(None)
+  return route_scraper.parse_xml(routes=None,xmldata=xml)
+
+
+def _pooledMatchTrack(track):
+  """
+  matchTrack, as run in the pool's threads. Each of these has its own
+  connection, so it commits whatever matchTrack stored (the database
+  writer will refer to it) and returns the connection to the pool.
+  If matching the track fails, nothing of it is stored and None is
+  returned, so that the other tracks' matches aren't lost with it.
+  """
+  try:
+    try:
+      ret = matchTrack(track)
+      dbutils.commit()
+      return ret
+    except Exception:
+      print "Error matching track:"
+      traceback.print_exc()
+      dbutils.rollback()
+      return None
+  finally:
+    dbutils.release_conn()
 
 
 class RealtimeSimulation(object):
@@ -95,15 +137,43 @@ class RealtimeSimulation(object):
   
   """
   
-  def __init__(self):
+  def __init__(self, match_threads = None):
     self.vehicles = {}
+    if match_threads is None:
+      match_threads = config['match_threads']
+    self.pool = ThreadPool(match_threads)
+
+  def updateVehicles(self, xml = None, update = None):
+    """
+    Applies a feed snapshot to the vehicles' tracks, and attempts a
+    GTFS match for every track which ended. The snapshot is either the
+    parsed vehicles in update, the XML data in xml, or if neither is
+    given, freshly scraped.
 
-  def updateVehicles(self, xml = None):
-    if xml is None:
-      update = route_scraper.get_updated_routes(None)
-    else:
-      update = route_scraper.parse_xml(routes=None,xmldata=xml)
+    Returns a list of the ( (trip_id,offset,error), segment ) matches
+    found, as described in matchTrack().
+    """
+    return self.matchTracks( self.applyUpdate(xml=xml, update=update) )
 
+  def matchTracks(self, tracks):
+    """
+    Runs matchTrack on each of the ended tracks in the worker pool,
+    and returns a list of the matches found.
+    """
+    if not tracks:
+      return []
+    return [m for m in self.pool.map(_pooledMatchTrack, tracks, chunksize=1)
+            if m is not None]
+
+  def applyUpdate(self, xml = None, update = None):
+    """
+    Applies a feed snapshot (given as for updateVehicles) to the
+    vehicles' tracks, and returns a list of the tracks which ended.
+    """
+    if update is None:
+      update = parse_update(xml)
+
+    ended = []
     for vehicle in update:
       vid = vehicle['id']
       now = vehicle['update_time'] #datetime
@@ -124,5 +194,9 @@ class RealtimeSimulation(object):
         trk = GPSTrackState(vid)
         self.vehicles[vid] = trk
 
-      gtfs_match = trk.updateTrack(report)
-      return gtfs_match
+      track = trk.updateTrack(report)
+      if track is not None:
+        ended.append(track)
+
+    return ended
+
@@ -1,14 +1,50 @@
 import rtqueries as rtdb
+from stopindex import StopIndex
+from latenesshist import open_histograms
 
 
+stop_index = None
+
+def load_stop_index():
+  """
+  (Re)builds the in-memory index of stops from the database.
+  Call this again whenever the GTFS feed is reloaded.
+  """
+  global stop_index
+  stop_index = StopIndex( rtdb.get_all_stops() )
+  return stop_index
+
+def get_stop_index():
+  if stop_index is None:
+    load_stop_index()
+  return stop_index
+
 
 def get_stops( min_lat, max_lat, min_lon, max_lon ):
-  stops = rtdb.get_stops( min_lat,max_lat,min_lon,max_lon )
-  return map( lambda stop: { 'stop_id' : stop['stop_id'],
-                             'lat' : stop['stop_lat'],
-                             'lon' : stop['stop_lon'],
-                             'stop_name' : stop['stop_name'] },
-              stops)
+  return get_stop_index().bbox( min_lat,max_lat,min_lon,max_lon )
+
+def get_nearest_stops( lat, lon, k=10 ):
+  return get_stop_index().nearest( lat, lon, int(k) )
+
+lateness_hists = None
+observation_ids = {}
+
+def get_lateness_hists():
+  # None until the realtime daemon has made the histogram file
+  global lateness_hists
+  if lateness_hists is None:
+    lateness_hists = open_histograms()
+  return lateness_hists
+
+def get_observation_id( trip_id, stop_seq, dow ):
+  key = (trip_id, int(stop_seq), int(dow))
+  osid = observation_ids.get(key)
+  if osid is None:
+    osid = rtdb.get_observation_stop_id( trip_id, None, key[2], key[1] )
+    if osid is not None:
+      observation_ids[key] = osid
+  return osid
+
 
 def get_stop_info(stop_id, dow):
   dow = int(dow)
@@ -49,7 +85,11 @@ def get_percentile( bounds, trip_id, stop_seq, dow ):
   Returns None if the identifying information does not identify a known
   arrival.
   """
-  return rtdb.measure_prob_mass( trip_id, None, dow, stop_seq, bounds )
+  hists = get_lateness_hists()
+  if hists is None:
+    return None
+  osid = get_observation_id( trip_id, stop_seq, dow )
+  return hists.prob_mass( osid, bounds )
 
 
 
@@ -66,7 +106,7 @@ Usage: %s min_minutes max_minutes trip_id stop_seq stop_id dow
     print usage
     sys.exit(1)
 
-  print get_percentile( (args[1],args[2]), *args[3:])
+  print get_percentile( [(args[1],args[2])], *args[3:])
 
 if __name__=="__main__":
   main()
@@ -35,9 +35,12 @@ def parse_bounds_string(boundstr):
   return ret
 
 
+# each request runs on a connection of its own; see yamwfw.querycall
+dbutils.configure_pool(statement_timeout=config['web_statement_timeout_ms'])
+
+
 class yamwfw(object):
   def handle_error(self,env,start,exc,msg):
-    dbutils.get_db_conn() # reset the database transaction
     start("400 BAD REQUEST", [ ('Content-type','text/plain') ] )
     return [ msg, str(exc) ]
 
@@ -54,6 +57,9 @@ class yamwfw(object):
     else:
       start( "200 OK", [('Content-type','application/json')] )
       return [ self.return_json(result)+"\n" ]
+    finally:
+      # rolls back whatever a failed request left behind
+      dbutils.release_conn()
 
 
 class GetStops(yamwfw):
@@ -61,6 +67,11 @@ class GetStops(yamwfw):
     return SIF.get_stops(**values)
   
 
+class GetNearestStops(yamwfw):
+  def handle_query(self,values):
+    return SIF.get_nearest_stops(**values)
+
+
 class GetStopInfo(yamwfw):
   def handle_query(self,values):
     return SIF.get_stop_info(**values)
@@ -76,15 +87,23 @@ class GetRoutesForStop(yamwfw):
     return SIF.get_routes_for_stop(**values)
 
 get_stops = GetStops().querycall
+get_nearest_stops = GetNearestStops().querycall
 get_stop_info = GetStopInfo().querycall
 get_lateness_stat = GetLatenessStat().querycall
 get_routes_for_stop = GetRoutesForStop().querycall
 
+# load the stops up front rather than on the first request, and give
+# back the connection that took, since this isn't a request thread
+SIF.load_stop_index()
+dbutils.release_conn()
+
 if __name__=="__main__":
   def start(*args):
     print args
   print get_stops({'QUERY_STRING':
                      "min_lat=37.78&max_lat=37.79&min_lon=-122.40&max_lon=-122.39"}, start)
+  print get_nearest_stops({'QUERY_STRING':
+                             "lat=37.785&lon=-122.395&k=5"}, start)
   print get_stop_info({'QUERY_STRING':
                          'stop_id=6920&dow=0'}, start)
   print get_lateness_stat({'QUERY_STRING':
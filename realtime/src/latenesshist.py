@@ -0,0 +1,159 @@
+"""
+latenesshist.py: Lateness histograms for every observed stop, kept in a
+memory-mapped file so that any number of processes can share them.
+
+Row i of the file belongs to observed_stop_id i, and holds the running
+(prefix) sums of its counts over these bins:
+
+  0            -- earlier than min_minutes
+  1 .. n       -- min_minutes .. max_minutes late, one minute per bin
+  n+1          -- later than max_minutes
+  n+2          -- lateness unknown
+
+so that the number of observations within any bounds is one subtraction.
+
+Only one process (the realtime daemon) should write to the file; it
+makes the file if need be. Readers find no histograms until it has.
+"""
+
+import os
+import numpy as np
+from numpy.lib.format import open_memmap
+
+import rtqueries as rtdb
+from RealtimeConfig import config
+
+
+class LatenessHistograms(object):
+
+  def __init__(self,fname,min_minutes,max_minutes,writable=False):
+    """
+    Opens the histograms in fname, which must have been made for the
+    same min_minutes and max_minutes. If writable, the file is created
+    (empty) if it doesn't exist.
+    """
+    self.fname = fname
+    self.min_minutes = int(min_minutes)
+    self.max_minutes = int(max_minutes)
+    self.num_bins = self.max_minutes - self.min_minutes + 4
+    self.writable = writable
+    self.sums = None
+    self.inode = None
+    if writable and not os.path.exists(fname):
+      self._replace(np.zeros((0,self.num_bins+1),dtype=np.int32))
+    self._open()
+
+  def _replace(self,sums):
+    # Readers may have the current file mapped, so rather than change
+    # its size, write a new file and move it into place.
+    tmpname = "%s.%d.tmp" % (self.fname,os.getpid())
+    new = open_memmap(tmpname, mode='w+', dtype=np.int32, shape=sums.shape)
+    new[:] = sums
+    new.flush()
+    del new
+    os.rename(tmpname,self.fname)
+
+  def _open(self):
+    self.sums = open_memmap(self.fname, mode=self.writable and 'r+' or 'r')
+    if self.sums.shape[1] != self.num_bins+1:
+      raise Exception, "%s was made for a different lateness range" \
+          % (self.fname,)
+    self.inode = os.stat(self.fname).st_ino
+
+  def _refresh(self):
+    # the writer may have replaced the file since we opened it
+    if os.stat(self.fname).st_ino != self.inode:
+      self._open()
+
+  def _grow(self,osid):
+    old = self.sums
+    sums = np.zeros((max(osid+1, 2*len(old), 1024),self.num_bins+1),
+                    dtype=np.int32)
+    sums[:len(old)] = old
+    self._replace(sums)
+    self._open()
+
+  def bin(self,minutes):
+    """
+    Returns the bin which minutes of lateness are counted in.
+    """
+    if minutes is None:
+      return self.num_bins-1
+    if minutes < self.min_minutes:
+      return 0
+    if minutes > self.max_minutes:
+      return self.num_bins-2
+    return minutes - self.min_minutes + 1
+
+  def add(self,osid,minutes,count=1):
+    """
+    Counts count more observations of minutes lateness for osid.
+    """
+    if osid >= len(self.sums):
+      self._grow(osid)
+    self.sums[osid,self.bin(minutes)+1:] += count
+
+  def flush(self):
+    self.sums.flush()
+
+  def rebuild(self,rows):
+    """
+    Replaces the contents of the file with histograms made from
+    (observed_stop_id, minutes_late, num_observations) rows.
+    """
+    rows = list(rows)
+    capacity = 1 + max([r[0] for r in rows] + [-1])
+    counts = np.zeros((capacity,self.num_bins+1),dtype=np.int32)
+    for osid,minutes,num in rows:
+      counts[osid,self.bin(minutes)+1] += num
+    self._replace(np.cumsum(counts,axis=1))
+    self._open()
+
+  def prob_mass(self,osid,lateness_bounds):
+    """
+    Given bounds [(min1,max1),(min2,max2),...] in minutes, returns
+    the fraction of osid's observations within each (inclusive), or
+    None if there are none. Bounds reaching beyond min_minutes or
+    max_minutes take in all the earlier or later observations.
+    """
+    self._refresh()
+    if osid is None or osid >= len(self.sums):
+      return None
+    row = self.sums[osid]
+    total = row[-1]
+    if total == 0:
+      return None
+    ret = []
+    for lo,hi in lateness_bounds:
+      lo,hi = int(lo),int(hi)
+      if lo > hi:
+        ret.append(0.0)
+      else:
+        ret.append(float(row[self.bin(hi)+1] - row[self.bin(lo)]) / total)
+    return ret
+
+
+def rebuild_from_db(hists):
+  hists.rebuild(rtdb.get_lateness_counts())
+
+
+def open_histograms(writable=False):
+  """
+  Opens the histogram file named by the realtime config. A writer
+  builds it from the database first if it doesn't exist yet; for a
+  reader, None is returned until then.
+  """
+  args = (config['lateness_hist_file'], config['min_lateness_minutes'],
+          config['max_lateness_minutes'])
+  if not os.path.exists(args[0]):
+    if not writable:
+      return None
+    rebuild_from_db(LatenessHistograms(*args,writable=True))
+  return LatenessHistograms(*args,writable=writable)
+
+
+if __name__=="__main__":
+  hists = open_histograms(writable=True)
+  print "Rebuilding",hists.fname,"..."
+  rebuild_from_db(hists)
+  print "...done."
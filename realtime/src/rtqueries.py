@@ -1,57 +1,30 @@
-from dbutils import SQLExec,get_cursor,commit
+from dbutils import SQLExec,get_cursor,commit, \
+    register_statement,SQLExecPrepared
 
 
-
-
-def create_observation_id( trip_id, stop_id, day_of_week, stop_sequence ):
-  """
-  Inserts an entry with new observed_stop_id into observation_attributes.
-  Returns the new ID.
-  """
-  ## observed_stop_id is not necessarily unique, across service intervals
-  cur = get_cursor()
-  SQLExec(cur,"select max(observed_stop_id) from observation_attributes")
-  r = list(cur)
-
-  if len(r) == 0 or r[0][0] is None:
-    newid = 0
-  else:
-    newid = r[0][0] + 1
-
-  sql = """\
-insert into observation_attributes
-  (observed_stop_id, trip_id, stop_id, stop_sequence, day_of_week)
-values
-  ( %(osid)s, %(tid)s, %(sid)s, %(seq)s, %(dow)s )
-"""
-
-  SQLExec(cur, sql, {'osid':newid, 'tid':trip_id, 'sid':stop_id,
-                     'seq':stop_sequence, 'dow':day_of_week})
-  cur.close()
-
-  return newid
-
-
-def get_observation_stop_id( trip_id, stop_id, day_of_week, stop_sequence,
-                             auto_create = True):
-  sql="""\
+register_statement("observation_stop_id","""\
 select observed_stop_id
 from observation_attributes oa
 where oa.trip_id=%(tid)s
   and oa.stop_sequence=%(seq)s
   and oa.day_of_week=%(dow)s
-"""
+""")
 
+def get_observation_stop_id( trip_id, stop_id, day_of_week, stop_sequence ):
+  """
+  Returns the observed_stop_id of the given stop of a trip on the given
+  day of the week, or None if it has never been observed. (Observation
+  IDs are made by upsert_observations.)
+  """
   cur = get_cursor()
-  SQLExec(cur, sql, {'tid':trip_id,'seq':stop_sequence,'dow':day_of_week})
+  SQLExecPrepared(cur, "observation_stop_id",
+                  {'tid':trip_id,'seq':stop_sequence,'dow':day_of_week})
   
   rows = [r[0] for r in cur]
+  cur.close()
 
   if len(rows) == 0:
-    if auto_create:
-      ret = create_observation_id(trip_id,stop_id,day_of_week,stop_sequence)
-    else:
-      ret = None
+    ret = None
   elif len(rows) > 1:
     raise Exception, "Redundant observation IDs"
   else:
@@ -60,116 +33,93 @@ where oa.trip_id=%(tid)s
   return ret
 
 
-def create_observation_row( trip_id, stop_id, day_of_week, stop_sequence, 
-                             lateness_minutes, initial_num_obs=1 ):
-  obs_id = get_observation_stop_id(trip_id,stop_id,day_of_week,stop_sequence,
-                                   auto_create = True)
+def upsert_observations( cur, obs_sql, params=None ):
+  """
+  Given obs_sql, a select of (trip_id, stop_id, stop_sequence,
+  day_of_week, minutes_late) rows, counts each row as one lateness
+  observation, creating any observation_attributes and
+  simplified_lateness_observations rows needed, all in one statement.
+
+  Returns a list of (observed_stop_id, minutes_late, count) for the
+  counts that were added.
+
+  obs_sql is run with params if they are given, in which case a literal
+  % in it must be written %%; without params it must be written %.
+  """
   sql = """\
-insert into simplified_lateness_observations 
-  ( minutes_late, num_observations, observed_stop_id )
-values
-  ( %(minutes)s, %(init)s, %(obsid)s )
-"""
-  cur = get_cursor()
-  SQLExec(cur, sql, {'minutes':lateness_minutes,'init':initial_num_obs,
-                     'obsid':obs_id})
-  cur.close()
+with obs as (
+%s
+),
+ids as (
+  insert into observation_attributes
+    (trip_id, stop_id, stop_sequence, day_of_week)
+  select distinct on (trip_id, stop_sequence, day_of_week)
+    trip_id, stop_id, stop_sequence, day_of_week
+  from obs
+  on conflict (trip_id, stop_sequence, day_of_week)
+    do update set stop_id = observation_attributes.stop_id
+  returning observed_stop_id, trip_id, stop_sequence, day_of_week
+),
+counts as (
+  select ids.observed_stop_id, obs.minutes_late, count(*)::integer as num
+  from obs inner join ids using (trip_id, stop_sequence, day_of_week)
+  group by ids.observed_stop_id, obs.minutes_late
+),
+upserted as (
+  insert into simplified_lateness_observations
+    ( observed_stop_id, minutes_late, num_observations )
+  select observed_stop_id, minutes_late, num from counts
+  on conflict (minutes_late, observed_stop_id)
+    do update set num_observations =
+      simplified_lateness_observations.num_observations
+        + excluded.num_observations
+)
+select observed_stop_id, minutes_late, num from counts
+""" % (obs_sql,)
+
+  SQLExec(cur, sql, params)
+  return [tuple(r) for r in cur]
 
 
 def record_observations( gpssched ):
   """
-  Given a GPSBusSchedule, records simplified lateness observations
+  Given a GPSBusSchedule, records simplified lateness observations.
+  Returns the counts added, as upsert_observations does, so that they
+  can be added to the lateness histograms once they are committed.
   """
   trip_id = gpssched.getGTFSSchedule().trip_id
   dow = gpssched.getTrackedVehicleSegment().reports[0].dayOfWeek()
 
+  stop_ids,stop_seqs,minutes = [],[],[]
   for arrival in gpssched.getGPSSchedule():
-    stop_id = arrival['stop_id']
-    stop_sequence = arrival['stop_sequence']
-
     if arrival['actual_arrival_time_seconds'] is None:
       continue # don't store null lateness entries
 
     lateness_seconds = (arrival['actual_arrival_time_seconds']
                         - arrival['departure_time_seconds'])
 
-    lateness_observed( trip_id, stop_id, dow, stop_sequence, lateness_seconds )
-    
+    stop_ids.append(arrival['stop_id'])
+    stop_seqs.append(arrival['stop_sequence'])
+    # round to the nearest minute
+    minutes.append(int( (lateness_seconds/60.0) + 0.5 ))
 
-def lateness_observed( trip_id, stop_id, day_of_week, stop_sequence, 
-                       lateness_seconds, auto_create=True ):
-  """
-  Increments the count for the indicated observation and returns True. 
-  If the entry does not exist, will create the entry if auto_create is 
-  True, otherwise returns False.
-  """
-  sql = """\
-update simplified_lateness_observations
-set num_observations = num_observations+1
-where minutes_late=%(lateness)s
-  and observed_stop_id=%(osid)s
-"""
-  osid = get_observation_stop_id( trip_id,stop_id,day_of_week,stop_sequence,
-                                  auto_create = False )
-  # round to the nearest minute
-  ret = True
-  if lateness_seconds is not None:
-    lateness_minutes = int( (lateness_seconds/60.0) + 0.5 )
-  else:
-    lateness_minutes = None
-  cur = get_cursor()
-  SQLExec(cur,sql, {'osid':osid,'lateness':lateness_minutes})
+  if not stop_ids:
+    return []
 
-  if cur.rowcount == 0:
-    if auto_create:
-      create_observation_row(trip_id,stop_id,day_of_week,stop_sequence,
-                             lateness_minutes,initial_num_obs=1)
-    else:
-      ret = False
-  elif cur.rowcount > 1:
-    raise Exception, "Redundant rows in observations table"
-
-  cur.close()
-  return ret
-
-
-def measure_prob_mass( trip_id, stop_id, day_of_week, stop_sequence, 
-                       lateness_bounds ):
-  sql = """\
-select num_observations, minutes_late
-from simplified_lateness_observations slo
-  inner join observation_attributes oa
-    on slo.observed_stop_id = oa.observed_stop_id
-      and oa.trip_id=%(tid)s
-      and oa.stop_sequence=%(seq)s
-      and oa.day_of_week=%(dow)s
+  obs_sql = """\
+  select %(tid)s::text as trip_id, stop_id, stop_sequence,
+    %(dow)s::integer as day_of_week, minutes_late
+  from unnest( %(sids)s::text[], %(seqs)s::integer[], %(mins)s::integer[] )
+    as t (stop_id, stop_sequence, minutes_late)
 """
-
   cur = get_cursor()
-  SQLExec(cur, sql, {'tid':trip_id,'seq':stop_sequence,'dow':day_of_week})
-
-  rows = map( lambda r: (r['num_observations'],r['minutes_late']),
-              cur.fetchall() );
-  
+  counts = upsert_observations( cur, obs_sql, {'tid':trip_id, 'dow':dow,
+                                               'sids':stop_ids,
+                                               'seqs':stop_seqs,
+                                               'mins':minutes} )
   cur.close()
-
-  reducer = lambda l,r: l+r[0]
-  total = reduce( reducer, rows, 0 )
-  sums = [0] * len(lateness_bounds)
-
-  for i,(min,max) in enumerate(lateness_bounds):
-    sums[i] = reduce(reducer,
-                     filter( lambda r: min<=r[1]<=max, rows ),
-                     0)
-  
-  if total == 0:
-    return None
-
-  return map(lambda i: float(sums[i])/total, 
-             range(len(lateness_bounds)))
-
-
-
+  return counts
+    
 
 def get_stops( min_lat, max_lat, min_lon, max_lon ):
   sql = """\
@@ -189,6 +139,32 @@ where stop_lat >= %(min_lat)s
   return map(dict,rows)
 
 
+def get_lateness_counts():
+  """
+  Returns all (observed_stop_id, minutes_late, num_observations) rows.
+  """
+  sql = """\
+select observed_stop_id, minutes_late, num_observations
+from simplified_lateness_observations
+"""
+  cur = get_cursor()
+  SQLExec(cur,sql)
+  rows = [tuple(r) for r in cur]
+  cur.close()
+  return rows
+
+
+def get_all_stops():
+  sql = """\
+select stop_id, stop_lat, stop_lon, stop_name from gtf_stops
+"""
+  cur = get_cursor()
+  SQLExec(cur,sql)
+  rows = cur.fetchall()
+  cur.close()
+  return rows
+
+
 def get_stop_info( stop_id, day_of_week ):
 
   ## SF hack here, for now.
@@ -230,29 +206,21 @@ def simplified_lateness_counts():
   This is a one-time function to translate all data from datamining_table
   into simplified_lateness_observations.
   """
-  sql = """
-select dm.lateness, dm.gtfs_trip_id, dm.stop_id, dm.stop_sequence, 
-  ((EXTRACT(DOW FROM gs.trip_date) + 6)::integer % 7) as dow
-from datamining_table dm
-  inner join gps_segments gs on gs.gps_segment_id = dm.gps_segment_id
+  # trunc() rounds like python's int() does in record_observations.
+  # (This is run without params, so its % is not doubled.)
+  obs_sql = """\
+  select dm.gtfs_trip_id as trip_id, dm.stop_id, dm.stop_sequence, 
+    ((EXTRACT(DOW FROM gs.trip_date) + 6)::integer % 7) as day_of_week,
+    trunc(dm.lateness/60.0 + 0.5)::integer as minutes_late
+  from datamining_table dm
+    inner join gps_segments gs on gs.gps_segment_id = dm.gps_segment_id
+  where dm.lateness is not null
 """
 
   cur = get_cursor()
-  SQLExec(cur,sql);
-
-  tot = cur.rowcount
-  i=1
-  for row in cur:
-    if row['lateness'] is None:
-      continue
-    if i%1000 == 0:
-      print i,"/",tot
-    i+=1
-    lateness_observed( row['gtfs_trip_id'], row['stop_id'],
-                       row['dow'], 
-                       row['stop_sequence'], row['lateness'],
-                       auto_create = True );
+  counts = upsert_observations( cur, obs_sql )
   cur.close()
+  print "Recorded",sum([c[2] for c in counts]),"observations"
 
 
 def get_routes_for_stop( stop_id ):
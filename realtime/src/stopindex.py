@@ -0,0 +1,125 @@
+"""
+stopindex.py: An in-memory spatial index of GTFS stops.
+
+Stops are bucketed into a uniform grid of CELL_DEGREES square cells,
+so that bounding box and nearest-stop queries only have to look at
+the stops in nearby cells.
+"""
+
+import numpy as np
+import gisarray as gisa
+
+CELL_DEGREES = 0.005 # roughly 500m
+
+
+class StopIndex(object):
+  """
+  Holds every stop as a dict with keys 'stop_id', 'lat', 'lon' and
+  'stop_name', in a grid keyed by (lat cell, lon cell).
+  """
+
+  def __init__(self,stops,cell_degrees=CELL_DEGREES):
+    """
+    Builds the index from dictlike rows with keys 'stop_id', 'stop_lat',
+    'stop_lon' and 'stop_name'.
+    """
+    self.cell_degrees = cell_degrees
+    self.stops = [ { 'stop_id' : s['stop_id'],
+                     'lat' : float(s['stop_lat']),
+                     'lon' : float(s['stop_lon']),
+                     'stop_name' : s['stop_name'] }
+                   for s in stops ]
+    self.lats = np.array([s['lat'] for s in self.stops],dtype=np.float64)
+    self.lons = np.array([s['lon'] for s in self.stops],dtype=np.float64)
+
+    self.cells = {}
+    rows = self._cell(self.lats)
+    cols = self._cell(self.lons)
+    for i,cell in enumerate(zip(rows.tolist(),cols.tolist())):
+      self.cells.setdefault(cell,[]).append(i)
+    for cell,members in self.cells.items():
+      self.cells[cell] = np.array(members,dtype=np.int64)
+
+    if self.cells:
+      self.min_row,self.max_row = rows.min(),rows.max()
+      self.min_col,self.max_col = cols.min(),cols.max()
+
+  def __len__(self):
+    return len(self.stops)
+
+  def _cell(self,degrees):
+    return np.floor(np.asarray(degrees) / self.cell_degrees).astype(np.int64)
+
+  def _members(self,cells):
+    found = [self.cells[c] for c in cells if c in self.cells]
+    if not found:
+      return np.zeros(0,dtype=np.int64)
+    return np.concatenate(found)
+
+  def bbox(self,min_lat,max_lat,min_lon,max_lon):
+    """
+    Returns the stops with min_lat <= lat <= max_lat and
+    min_lon <= lon <= max_lon.
+    """
+    if not self.cells:
+      return []
+    min_lat,max_lat,min_lon,max_lon = map(float,(min_lat,max_lat,
+                                                 min_lon,max_lon))
+    r0 = max(self._cell(min_lat),self.min_row)
+    r1 = min(self._cell(max_lat),self.max_row)
+    c0 = max(self._cell(min_lon),self.min_col)
+    c1 = min(self._cell(max_lon),self.max_col)
+    if r0 > r1 or c0 > c1:
+      return []
+
+    if (r1-r0+1)*(c1-c0+1) > len(self.cells):
+      # cheaper to look at every stop
+      candidates = np.arange(len(self.stops))
+    else:
+      candidates = self._members([(r,c) for r in xrange(r0,r1+1)
+                                        for c in xrange(c0,c1+1)])
+    lats,lons = self.lats[candidates],self.lons[candidates]
+    inside = (lats >= min_lat) & (lats <= max_lat) \
+        & (lons >= min_lon) & (lons <= max_lon)
+    return [self.stops[i] for i in np.sort(candidates[inside])]
+
+  def nearest(self,lat,lon,k=10):
+    """
+    Returns the k stops nearest to (lat,lon), nearest first, as
+    measured by gisutils.distance_meters.
+    """
+    if not self.cells or k <= 0:
+      return []
+    lat,lon = float(lat),float(lon)
+    row,col = self._cell(lat),self._cell(lon)
+    m_per_lat,m_per_lon = gisa.latlon_distance_conversion(lat)
+    # anything outside the first r rings of cells is at least r times
+    # this far away (less a little, as the conversion varies with lat)
+    ring_meters = 0.9 * self.cell_degrees \
+        * min(abs(m_per_lat),abs(m_per_lon))
+    max_ring = max(abs(row-self.min_row),abs(row-self.max_row),
+                   abs(col-self.min_col),abs(col-self.max_col))
+
+    candidates = np.zeros(0,dtype=np.int64)
+    r = 0
+    while True:
+      if r == 0:
+        ring = [(row,col)]
+      else:
+        ring = [(row+dr,col+dc) for dr in xrange(-r,r+1)
+                                for dc in xrange(-r,r+1)
+                                if max(abs(dr),abs(dc)) == r]
+      candidates = np.concatenate((candidates,self._members(ring)))
+      if r >= max_ring:
+        break
+      if len(candidates) >= k:
+        dists = gisa.distance_meters(lat,lon,self.lats[candidates],
+                                     self.lons[candidates])
+        if np.sort(dists)[k-1] <= r*ring_meters:
+          break
+      r += 1
+
+    dists = gisa.distance_meters(lat,lon,self.lats[candidates],
+                                 self.lons[candidates])
+    order = np.argsort(dists,kind='mergesort')[:k]
+    return [self.stops[i] for i in candidates[order]]
@@ -42,7 +42,7 @@ def make_dirtag(sched):
   return ret
 
 def make_xml(sched,date,maxerr_seconds):
-  stops = sched.stops
+  stops = list(sched.stops) # don't add to the cached stop list
   vehicle_id = "randomvid_%d" % (int(random() * 10000))
   # add fake stop at the end to trigger route match
   stops.append( None )
@@ -0,0 +1,73 @@
+"""
+Checks the SQL rtqueries sends, against a cursor which substitutes
+parameters the way psycopg2 does. Needs psycopg2 to import dbutils,
+but not a database.
+
+Run with: python -m unittest discover -s realtime/tests
+"""
+
+import unittest
+from os import path,sys
+
+srcdir = path.join(path.dirname(path.abspath(__file__)),"../src")
+sys.path.insert(0,path.join(srcdir,"../../common/src"))
+sys.path.insert(0,srcdir)
+
+try:
+  import rtqueries as rtdb
+except ImportError:
+  rtdb = None
+
+
+class SubstitutingCursor(object):
+  """
+  Records each statement as the server would receive it. As with
+  psycopg2, statements with parameters are %-formatted (so %% becomes
+  %), and statements without any are sent untouched.
+  """
+
+  def __init__(self,rows=()):
+    self.statements = []
+    self.rows = list(rows)
+
+  def execute(self,sql,params=None):
+    if params is not None:
+      sql = sql % dict([(k,"'%s'" % (v,)) for k,v in params.items()])
+    self.statements.append(sql)
+
+  def __iter__(self):
+    return iter(self.rows)
+
+  def close(self):
+    pass
+
+
+@unittest.skipIf(rtdb is None, "psycopg2 is not installed")
+class UpsertObservationsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.cursor = SubstitutingCursor([(7,2,3)])
+    self.get_cursor = rtdb.get_cursor
+    rtdb.get_cursor = lambda name=None: self.cursor
+
+  def tearDown(self):
+    rtdb.get_cursor = self.get_cursor
+
+  def test_simplified_lateness_counts(self):
+    rtdb.simplified_lateness_counts()
+    sql, = self.cursor.statements
+    self.assertFalse("%%" in sql)
+    self.assertTrue("::integer % 7" in sql)
+
+  def test_upsert_with_params(self):
+    ret = rtdb.upsert_observations(self.cursor,
+                                   "select %(tid)s::text as trip_id, 1 %% 7",
+                                   {'tid':'trip'})
+    sql, = self.cursor.statements
+    self.assertFalse("%%" in sql)
+    self.assertTrue("select 'trip'::text as trip_id, 1 % 7" in sql)
+    self.assertEqual(ret,[(7,2,3)])
+
+
+if __name__ == "__main__":
+  unittest.main()